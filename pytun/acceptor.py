@@ -9,6 +9,11 @@ import loglevel
 _logger = loglevel.get_logger('acceptor')
 
 
+LISTEN_BACKLOG = 128
+# pending fast open requests, i.e. accepted with data before the handshake
+FAST_OPEN_QUEUE = 256
+
+
 class Acceptor:
 
     def __init__(self, prefix=None):
@@ -22,29 +27,144 @@ class Acceptor:
         self._rev.set_write(False)
         self._rev.set_fd(self._fd.fileno())
         self._rev.set_handler(lambda ev: self._on_accept())
+        self._rev.set_name('accept')
 
         self._onAccepted = None
         self._onClosed = None
 
+        # 0 means no limit
+        self._max_accepts = 0
+        self._max_streams = 0
+        self._rate = 0
+        self._burst = 0
+        self._tokens = 0.0
+        self._refilled = 0.0
+
+        self._listening = False
+        self._paused = False
+        self._resume_ev = None
+
+        self._streams = 0
+        self._accepted = 0
+        self._rejected = 0
+        self._pauses = 0
+
+    def set_reuse_port(self):
+        so_reuseport = getattr(socket, 'SO_REUSEPORT', 15)
+        self._fd.setsockopt(socket.SOL_SOCKET, so_reuseport, 1)
+
+    def set_fast_open(self, queue=FAST_OPEN_QUEUE):
+        tcp_fastopen = getattr(socket, 'TCP_FASTOPEN', 23)
+        try:
+            self._fd.setsockopt(socket.IPPROTO_TCP, tcp_fastopen, queue)
+        except socket.error as msg:
+            _logger.warning('TCP_FASTOPEN: %s', os.strerror(msg.errno))
+
     def bind(self, addr, port):
         _logger.debug('bind')
         self._fd.bind((addr, port))
         _logger.debug('bind to: %s:%d', addr, port)
 
-    def listen(self, backlog=0):
+    def listen(self, backlog=LISTEN_BACKLOG):
         _logger.debug('listen')
         self._fd.listen(backlog)
-        Event.addEvent(self._rev)
+        self._listening = True
+        if self._can_accept():
+            Event.addEvent(self._rev)
+        else:
+            self._pause()
+
+    def set_max_accepts(self, count):
+        """accepts at most `count` connections per loop iteration"""
+        self._max_accepts = count
+
+    def set_max_streams(self, count):
+        """stops accepting while `count` accepted streams are open"""
+        self._max_streams = count
+
+    def set_accept_rate(self, rate, burst=None):
+        """token bucket, `rate` accepts per second on average and at most
+        `burst` at once"""
+        self._rate = rate
+        self._burst = burst if burst is not None else max(rate, 1)
+        self._tokens = float(self._burst)
+        self._refilled = Event.now()
+
+    def get_stats(self):
+        return {
+            'accepted': self._accepted,
+            'rejected': self._rejected,
+            'paused': self._pauses,
+            'streams': self._streams
+        }
+
+    def _refill(self):
+        if self._rate <= 0:
+            return
+        # accepted while polling, Event.now() lags behind
+        now = Event.update_time()
+        self._tokens = min(self._burst, self._tokens + (now - self._refilled) * self._rate)
+        self._refilled = now
+
+    def _can_accept(self):
+        if self._max_streams > 0 and self._streams >= self._max_streams:
+            return False
+        if self._rate > 0:
+            self._refill()
+            if self._tokens < 1:
+                return False
+        return True
+
+    def _pause(self):
+        _logger.debug('%s, pause accepting, streams: %d', self._prefix, self._streams)
+        if not self._paused:
+            self._paused = True
+            self._pauses += 1
+        if Event.isEventSet(self._rev):
+            Event.delEvent(self._rev)
+        # out of tokens, come back once there is one; at the stream limit
+        # a released stream resumes it
+        if self._rate > 0 and self._tokens < 1 and self._resume_ev is None:
+            delay = int((1 - self._tokens) * 1000 / self._rate) + 1
+            self._resume_ev = Event.add_timer(delay)
+            self._resume_ev.set_handler(lambda ev: self._on_resume_timer())
+
+    def _on_resume_timer(self):
+        self._resume_ev = None
+        self._try_resume()
+
+    def _try_resume(self):
+        if not self._paused:
+            return
+        if not self._can_accept():
+            self._pause()
+            return
+        _logger.debug('%s, resume accepting', self._prefix)
+        self._paused = False
+        if self._listening and not Event.isEventSet(self._rev):
+            Event.addEvent(self._rev)
+
+    def _on_stream_released(self, _stream):
+        self._streams -= 1
+        self._try_resume()
 
     def _on_accept(self):
         _logger.debug('_on_accept')
+        accepted = 0
         while True:
+            if self._max_accepts > 0 and accepted >= self._max_accepts:
+                # the rest waits for the next loop iteration, other fds first
+                return
+            if not self._can_accept():
+                self._pause()
+                return
             try:
                 sock, addr = self._fd.accept()
                 _logger.debug('fd: %d accept fd: %d',
                               self._fd.fileno(), sock.fileno())
             except socket.error as msg:
                 if msg.errno == errno.ECONNABORTED:
+                    self._rejected += 1
                     continue
                 if msg.errno != errno.EAGAIN and msg.errno != errno.EINPROGRESS:
                     _logger.error('fd: %d, accept: %s',
@@ -56,15 +176,24 @@ class Acceptor:
                         except Exception as ex:
                             _logger.error('_onClosed: %s', str(ex))
                             _logger.exception(traceback.format_exc())
+                else:
+                    Event.eventDrained(self._rev)
                 return
             else:
+                accepted += 1
+                self._accepted += 1
+                self._streams += 1
+                if self._rate > 0:
+                    self._tokens -= 1
                 new_stream = Stream(sock, prefix=self._prefix)
                 new_stream._connected = True
+                new_stream.set_on_released(self._on_stream_released)
                 try:
                     self._onAccepted(new_stream, addr)
                 except Exception as e:
                     _logger.error('_onAccepted: %s', e)
                     _logger.exception(traceback.format_exc())
+                    self._rejected += 1
                     new_stream.close()
 
     def set_on_accepted(self, on_accepted):
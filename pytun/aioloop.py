@@ -0,0 +1,144 @@
+import os
+import sys
+import traceback
+from collections import OrderedDict
+from event import Event
+if sys.version_info[0] == 2:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        import asyncio
+else:
+    import asyncio
+
+import loglevel
+_logger = loglevel.get_logger('aioloop')
+_logger.setLevel(loglevel.DEFAULT_LEVEL)
+
+
+class AsyncioLoop:
+    """Event backend running on an asyncio loop, uvloop if it is installed.
+
+    processEvents runs the asyncio loop until either some fd became ready
+    or the timeout passed, so other asyncio code sharing the loop keeps
+    running while pytun waits. The ready events are handled once the loop
+    stopped: trollius stops by raising from a callback, which leaves the
+    rest of its iteration for the next run, and an fd may be reported
+    twice then.
+    """
+
+    _aioloop = None
+
+    @staticmethod
+    def init(loop=None):
+        AsyncioLoop._aioloop = AsyncioLoop(loop)
+        # only one instance is allowed
+        Event.addEvent = staticmethod(lambda ev: AsyncioLoop._aioloop.register(ev))
+        Event.delEvent = staticmethod(lambda ev: AsyncioLoop._aioloop.deregister(ev))
+        Event.isEventSet = staticmethod(lambda ev: AsyncioLoop._aioloop.is_set(ev))
+        Event.processEvents = staticmethod(lambda t: AsyncioLoop._aioloop.process_events(t))
+
+    @staticmethod
+    def new_loop():
+        try:
+            import uvloop
+            _logger.debug('uvloop')
+            return uvloop.new_event_loop()
+        except ImportError:
+            return asyncio.new_event_loop()
+
+    def __init__(self, loop=None):
+        if loop is None:
+            loop = self.new_loop()
+            asyncio.set_event_loop(loop)
+        self._loop = loop
+
+        self._registered_read = {}
+        self._registered_write = {}
+        # id(event) -> event, ready in this run of the loop
+        self._ready = OrderedDict()
+        self._stopping = False
+
+        self._last_time = Event.now()
+
+    def get_loop(self):
+        return self._loop
+
+    def register(self, event):
+        fd = event.get_fd()
+        if event.is_write():
+            assert(fd not in self._registered_write)
+            self._registered_write[fd] = event
+            self._loop.add_writer(fd, self._on_ready, event)
+        else:
+            assert(fd not in self._registered_read)
+            self._registered_read[fd] = event
+            self._loop.add_reader(fd, self._on_ready, event)
+
+    def deregister(self, event):
+        fd = event.get_fd()
+        if event.is_write():
+            if fd not in self._registered_write:
+                _logger.warn("No write event registered for fd: %d", fd)
+                return
+            del self._registered_write[fd]
+            self._loop.remove_writer(fd)
+        else:
+            if fd not in self._registered_read:
+                _logger.warn("No read event registered for fd: %d", fd)
+                return
+            del self._registered_read[fd]
+            self._loop.remove_reader(fd)
+
+    def is_set(self, event):
+        fd = event.get_fd()
+        if event.is_write():
+            return fd in self._registered_write
+        else:
+            return fd in self._registered_read
+
+    def _close_fd(self, fd):
+        if fd in self._registered_read:
+            self._loop.remove_reader(fd)
+            del self._registered_read[fd]
+        if fd in self._registered_write:
+            self._loop.remove_writer(fd)
+            del self._registered_write[fd]
+        try:
+            os.close(fd)
+        finally:
+            pass
+
+    def _stop(self):
+        # once per run, every stop() queues another stop with trollius
+        if not self._stopping:
+            self._stopping = True
+            self._loop.stop()
+
+    def _on_ready(self, event):
+        self._ready[id(event)] = event
+        self._stop()
+
+    def process_events(self, timeout):
+        handle = self._loop.call_later(timeout, self._stop)
+        self._loop.run_forever()
+        handle.cancel()
+        self._stopping = False
+
+        ready, self._ready = self._ready.values(), OrderedDict()
+        for event in ready:
+            registered = self._registered_write if event.is_write() else self._registered_read
+            try:
+                # not if it was deregistered meanwhile, or the fd reused
+                if registered.get(event.get_fd()) is event:
+                    event.get_handler()(event)
+            except Exception as ex:
+                self._close_fd(event.get_fd())
+                _logger.warning('%s, event handler exception', str(ex))
+                traceback.print_exc()
+
+        current_time = Event.now()
+        if current_time - self._last_time > 60.0:
+            _logger.info('current number of opened fd: %d',
+                         len(set(self._registered_write) | set(self._registered_read)))
+            self._last_time = current_time
@@ -0,0 +1,168 @@
+from collections import deque
+from event import Event
+
+import loglevel
+_logger = loglevel.get_logger('autoscaler')
+_logger.setLevel(loglevel.DEFAULT_LEVEL)
+
+
+# tunnels of a pool sized by load, unless a size is given
+MIN_TUNNELS = 2
+MAX_TUNNELS = 16
+# ms between two looks at the load
+AUTOSCALE_INTERVAL = 2000
+# per tunnel, bytes outstanding and bytes/s sent and received, above either
+# of them the pool is too small
+QUEUE_TARGET = 256 * 1024
+RATE_TARGET = 4 * 1024 * 1024
+# the pool is too large if one tunnel less would stay below this share of
+# both targets
+SHRINK_RATIO = 0.25
+# looks in a row the pool has to be too small, or too large, to change it
+GROW_LOOKS = 2
+SHRINK_LOOKS = 15
+# looks after a change before the next, the new tunnel takes its share
+COOLDOWN_LOOKS = 3
+# scaling decisions kept for get_decisions()
+DECISIONS_KEPT = 64
+
+
+class Autoscaler(object):
+    """Sizes a TunnelPool between min_size and max_size by its load.
+
+    Every AUTOSCALE_INTERVAL it takes the bytes outstanding and the
+    throughput per established tunnel. While either stays above its target
+    the pool grows by a tunnel. When one tunnel less would still be well
+    below both targets, the pool shrinks: the least busy tunnel is drained,
+    it takes no new flows and is closed once its flows are gone. Every
+    decision is logged, kept for get_decisions() and passed to the handler
+    set with set_on_decision().
+    """
+
+    # the started ones
+    _live = []
+
+    def __init__(self, pool, min_size=MIN_TUNNELS, max_size=MAX_TUNNELS):
+        assert(1 <= min_size <= max_size)
+        self._pool = pool
+        self._min_size = min_size
+        self._max_size = max_size
+        self._timer = None
+        self._too_small = 0
+        self._too_large = 0
+        self._cooldown = 0
+        self._decisions = deque(maxlen=DECISIONS_KEPT)
+        self._grown = 0
+        self._shrunk = 0
+        self._on_decision = None
+
+    def set_on_decision(self, handler):
+        """handler(decision) with the dict get_decisions() lists"""
+        self._on_decision = handler
+
+    def start(self):
+        if self._timer is None:
+            self._arm()
+            Autoscaler._live.append(self)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.del_timer()
+            self._timer = None
+            Autoscaler._live.remove(self)
+
+    def _arm(self):
+        self._timer = Event.add_timer(AUTOSCALE_INTERVAL)
+        self._timer.set_handler(lambda ev: self._on_timer())
+
+    def _on_timer(self):
+        self._arm()
+        self._pool.close_drained()
+        self._look()
+
+    def _measure(self):
+        tunnels = [t for t in self._pool.get_tunnels() if t.is_established()]
+        if len(tunnels) == 0:
+            return None, None
+        queue = sum(t.get_outstanding() for t in tunnels) / float(len(tunnels))
+        rate = 0.0
+        for tunnel in tunnels:
+            stats = tunnel.get_stats()
+            rate += stats['sent_rate'] + stats['received_rate']
+        return queue, rate / len(tunnels)
+
+    def _look(self):
+        size = self._pool.get_size()
+        queue, rate = self._measure()
+        if queue is None:
+            return
+        if self._cooldown > 0:
+            self._cooldown -= 1
+            return
+
+        if queue > QUEUE_TARGET or rate > RATE_TARGET:
+            self._too_small += 1
+        else:
+            self._too_small = 0
+        fewer = size / float(size - 1) if size > 1 else None
+        if fewer is not None and queue * fewer < QUEUE_TARGET * SHRINK_RATIO and \
+                rate * fewer < RATE_TARGET * SHRINK_RATIO:
+            self._too_large += 1
+        else:
+            self._too_large = 0
+
+        if self._too_small >= GROW_LOOKS and size < self._max_size:
+            self._decide('grow', size, size + 1, queue, rate)
+        elif self._too_large >= SHRINK_LOOKS and size > self._min_size:
+            self._decide('shrink', size, size - 1, queue, rate)
+
+    def _decide(self, action, size, new_size, queue, rate):
+        decision = {
+            'time': Event.now(),
+            'action': action,
+            'from': size,
+            'to': new_size,
+            'queue': int(queue),
+            'rate': int(rate)
+        }
+        via = self._pool.get_via()
+        _logger.info('%s tunnels to %s:%d, %d -> %d, per tunnel %d bytes outstanding, %d bytes/s',
+                     action, via[0], via[1], size, new_size, queue, rate)
+        self._decisions.append(decision)
+        if action == 'grow':
+            self._grown += 1
+        else:
+            self._shrunk += 1
+        self._too_small = 0
+        self._too_large = 0
+        self._cooldown = COOLDOWN_LOOKS
+        self._pool.set_size(new_size)
+        if self._on_decision is not None:
+            self._on_decision(decision)
+
+    def get_decisions(self):
+        """the last DECISIONS_KEPT decisions, oldest first"""
+        return list(self._decisions)
+
+    def get_stats(self):
+        return {
+            'size': self._pool.get_size(),
+            'min_size': self._min_size,
+            'max_size': self._max_size,
+            'draining': len(self._pool.get_draining()),
+            'grown': self._grown,
+            'shrunk': self._shrunk
+        }
+
+    @staticmethod
+    def get_live_autoscalers():
+        return list(Autoscaler._live)
+
+    @staticmethod
+    def dump_stats():
+        for autoscaler in Autoscaler._live:
+            stats = autoscaler.get_stats()
+            via = autoscaler._pool.get_via()
+            _logger.info('tunnels to %s:%d: %d of %d..%d, draining: %d, grown: %d, shrunk: %d',
+                         via[0], via[1], stats['size'], stats['min_size'], stats['max_size'],
+                         stats['draining'], stats['grown'], stats['shrunk'])
@@ -0,0 +1,1685 @@
+#!/usr/bin/env python
+import sys
+import time
+import heapq
+import random
+
+
+def _timeit(func, *args):
+    start = time.time()
+    ret = func(*args)
+    return time.time() - start, ret
+
+
+def bench_timer(count=100000):
+    """add/cancel/expire cost at `count` live timers, heapq vs timing wheel"""
+    from timerwheel import TimingWheel
+
+    now = 1000.0
+    deadlines = [now + random.uniform(0.0, 120.0) for _ in range(count)]
+
+    # the former implementation: cancelling only clears a flag
+    class HeapTimer(object):
+        def __init__(self):
+            self.set = True
+
+    heap = []
+    timers = [HeapTimer() for _ in range(count)]
+
+    def heap_add():
+        for deadline, timer in zip(deadlines, timers):
+            heapq.heappush(heap, (deadline, timer))
+
+    def heap_cancel():
+        for timer in timers[::2]:
+            timer.set = False
+
+    def heap_expire():
+        fired = 0
+        while len(heap) > 0:
+            _, timer = heapq.heappop(heap)
+            if timer.set:
+                fired += 1
+        return fired
+
+    wheel = TimingWheel(now=now)
+    keys = [object() for _ in range(count)]
+    slots = []
+
+    def wheel_add():
+        for deadline, key in zip(deadlines, keys):
+            slots.append(wheel.add(key, deadline))
+
+    def wheel_cancel():
+        for key, slot in zip(keys[::2], slots[::2]):
+            wheel.remove(key, slot)
+
+    def wheel_expire():
+        fired = 0
+        t = now
+        while len(wheel) > 0:
+            t += 0.05
+            fired += len(wheel.expire(t))
+        return fired
+
+    print('%d live timers, half of them cancelled' % count)
+    print('%-8s %10s %10s %10s %12s' % ('', 'add', 'cancel', 'expire', 'queued'))
+    t_add, _ = _timeit(heap_add)
+    t_cancel, _ = _timeit(heap_cancel)
+    queued = len(heap)
+    t_expire, _ = _timeit(heap_expire)
+    print('%-8s %9.3fs %9.3fs %9.3fs %12d' % ('heapq', t_add, t_cancel, t_expire, queued))
+    t_add, _ = _timeit(wheel_add)
+    t_cancel, _ = _timeit(wheel_cancel)
+    queued = len(wheel)
+    t_expire, _ = _timeit(wheel_expire)
+    print('%-8s %9.3fs %9.3fs %9.3fs %12d' % ('wheel', t_add, t_cancel, t_expire, queued))
+
+
+class _CountingPoller(object):
+    """wraps a select.epoll and counts the calls made on it"""
+
+    def __init__(self, poller):
+        self._poller = poller
+        self.counts = {}
+
+    def __getattr__(self, name):
+        method = getattr(self._poller, name)
+
+        def counted(*args):
+            self.counts[name] = self.counts.get(name, 0) + 1
+            return method(*args)
+        return counted
+
+
+def bench_epoll(pairs=200, rounds=200):
+    """epoll syscalls of level vs edge triggered backend under receive toggling"""
+    import socket
+    import errno
+    from event import Event
+    import epoll
+
+    def run(edge_triggered):
+        epoll.Epoll.init(edge_triggered)
+        poller = _CountingPoller(epoll.Epoll._epoll._fd)
+        epoll.Epoll._epoll._fd = poller
+
+        sockets = []
+        events = []
+        received = [0]
+
+        def gen_on_receive(sock, ev):
+            def on_receive(_):
+                while True:
+                    try:
+                        received[0] += len(sock.recv(4096))
+                    except socket.error as ex:
+                        if ex.errno != errno.EAGAIN:
+                            raise
+                        Event.eventDrained(ev)
+                        return
+            return on_receive
+
+        for _ in range(pairs):
+            a, b = socket.socketpair()
+            a.setblocking(False)
+            ev = Event()
+            ev.set_fd(a.fileno())
+            ev.set_handler(gen_on_receive(a, ev))
+            Event.addEvent(ev)
+            sockets.append((a, b))
+            events.append(ev)
+
+        start = time.time()
+        for _ in range(rounds):
+            for (_, b), ev in zip(sockets, events):
+                b.send('x' * 64)
+                # backpressure: toggle the read interest like tcptun does
+                Event.delEvent(ev)
+                Event.addEvent(ev)
+            Event.processEvents(0)
+        elapsed = time.time() - start
+
+        for ev in events:
+            Event.delEvent(ev)
+        for a, b in sockets:
+            a.close()
+            b.close()
+        ctl = sum(count for name, count in poller.counts.items() if name != 'poll')
+        return elapsed, ctl, poller.counts.get('poll', 0), received[0]
+
+    print('%d fds, %d rounds of toggle + poll' % (pairs, rounds))
+    print('%-8s %10s %12s %8s %12s' % ('', 'time', 'epoll_ctl', 'poll', 'received'))
+    for name, edge in (('level', False), ('edge', True)):
+        elapsed, ctl, polls, received = run(edge)
+        print('%-8s %9.3fs %12d %8d %12d' % (name, elapsed, ctl, polls, received))
+
+
+def bench_soon(count=100000):
+    """deferring `count` callbacks, zero-delay timers vs call_soon"""
+    from event import Event
+
+    Event.processEvents = staticmethod(lambda timeout: None)
+    fired = [0]
+
+    def handler(_):
+        fired[0] += 1
+
+    def timers():
+        for _ in range(count):
+            Event.add_timer(0).set_handler(handler)
+        while fired[0] < count:
+            Event.process_events_and_timers()
+
+    def soon():
+        for _ in range(count):
+            Event.call_soon(handler)
+        Event.process_events_and_timers()
+
+    print('%d deferred callbacks' % count)
+    for name, func in (('timer(0)', timers), ('soon', soon)):
+        fired[0] = 0
+        elapsed, _ = _timeit(func)
+        print('%-10s %9.3fs' % (name, elapsed))
+
+
+def _run_forked(func, *args):
+    """runs func in a child, the event loop state is process wide"""
+    import os
+    import traceback
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            func(*args)
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            # os._exit() skips flushing, piped output would be lost
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+        raise Exception('%s killed by signal %d in its child' % (func.__name__, os.WTERMSIG(status)))
+    if os.WEXITSTATUS(status) != 0:
+        raise Exception('%s failed in its child, exit status %d' % (func.__name__, os.WEXITSTATUS(status)))
+
+
+def _loopback_tunnel(label, base_port, connections, size):
+    """echo server behind an accept side and a tcp connect side, all in this
+    process; returns a thread which reports the time taken to echo `size`
+    bytes over every connection and then ends the process"""
+    import os
+    import socket
+    import threading
+    from acceptor import Acceptor
+    from tunnel import Tunnel
+    import tcptun
+
+    def echo_accepted(stream, _):
+        stream.set_on_received(lambda self_, data, _addr: self_.send(data) or True)
+        stream.start_receiving()
+
+    echo = Acceptor('ECHO')
+    echo.bind('127.0.0.1', base_port)
+    echo.listen(128)
+    echo.set_on_accepted(echo_accepted)
+
+    Tunnel.set_tcp_fin_received_handler(tcptun.on_stream_fin_received)
+    Tunnel.set_tcp_closed_handler(tcptun.on_stream_closed)
+    Tunnel.set_tcp_initial_handler(tcptun.on_server_side_initialized)
+    server = Acceptor('TUNNEL')
+    server.bind('127.0.0.1', base_port + 1)
+    server.listen(128)
+    server.set_on_accepted(lambda stream, _: Tunnel(connection=stream).initialize())
+
+    client = Acceptor('TCP')
+    client.bind('127.0.0.1', base_port + 2)
+    client.listen(128)
+    client.set_on_accepted(tcptun.gen_on_client_side_accepted(['127.0.0.1', base_port + 1],
+                                                              ['127.0.0.1', base_port]))
+
+    payload = os.urandom(size)
+    results = []
+
+    def run_client():
+        sock = socket.create_connection(('127.0.0.1', base_port + 2))
+        writer = threading.Thread(target=sock.sendall, args=(payload,))
+        writer.start()
+        received = 0
+        while received < size:
+            data = sock.recv(2 ** 16)
+            if len(data) == 0:
+                break
+            received += len(data)
+        writer.join()
+        sock.close()
+        results.append(received)
+
+    def run_clients():
+        clients = [threading.Thread(target=run_client) for _ in range(connections)]
+        start = time.time()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.time() - start
+        if sum(results) != size * connections:
+            print('echoed %d of %d bytes' % (sum(results), size * connections))
+        print('%-10s %9.3fs %9.1f MB/s' % (label, elapsed, size * connections / elapsed / 1024 ** 2))
+        sys.stdout.flush()
+        os._exit(0)
+
+    thread = threading.Thread(target=run_clients)
+    thread.daemon = True
+    return thread
+
+
+def bench_backend(connections=8, size=4 * 1024 * 1024):
+    """loopback tunnel throughput with the native epoll vs the asyncio backend"""
+
+    def run(name, init, port):
+        from event import Event
+        try:
+            init()
+        except ImportError as ex:
+            print('%-10s skipped: %s' % (name, str(ex)))
+            return
+        _loopback_tunnel(name, port, connections, size).start()
+        Event.process_loop()
+
+    def init_epoll():
+        import epoll
+        epoll.Epoll.init()
+
+    def init_asyncio():
+        import aioloop
+        aioloop.AsyncioLoop.init()
+
+    print('%d connections echoing %d bytes each through the tunnel' % (connections, size))
+    for i, (name, init) in enumerate((('epoll', init_epoll), ('asyncio', init_asyncio))):
+        _run_forked(run, name, init, 19100 + i * 3)
+
+
+def bench_receive_buffer(connections=8, size=4 * 1024 * 1024):
+    """loopback tunnel throughput reading into new strings vs the shared buffer"""
+
+    def run(name, shared, port):
+        from event import Event
+        from nonblocking import NonBlocking
+        import epoll
+        epoll.Epoll.init()
+        if shared:
+            NonBlocking.enable_receive_buffer()
+        _loopback_tunnel(name, port, connections, size).start()
+        Event.process_loop()
+
+    print('%d connections echoing %d bytes each through the tunnel' % (connections, size))
+    for i, (name, shared) in enumerate((('recv', False), ('recv_into', True))):
+        _run_forked(run, name, shared, 19110 + i * 3)
+
+
+def bench_sendv(frames=200000, frame_size=64):
+    """send() per queued chunk vs one vectored write per flush"""
+    import socket
+    import threading
+    import epoll
+    from event import Event
+    from stream import Stream
+
+    epoll.Epoll.init()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+
+    def run(vectored):
+        peer = socket.create_connection(listener.getsockname())
+        conn, _ = listener.accept()
+        stream = Stream(conn, prefix='BENCH')
+        stream._connected = True
+        stream._vectored = vectored
+        calls = [0]
+
+        def gen_counted(method):
+            def counted(*args):
+                calls[0] += 1
+                return method(*args)
+            return counted
+
+        for name in ('_send', '_sendv'):
+            setattr(stream, name, gen_counted(getattr(stream, name)))
+
+        total = frames * frame_size
+        received = [0]
+
+        def drain():
+            while True:
+                data = peer.recv(2 ** 16)
+                if len(data) == 0:
+                    break
+                received[0] += len(data)
+
+        reader = threading.Thread(target=drain)
+        reader.start()
+        frame = 'x' * frame_size
+        start = time.time()
+        for i in range(frames):
+            stream.send(frame)
+            if i % 1000 == 999:
+                Event.process_events_and_timers()
+        stream.shutdown()
+        while not stream.is_closed() and received[0] < total:
+            Event.process_events_and_timers()
+        stream.close()
+        reader.join()
+        elapsed = time.time() - start
+        peer.close()
+        return elapsed, calls[0], received[0]
+
+    print('%d frames of %d bytes' % (frames, frame_size))
+    print('%-8s %10s %10s %12s' % ('', 'time', 'syscalls', 'received'))
+    for name, vectored in (('send', False), ('sendv', True)):
+        elapsed, calls, received = run(vectored)
+        print('%-8s %9.3fs %10d %12d' % (name, elapsed, calls, received))
+
+
+class _LegacyDecoder(object):
+    """the former decoder chain, re-concatenating the remains on every read"""
+
+    def __init__(self, handlers):
+        self._handlers = handlers
+        self._remains = [[] for _ in handlers]
+
+    @staticmethod
+    def _decode_single_depth(handler, data_list):
+        if len(data_list) == 0:
+            return [], 0, []
+        total_processed = []
+        total_consumed_bytes = 0
+        to_process = data_list[0]
+        total_consumed_count = 1
+        while True:
+            processed, consumed_bytes = handler(to_process)
+            if consumed_bytes == 0:
+                if total_consumed_count < len(data_list):
+                    to_process += data_list[total_consumed_count]
+                    total_consumed_count += 1
+                else:
+                    break
+            else:
+                to_process = to_process[consumed_bytes:]
+            if processed is not None:
+                total_processed.append(processed)
+            total_consumed_bytes += consumed_bytes
+        remain = []
+        if len(to_process) > 0:
+            remain.append(to_process)
+        remain.extend(data_list[total_consumed_count:])
+        return total_processed, total_consumed_bytes, remain
+
+    def decode(self, data):
+        to_consume = [data]
+        for depth, handler in enumerate(self._handlers):
+            if len(self._remains[depth]) > 0:
+                self._remains[depth].extend(to_consume)
+                to_consume = self._remains[depth]
+            to_consume, processed, self._remains[depth] = self._decode_single_depth(handler, to_consume)
+            if processed == 0:
+                return []
+        return to_consume
+
+
+def bench_decode(read_size=2 ** 16):
+    """tunnel decoder chain over large frames arriving in `read_size` reads"""
+    import obscure
+    from nonblocking import NonBlocking
+
+    def gen_decoders():
+        return [obscure.gen_http_decode(False), obscure.gen_xor_decrypt(),
+                obscure.unpad_random, obscure.unpack_data]
+
+    def run(decode, stream):
+        decoded = 0
+        for i in range(0, len(stream), read_size):
+            for unit in decode(stream[i: i + read_size]):
+                decoded += len(unit)
+        return decoded
+
+    print('%-10s %10s %10s %10s' % ('frame', 'legacy', 'cursor', 'per MB'))
+    for size in (256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2):
+        stream = 'z' * size
+        for encoder in (obscure.pack_data, obscure.random_padding,
+                        obscure.gen_xor_encrypt(), obscure.gen_http_encode(True)):
+            stream = encoder(stream)
+
+        legacy = _LegacyDecoder(gen_decoders())
+        t_legacy, decoded = _timeit(run, legacy.decode, stream)
+        assert decoded == size
+
+        contexts = [NonBlocking._ReceiveHandlerContext(handler) for handler in gen_decoders()]
+
+        def decode(data):
+            to_consume = [data]
+            for context in contexts:
+                to_consume = context.decode(to_consume)
+            return to_consume
+
+        t_cursor, decoded = _timeit(run, decode, stream)
+        assert decoded == size
+        print('%-10d %9.3fs %9.3fs %9.3fs' % (size, t_legacy, t_cursor, t_cursor / size * 1024 ** 2))
+
+
+def bench_backpressure(endpoints=5000, frames=20000, frame_size=1024):
+    """cpu spent in tunnel backpressure callbacks with `endpoints` streams,
+    notifying on every send vs on watermark crossings"""
+    import socket
+    import threading
+    import epoll
+    from event import Event
+    from stream import Stream
+    from nonblocking import SEND_BUFFER_HIGH
+
+    epoll.Epoll.init()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+
+    class Endpoint(object):
+        # what tcptun does for every endpoint of the tunnel
+        def __init__(self):
+            self.receiving = True
+
+        def start_receiving(self):
+            if not self.receiving:
+                self.receiving = True
+
+        def stop_receiving(self):
+            if self.receiving:
+                self.receiving = False
+
+    class EverySendStream(Stream):
+        # the former policy: ready after every send below the threshold
+        def _check_watermarks(self):
+            if self._to_send_bytes > SEND_BUFFER_HIGH:
+                self._notify_send_buffer(self._on_send_buffer_full, '_on_send_buffer_full')
+            else:
+                self._notify_send_buffer(self._on_ready_to_send, '_on_ready_to_send')
+
+    def run(stream_class):
+        peer = socket.create_connection(listener.getsockname())
+        conn, _ = listener.accept()
+        stream = stream_class(conn, prefix='BENCH')
+        stream._connected = True
+        connections = [Endpoint() for _ in range(endpoints)]
+        calls = [0]
+
+        def on_ready_to_send(_):
+            calls[0] += 1
+            for endpoint in connections:
+                endpoint.start_receiving()
+
+        def on_send_buffer_full(_):
+            calls[0] += 1
+            for endpoint in connections:
+                endpoint.stop_receiving()
+
+        stream.set_on_ready_to_send(on_ready_to_send)
+        stream.set_on_send_buffer_full(on_send_buffer_full)
+
+        total = frames * frame_size
+        received = [0]
+
+        def drain():
+            while received[0] < total:
+                data = peer.recv(2 ** 16)
+                if len(data) == 0:
+                    break
+                received[0] += len(data)
+                # a slow reader, so the send buffer fills up
+                time.sleep(0.0005)
+
+        reader = threading.Thread(target=drain)
+        reader.start()
+        frame = 'x' * frame_size
+        start = time.clock()
+        sent = 0
+        while sent < frames:
+            # producers only write while the tunnel accepts more
+            if connections[0].receiving:
+                stream.send(frame)
+                sent += 1
+            else:
+                Event.process_events_and_timers()
+        while received[0] < total:
+            Event.process_events_and_timers()
+        elapsed = time.clock() - start
+        reader.join()
+        stream.close()
+        Event.process_events_and_timers()
+        peer.close()
+        return elapsed, calls[0]
+
+    print('%d endpoints, %d frames of %d bytes' % (endpoints, frames, frame_size))
+    print('%-10s %10s %10s' % ('', 'cpu', 'callbacks'))
+    for name, stream_class in (('every', EverySendStream), ('watermark', Stream)):
+        elapsed, calls = run(stream_class)
+        print('%-10s %9.3fs %10d' % (name, elapsed, calls))
+
+
+def bench_relay(connections=4, size=32 * 1024 * 1024, base_port=19420):
+    """cpu the accept side spends passing decoy clients through to the
+    unknown connection, copying in python vs splice()"""
+    import os
+    import signal
+    import socket
+    import threading
+    import epoll
+    from event import Event
+    from acceptor import Acceptor
+    import tunnel
+    from relay import SpliceRelay
+
+    if not SpliceRelay.is_supported():
+        print('splice is not supported')
+        return
+
+    def echo(sock):
+        while True:
+            data = sock.recv(2 ** 16)
+            if len(data) == 0:
+                break
+            sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        sock.close()
+
+    def run_echo(listener):
+        while True:
+            sock, _ = listener.accept()
+            thread = threading.Thread(target=echo, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', base_port))
+    listener.listen(128)
+
+    def serve(splice):
+        listener.close()
+        epoll.Epoll.init()
+        tunnel.SPLICE_RELAY = splice
+        tunnel.UNKNOWN_CONN_PORT = base_port
+        server = Acceptor('TUNNEL')
+        server.bind('127.0.0.1', base_port + 1)
+        server.listen(128)
+        server.set_on_accepted(lambda stream, _: tunnel.Tunnel(connection=stream).initialize())
+        Event.process_loop()
+
+    echo_thread = threading.Thread(target=run_echo, args=(listener,))
+    echo_thread.daemon = True
+    echo_thread.start()
+
+    request = 'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n' + os.urandom(size)
+    received = []
+
+    def run_client():
+        sock = socket.create_connection(('127.0.0.1', base_port + 1))
+        writer = threading.Thread(target=sock.sendall, args=(request,))
+        writer.start()
+        total = 0
+        while total < len(request):
+            data = sock.recv(2 ** 16)
+            if len(data) == 0:
+                break
+            total += len(data)
+        writer.join()
+        sock.close()
+        received.append(total)
+
+    print('%d decoy connections, %d MiB each' % (connections, size / 1024 ** 2))
+    print('%-10s %10s %10s' % ('', 'wall', 'cpu'))
+    for name, splice in (('copy', False), ('splice', True)):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve(splice)
+            finally:
+                os._exit(0)
+        time.sleep(0.2)
+        del received[:]
+        clients = [threading.Thread(target=run_client) for _ in range(connections)]
+        start = time.time()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.time() - start
+        os.kill(pid, signal.SIGKILL)
+        _, _, usage = os.wait4(pid, 0)
+        if sum(received) != len(request) * connections:
+            print('%s: echoed %d of %d bytes' % (name, sum(received), len(request) * connections))
+        print('%-10s %9.3fs %9.3fs' % (name, elapsed, usage.ru_utime + usage.ru_stime))
+
+
+def bench_fastopen(requests=200, base_port=19440, rtt=0.02):
+    """time to the first echoed byte over a freshly connected tunnel, with
+    and without TCP Fast Open; the accept side needs
+    net.ipv4.tcp_fastopen = 3 for it to make a difference. Loopback first,
+    then a link of `rtt` seconds: a tun device in a network namespace of its
+    own, every packet delayed by half of it, which needs root"""
+    import os
+    import signal
+    import socket
+    import struct
+    import threading
+    import fcntl
+    import ctypes
+    import ctypes.util
+    import subprocess
+    from collections import deque
+
+    def serve(fast_open, port, link):
+        import epoll
+        from event import Event
+        from acceptor import Acceptor
+        import tunnel
+        import tunnelpool
+        import autoscaler
+        import tcptun
+
+        epoll.Epoll.init()
+        tunnel.FAST_OPEN = fast_open
+
+        def echo_accepted(stream, _):
+            stream.set_on_received(lambda self_, data, _addr: self_.send(data) or True)
+            stream.start_receiving()
+
+        echo = Acceptor('ECHO')
+        echo.bind('127.0.0.1', port)
+        echo.listen()
+        echo.set_on_accepted(echo_accepted)
+
+        tunnel.Tunnel.set_tcp_fin_received_handler(tcptun.on_stream_fin_received)
+        tunnel.Tunnel.set_tcp_closed_handler(tcptun.on_stream_closed)
+        tunnel.Tunnel.set_tcp_initial_handler(tcptun.on_server_side_initialized)
+        server = Acceptor('TUNNEL')
+        server.set_fast_open()
+        server.bind(link[0], port + 1)
+        server.listen()
+        server.set_on_accepted(lambda stream, _: tunnel.Tunnel(connection=stream).initialize())
+
+        # the pools of one tunnel, opened by their first connection
+        autoscaler.MIN_TUNNELS = autoscaler.MAX_TUNNELS = 1
+        pools = []
+
+        class RecordedPool(tunnelpool.TunnelPool):
+            def __init__(self, *args):
+                tunnelpool.TunnelPool.__init__(self, *args)
+                pools.append(self)
+
+        tcptun.TunnelPool = RecordedPool
+
+        def on_client_accepted(stream, from_):
+            # a new tunnel for every request
+            for pool in pools:
+                pool.close()
+            del pools[:]
+            tcptun.gen_on_client_side_accepted([link[1], port + 1], ['127.0.0.1', port])(stream, from_)
+
+        client = Acceptor('TCP')
+        client.bind('127.0.0.1', port + 2)
+        client.listen()
+        client.set_on_accepted(on_client_accepted)
+        Event.process_loop()
+
+    def measure(fast_open, port, link=('127.0.0.1', '127.0.0.1')):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve(fast_open, port, link)
+            finally:
+                os._exit(0)
+        time.sleep(0.2)
+        latencies = []
+        for _ in range(requests):
+            start = time.time()
+            sock = socket.create_connection(('127.0.0.1', port + 2))
+            sock.sendall('x')
+            sock.recv(1)
+            latencies.append(time.time() - start)
+            sock.close()
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        latencies.sort()
+        print('%-10s %8.3fms %8.3fms' % ('fast open' if fast_open else 'connect',
+                                         latencies[len(latencies) / 2] * 1000,
+                                         latencies[len(latencies) * 99 / 100] * 1000))
+
+    def delayed_link(tun):
+        from packet import Packet
+
+        # the tunnel connects to .2, the packets come back from .3 to the
+        # local .1, and the answers to .3 go back from .2
+        local, peer, alias = [struct.unpack('!I', socket.inet_aton('10.9.0.%d' % i))[0] for i in (1, 2, 3)]
+        in_flight = deque()
+
+        def read():
+            while True:
+                packet = Packet(os.read(tun, 65536))
+                if not packet.is_ipv4():
+                    continue
+                destination = packet.get_raw_destination_ip()
+                if destination == peer:
+                    packet.set_raw_source_ip(alias)
+                elif destination == alias:
+                    packet.set_raw_source_ip(peer)
+                else:
+                    continue
+                packet.set_raw_destination_ip(local)
+                in_flight.append((time.time() + rtt / 2, packet.get_packet()))
+
+        def write():
+            while True:
+                if len(in_flight) == 0 or in_flight[0][0] > time.time():
+                    time.sleep(0.0002)
+                    continue
+                os.write(tun, in_flight.popleft()[1])
+
+        for target in (read, write):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def run_delayed():
+        from tundevice import TunDevice
+
+        clone_newnet = 0x40000000
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if libc.unshare(clone_newnet) != 0:
+            print('%d ms link skipped: unshare: %s' % (rtt * 1000, os.strerror(ctypes.get_errno())))
+            return
+        try:
+            tun = os.open('/dev/net/tun', os.O_RDWR)
+        except OSError as ex:
+            print('%d ms link skipped: %s' % (rtt * 1000, ex.strerror))
+            return
+        fcntl.ioctl(tun, TunDevice.TUNSETIFF, struct.pack('16sH', 'tun0', TunDevice.IFF_TUN | TunDevice.IFF_NO_PI))
+        for cmd in ('ip link set lo up', 'ip addr add 10.9.0.1/24 dev tun0', 'ip link set tun0 up'):
+            subprocess.check_call(cmd.split())
+        for name, value in (('ipv4/tcp_fastopen', 3), ('ipv4/conf/all/rp_filter', 0),
+                            ('ipv4/conf/tun0/rp_filter', 0)):
+            with open('/proc/sys/net/' + name, 'w') as f:
+                f.write('%d' % value)
+        delayed_link(tun)
+        print('%d ms link, net.ipv4.tcp_fastopen = 3' % (rtt * 1000))
+        measure(False, base_port + 20, ('10.9.0.1', '10.9.0.2'))
+        measure(True, base_port + 30, ('10.9.0.1', '10.9.0.2'))
+
+    try:
+        with open('/proc/sys/net/ipv4/tcp_fastopen') as f:
+            print('net.ipv4.tcp_fastopen = %s' % f.read().strip())
+    except IOError:
+        pass
+    print('%-10s %10s %10s' % ('', 'p50', 'p99'))
+    measure(False, base_port)
+    measure(True, base_port + 10)
+    if rtt > 0:
+        _run_forked(run_delayed)
+
+
+def bench_mmsg(packets=100000, size=512, burst=64):
+    """cpu a Dgram spends receiving and sending `packets` datagrams, one
+    syscall per datagram vs recvmmsg/sendmmsg batches"""
+    import socket
+    import epoll
+    from event import Event
+    from dgram import Dgram
+    from syscall import MessageBatch
+
+    if not MessageBatch.is_supported():
+        print('recvmmsg/sendmmsg are not supported')
+        return
+    epoll.Epoll.init()
+    payload = 'x' * size
+
+    def receive(batch):
+        Dgram._batch = batch
+        receiver = Dgram()
+        receiver.bind('127.0.0.1', 0)
+        received = [0]
+        receiver.set_on_received(lambda self_, data, addr: received.__setitem__(0, received[0] + 1) or True)
+        receiver.start_receiving()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        to = receiver._fd.getsockname()
+        elapsed = 0.0
+        sent = 0
+        while sent < packets:
+            # a burst small enough for the receive buffer, nothing is dropped
+            for _ in range(burst):
+                sender.sendto(payload, to)
+            sent += burst
+            start = time.clock()
+            while received[0] < sent:
+                Event.process_events_and_timers()
+            elapsed += time.clock() - start
+        receiver.close()
+        sender.close()
+        Event.process_events_and_timers()
+        return elapsed
+
+    def send(batch):
+        Dgram._batch = batch
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(('127.0.0.1', 0))
+        to = sink.getsockname()
+        sender = Dgram()
+        for _ in range(packets):
+            sender.send(payload, to)
+        # only the flushing, queueing costs the same either way
+        start = time.clock()
+        while sender._to_send_bytes > 0:
+            Event.process_events_and_timers()
+        elapsed = time.clock() - start
+        sender.close()
+        Event.process_events_and_timers()
+        sink.close()
+        return elapsed
+
+    print('%d datagrams of %d bytes' % (packets, size))
+    print('%-10s %10s %10s %12s' % ('', 'receive', 'send', 'receive pps'))
+    for name, batch in (('single', None), ('batch', MessageBatch(burst, 2 ** 16))):
+        received = receive(batch)
+        sent = send(batch)
+        print('%-10s %9.3fs %9.3fs %12d' % (name, received, sent, packets / received))
+    Dgram._batch = None
+
+
+def bench_frames(frames=20000, streams=100):
+    """bytes on the wire per payload byte with v1 and v2 tunnel frames, for
+    a few payload size distributions; counts the framing and the padding,
+    not the http disguise which costs the same either way"""
+    import uuid
+    import obscure
+    from tunnel import Tunnel
+
+    distributions = [
+        ('interactive', lambda: random.randint(1, 64)),
+        ('dns', lambda: random.randint(30, 512)),
+        ('web', lambda: random.choice([100, 1400, 1400, 1400, 1400, 1400, 1400, 1400, 16384, 16384])),
+        ('bulk', lambda: 2 ** 16),
+    ]
+
+    class Wire(object):
+        def __init__(self):
+            self.bytes = 0
+
+        def send(self, data):
+            self.bytes += len(obscure.random_padding(obscure.pack_data(data)))
+
+    def run(version, size_of):
+        random.seed(1)
+        wire = Wire()
+        tunnel = Tunnel(connection=wire)
+        tunnel._send_version = version
+        tunnel.set_coalescing(0)
+        tunnel.set_fair_queueing(False)
+        ids = [uuid.uuid4() for _ in range(streams)]
+        payload_bytes = 0
+        for id_ in ids:
+            tunnel.send_tcp_initial_data(id_, '{"addr": "10.0.0.1", "port": 443}')
+        for i in range(frames):
+            size = size_of()
+            payload_bytes += size
+            tunnel.send_payload(ids[i % streams], 'x' * size)
+        for id_ in ids:
+            tunnel.send_tcp_closed_data(id_)
+        return wire.bytes, payload_bytes
+
+    def heartbeat(version):
+        wire = Wire()
+        tunnel = Tunnel(connection=wire)
+        tunnel._send_version = version
+        tunnel.set_coalescing(0)
+        random.seed(1)
+        for _ in range(1000):
+            tunnel.warm_up()
+        return wire.bytes / 1000.0
+
+    print('%d frames over %d streams' % (frames, streams))
+    print('%-12s %12s %12s %10s %10s %8s' % ('', 'payload', 'v1 wire', 'v2 wire', 'v1 ovh', 'v2 ovh'))
+    for name, size_of in distributions:
+        v1, payload = run(1, size_of)
+        v2, _ = run(2, size_of)
+        print('%-12s %12d %12d %10d %9.1f%% %7.1f%%' % (name, payload, v1, v2,
+                                                        100.0 * (v1 - payload) / payload,
+                                                        100.0 * (v2 - payload) / payload))
+    print('%-12s %12s %12.1f %10.1f' % ('heartbeat', '', heartbeat(1), heartbeat(2)))
+
+
+def bench_coalesce(packets=100000, size=64, burst=32, base_port=19460):
+    """small packets per second through a pair of tunnels, sent the way
+    tuntun does for every packet read from the tun device, with every frame
+    encoded on its own vs coalesced"""
+    import uuid
+
+    def run(coalesce_bytes, port, report):
+        import epoll
+        from event import Event
+        from acceptor import Acceptor
+        from tunnel import Tunnel, FRAME_VERSION
+
+        epoll.Epoll.init()
+        received = [0]
+
+        def on_accepted(stream, _):
+            tunnel = Tunnel(connection=stream)
+            tunnel.set_on_payload(lambda _, __, data: received.__setitem__(0, received[0] + 1))
+            tunnel.initialize()
+
+        server = Acceptor('TUNNEL')
+        server.bind('127.0.0.1', port)
+        server.listen()
+        server.set_on_accepted(on_accepted)
+
+        client = Tunnel(connect_to=('127.0.0.1', port))
+        client.set_coalescing(coalesce_bytes)
+        client.initialize()
+        while client.get_frame_version() != (FRAME_VERSION, FRAME_VERSION):
+            Event.process_events_and_timers()
+
+        ids = [uuid.uuid4() for _ in range(16)]
+        packet = 'p' * size
+        sent = 0
+        start = time.time()
+        cpu = time.clock()
+        while received[0] < packets:
+            # a burst per iteration, what one read of the tun device gives
+            if sent < packets and client.is_ready_to_send():
+                for i in range(min(burst, packets - sent)):
+                    client.send_payload(ids[i % len(ids)], packet)
+                sent += burst
+            Event.process_events_and_timers()
+        elapsed = time.time() - start
+        report(elapsed, time.clock() - cpu)
+
+    def report(name):
+        def print_report(elapsed, cpu):
+            print('%-10s %9.3fs %9.3fs %10d' % (name, elapsed, cpu, packets / elapsed))
+        return print_report
+
+    print('%d packets of %d bytes, bursts of %d' % (packets, size, burst))
+    print('%-10s %10s %10s %10s' % ('', 'time', 'cpu', 'pps'))
+    _run_forked(run, 0, base_port, report('single'))
+    _run_forked(run, 16 * 1024, base_port + 1, report('coalesced'))
+
+
+def bench_fairness(rate=4 * 1024 * 1024, seconds=3, base_port=19470):
+    """latency of small interactive messages sharing a tunnel with a bulk
+    stream, over a link of `rate` bytes/s, with one queue for the tunnel vs
+    per stream queues drained by deficit round robin"""
+    import os
+    import signal
+    import socket
+    import threading
+    import uuid
+
+    def throttle(port):
+        # the slow link, a proxy in a child of its own
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32 * 1024)
+        listener.bind(('127.0.0.1', port))
+        listener.listen(1)
+        front, _ = listener.accept()
+        back = socket.create_connection(('127.0.0.1', port + 1))
+
+        def backward():
+            while True:
+                data = back.recv(2 ** 16)
+                if len(data) == 0:
+                    break
+                front.sendall(data)
+
+        thread = threading.Thread(target=backward)
+        thread.daemon = True
+        thread.start()
+        while True:
+            data = front.recv(16 * 1024)
+            if len(data) == 0:
+                break
+            back.sendall(data)
+            time.sleep(float(len(data)) / rate)
+
+    def run(fair, port):
+        import epoll
+        from event import Event
+        from acceptor import Acceptor
+        import tunnel as tunnel_module
+        from tunnel import Tunnel
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                throttle(port)
+            finally:
+                os._exit(0)
+
+        epoll.Epoll.init()
+        tunnel_module.FAIR_QUEUEING = fair
+        bulk_id = uuid.uuid4()
+        interactive_id = uuid.uuid4()
+        latencies = []
+
+        def on_payload(_, id_, data):
+            if id_ == interactive_id:
+                latencies.append(time.time() - float(data))
+
+        def on_accepted(stream, _):
+            server_tunnel = Tunnel(connection=stream)
+            server_tunnel.set_on_payload(on_payload)
+            server_tunnel.initialize()
+
+        server = Acceptor('TUNNEL')
+        server.bind('127.0.0.1', port + 1)
+        server.listen()
+        server.set_on_accepted(on_accepted)
+        time.sleep(0.2)
+
+        client = Tunnel(connect_to=('127.0.0.1', port))
+        client.initialize()
+        client._stream.set_buffer_size(32 * 1024)
+        chunk = 'b' * (16 * 1024)
+        end = time.time() + seconds
+        next_message = time.time()
+        while time.time() < end:
+            # the bulk endpoint reads whenever the tunnel takes more
+            while client.is_ready_to_send(bulk_id):
+                client.send_payload(bulk_id, chunk)
+            if time.time() >= next_message:
+                client.send_payload(interactive_id, '%.6f' % time.time())
+                next_message += 0.02
+            Event.process_events_and_timers()
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        latencies.sort()
+        if len(latencies) == 0:
+            print('%-10s %10s' % ('fair' if fair else 'single', 'nothing arrived'))
+            return
+        print('%-10s %8.1fms %8.1fms %10d' % ('fair' if fair else 'single',
+                                             latencies[len(latencies) / 2] * 1000,
+                                             latencies[len(latencies) * 99 / 100] * 1000,
+                                             len(latencies)))
+
+    print('bulk and a message every 20ms over %d KiB/s for %ds' % (rate / 1024, seconds))
+    print('%-10s %10s %10s %10s' % ('', 'p50', 'p99', 'messages'))
+    _run_forked(run, False, base_port)
+    _run_forked(run, True, base_port + 10)
+
+
+def _throttled_link(port, rate, loss=0.0, stall=0.0):
+    """forwards the connections to `port` to port + 1, forever; what goes
+    upstream gets `rate` bytes/s per connection and stalls for `stall` s on
+    a `loss` share of its 16K chunks"""
+    import socket
+    import threading
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32 * 1024)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(16)
+
+    def pipe(src, dst, throttled):
+        while True:
+            data = src.recv(16 * 1024)
+            if len(data) == 0:
+                break
+            dst.sendall(data)
+            if throttled:
+                time.sleep(float(len(data)) / rate + (stall if random.random() < loss else 0))
+
+    while True:
+        front, _ = listener.accept()
+        back = socket.create_connection(('127.0.0.1', port + 1))
+        for src, dst, throttled in ((front, back, True), (back, front, False)):
+            thread = threading.Thread(target=pipe, args=(src, dst, throttled))
+            thread.daemon = True
+            thread.start()
+
+
+def bench_stripe(size=8 * 1024 * 1024, rate=1024 * 1024, loss=0.02, stall=0.2, base_port=19480):
+    """time to upload `size` bytes over pooled tunnels whose connections
+    each get `rate` bytes/s and stall for `stall` s on a `loss` share of
+    their 16K chunks, like a lossy long haul link; one tunnel per
+    connection vs striped over up to 4"""
+    import os
+    import signal
+    import socket
+    import threading
+
+    def run(stripes, port):
+        import epoll
+        from event import Event
+        from acceptor import Acceptor
+        from tunnel import Tunnel
+        import tcptun
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _throttled_link(port, rate, loss, stall)
+            finally:
+                os._exit(0)
+
+        epoll.Epoll.init()
+        received = [0]
+        initialize = Tunnel.initialize
+
+        def initialize_with_small_buffers(self):
+            initialize(self)
+            # a lossy long haul connection has about its window in flight,
+            # not the megabytes loopback would take
+            self._stream.set_buffer_size(32 * 1024)
+
+        Tunnel.initialize = initialize_with_small_buffers
+
+        def sink_accepted(stream, _):
+            stream.set_on_received(lambda _, data, __: received.__setitem__(0, received[0] + len(data)) or True)
+            stream.start_receiving()
+
+        sink = Acceptor('SINK')
+        sink.bind('127.0.0.1', port + 2)
+        sink.listen()
+        sink.set_on_accepted(sink_accepted)
+
+        Tunnel.set_tcp_fin_received_handler(tcptun.on_stream_fin_received)
+        Tunnel.set_tcp_closed_handler(tcptun.on_stream_closed)
+        Tunnel.set_tcp_initial_handler(tcptun.on_server_side_initialized)
+        Tunnel.set_stripe_join_handler(tcptun.on_stream_joined)
+        Tunnel.set_stripe_leave_handler(tcptun.on_stream_left)
+        server = Acceptor('TUNNEL')
+        server.bind('127.0.0.1', port + 1)
+        server.listen()
+        server.set_on_accepted(lambda stream, _: Tunnel(connection=stream).initialize())
+
+        client = Acceptor('TCP')
+        client.bind('127.0.0.1', port + 3)
+        client.listen()
+        client.set_on_accepted(tcptun.gen_on_client_side_accepted(
+            ['127.0.0.1', port], ['127.0.0.1', port + 2], 4, stripes))
+        # the pool connects and negotiates first
+        end = time.time() + 1
+        while time.time() < end:
+            Event.process_events_and_timers()
+
+        def upload():
+            sock = socket.create_connection(('127.0.0.1', port + 3))
+            sock.sendall(os.urandom(size))
+            sock.shutdown(socket.SHUT_WR)
+            sock.recv(1)
+
+        thread = threading.Thread(target=upload)
+        thread.daemon = True
+        start = time.time()
+        thread.start()
+        while received[0] < size and time.time() - start < 120:
+            Event.process_events_and_timers()
+        elapsed = time.time() - start
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        print('%-10s %9.3fs %9.0f KiB/s' % ('striped' if stripes > 1 else 'single', elapsed,
+                                           received[0] / elapsed / 1024))
+
+    print('%d KiB over tunnels of %d KiB/s, %.0f%% of the chunks stalled %.1fs' % (
+        size / 1024, rate / 1024, loss * 100, stall))
+    print('%-10s %10s %15s' % ('', 'time', 'throughput'))
+    _run_forked(run, 1, base_port)
+    _run_forked(run, 4, base_port + 10)
+
+
+def bench_compress(frames=5000, streams=20):
+    """bytes on the wire and cpu seconds, both sides, with v3 frames and v4
+    compressed chunks for a few kinds of payload, every frame its own chunk;
+    tls stands for anything encrypted or compressed already"""
+    import os
+    import json
+    import uuid
+    import obscure
+    import compression
+    from tunnel import Tunnel
+
+    def html():
+        rows = ''.join('<tr><td class="name">item %d</td><td>%d.%02d</td></tr>\n' % (
+            random.randint(0, 10000), random.randint(0, 500), random.randint(0, 99)) for _ in range(30))
+        return 'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: %d\r\n\r\n' % len(rows) + \
+            '<table>\n' + rows + '</table>'
+
+    def api():
+        return json.dumps([{'id': random.randint(0, 2 ** 31), 'user': 'user%d' % random.randint(0, 1000),
+                            'active': random.random() < 0.5, 'score': random.random()} for _ in range(8)])
+
+    def dns():
+        name = '.'.join(random.choice(['www', 'api', 'cdn', 'mail', 'static']) for _ in range(2))
+        return os.urandom(2) + '\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00' + \
+            ''.join(chr(len(label)) + label for label in (name + '.example.com').split('.')) + '\x00\x00\x01\x00\x01'
+
+    def tls():
+        return '\x17\x03\x03\x05\x78' + os.urandom(1400)
+
+    class Wire(object):
+        def __init__(self):
+            self.bytes = 0
+            self.chunks = []
+
+        def send(self, data):
+            self.bytes += len(obscure.random_padding(obscure.pack_data(data)))
+            self.chunks.append(data)
+
+        def is_closed(self):
+            return False
+
+    def run(codec, generate):
+        random.seed(1)
+        payloads = [generate() for _ in range(frames)]
+        ids = [uuid.uuid4() for _ in range(streams)]
+        wire = Wire()
+        sender = Tunnel(connection=wire)
+        sender.set_coalescing(0)
+        sender.set_fair_queueing(False)
+        receiver = Tunnel(connection=wire)
+        received = [0]
+        receiver.set_on_payload(lambda _, __, data: received.__setitem__(0, received[0] + len(data)))
+        if codec is not None:
+            sender._send_version = 4
+            receiver._receive_version = 4
+            if codec != compression.RAW:
+                sender._compress = compression.gen_compress(codec)
+        else:
+            sender._send_version = 3
+            receiver._receive_version = 3
+
+        start = time.time()
+        for i, payload in enumerate(payloads):
+            sender.send_payload(ids[i % streams], payload)
+        for chunk in wire.chunks:
+            receiver._on_received(chunk, None)
+        elapsed = time.time() - start
+        assert received[0] == sum(len(payload) for payload in payloads)
+        return wire.bytes, received[0], elapsed
+
+    codecs = [('v3', None), ('v4 raw', compression.RAW), ('zlib', compression.ZLIB)]
+    if compression.lz4frame is not None:
+        codecs.append(('lz4', compression.LZ4))
+    print('%d frames over %d streams' % (frames, streams))
+    print('%-6s %-8s %12s %12s %8s %8s' % ('', '', 'payload', 'wire', 'ratio', 'cpu'))
+    for name, generate in [('html', html), ('json', api), ('dns', dns), ('tls', tls)]:
+        for label, codec in codecs:
+            wire_bytes, payload, elapsed = run(codec, generate)
+            print('%-6s %-8s %12d %12d %7.2fx %7.3fs' % (name, label, payload, wire_bytes,
+                                                          float(payload) / wire_bytes, elapsed))
+
+
+def bench_ping(base_port=19490):
+    """what the pings of a busy tunnel tell through a link whose latency is
+    changed, then stalled: the smoothed rtt and jitter at the end of every
+    phase, and how long a stall takes to mark the tunnel degraded"""
+    import socket
+    import threading
+    import uuid
+    from collections import deque
+
+    def run(port):
+        import epoll
+        import linkstats
+        import tunnel as tunnel_module
+        from event import Event
+        from acceptor import Acceptor
+        from tunnel import Tunnel
+
+        # shorter than the defaults, for the phases to be short
+        tunnel_module.PING_INTERVAL = 200
+        linkstats.PING_TIMEOUT = 1.0
+        delay = [0.0]
+        stalled = [False]
+
+        def delayed_link():
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(('127.0.0.1', port))
+            listener.listen(1)
+            front, _ = listener.accept()
+            back = socket.create_connection(('127.0.0.1', port + 1))
+
+            def read(src, in_flight):
+                while True:
+                    data = src.recv(64 * 1024)
+                    if len(data) == 0:
+                        break
+                    in_flight.append((time.time() + delay[0] / 2, data))
+
+            def write(dst, in_flight):
+                while True:
+                    if stalled[0] or len(in_flight) == 0 or in_flight[0][0] > time.time():
+                        time.sleep(0.0005)
+                        continue
+                    dst.sendall(in_flight.popleft()[1])
+
+            for src, dst in ((front, back), (back, front)):
+                in_flight = deque()
+                for target, sock in ((read, src), (write, dst)):
+                    thread = threading.Thread(target=target, args=(sock, in_flight))
+                    thread.daemon = True
+                    thread.start()
+
+        link = threading.Thread(target=delayed_link)
+        link.daemon = True
+        link.start()
+
+        epoll.Epoll.init()
+        server = Acceptor('TUNNEL')
+        server.bind('127.0.0.1', port + 1)
+        server.listen()
+
+        def on_accepted(stream, _):
+            tunnel = Tunnel(connection=stream)
+            tunnel.set_on_payload(lambda _, __, ___: None)
+            tunnel.initialize()
+
+        server.set_on_accepted(on_accepted)
+        time.sleep(0.1)
+        client = Tunnel(connect_to=('127.0.0.1', port))
+        client.initialize()
+        id_ = uuid.uuid4()
+        # the samples of a phase, the smoothed rtt still carries the one before
+        samples = []
+        link = client._link
+        pong_received = link.pong_received
+
+        def recording_pong_received(seq, sent, now):
+            rtt = pong_received(seq, sent, now)
+            if rtt is not None:
+                samples.append(rtt)
+            return rtt
+
+        link.pong_received = recording_pong_received
+
+        def loop_for(seconds, until=None):
+            end = time.time() + seconds
+            next_send = 0
+            while time.time() < end:
+                if time.time() >= next_send:
+                    # keeps the tunnel busy, so it is pinged every interval
+                    client.send_payload(id_, 'p' * 100)
+                    next_send = time.time() + 0.05
+                Event.process_events_and_timers()
+                if until is not None and until():
+                    return True
+            return False
+
+        print('%-14s %10s %10s %10s %8s %9s' % ('one way delay', 'rtt', 'p50 sample', 'jitter', 'loss',
+                                                 'timeouts'))
+        for one_way in (0.005, 0.025, 0.1, 0.01):
+            delay[0] = one_way * 2
+            del samples[:]
+            loop_for(3)
+            stats = client.get_stats()
+            samples.sort()
+            print('%11.0f ms %7.1f ms %7.1f ms %7.1f ms %7.1f%% %9d' % (
+                one_way * 1000, stats['rtt'] * 1000, samples[len(samples) / 2] * 1000 if samples else 0,
+                stats['jitter'] * 1000, stats['loss'] * 100, stats['timeouts']))
+        stalled[0] = True
+        start = time.time()
+        detected = loop_for(10, client.is_degraded)
+        print('stalled link degraded after %s (ping every %d ms, timeout %.1f s, %d in a row)' % (
+            '%.2f s' % (time.time() - start) if detected else 'never', tunnel_module.PING_INTERVAL,
+            linkstats.PING_TIMEOUT, linkstats.DEGRADED_TIMEOUTS))
+        stalled[0] = False
+
+    _run_forked(run, base_port)
+
+
+def bench_placement(tunnels=8, steps=20000, arrival=4, drain=16 * 1024):
+    """simulated tunnels draining `drain` bytes per step, new flows of
+    heavy tailed sizes arriving at `arrival` per step: the bytes waiting in
+    the tunnel a flow is put on, with uuid modulo the tunnels as before vs
+    the placement module; then where the flows of a closed tunnel go"""
+    import uuid
+    from placement import Placement
+
+    class FakeTunnel(object):
+        def __init__(self):
+            self.outstanding = 0
+            self.closed = False
+
+        def is_closed(self):
+            return self.closed
+
+        def is_established(self):
+            return not self.closed
+
+        def is_degraded(self):
+            return False
+
+        def get_outstanding(self):
+            return self.outstanding
+
+    class FakePool(object):
+        def __init__(self, size):
+            self.tunnels = [FakeTunnel() for _ in range(size)]
+
+        def start(self):
+            pass
+
+        def get_tunnels(self):
+            return list(self.tunnels)
+
+        def get(self):
+            return self.tunnels[0]
+
+    def flow_size():
+        # pareto, most flows small, a few of many megabytes
+        return int(min(2000 * random.paretovariate(1.1), 64 * 1024 * 1024))
+
+    def run(choose):
+        random.seed(1)
+        pool = FakePool(tunnels)
+        placement = Placement(pool)
+        waits = []
+        for _ in range(steps):
+            for _ in range(arrival):
+                id_ = uuid.uuid4()
+                tunnel = choose(pool, placement, id_)
+                waits.append(tunnel.outstanding)
+                tunnel.outstanding += flow_size()
+            for tunnel in pool.tunnels:
+                tunnel.outstanding = max(tunnel.outstanding - drain, 0)
+        waits.sort()
+        return waits
+
+    print('%d tunnels draining %d KiB per step, %d flows per step, %d steps' % (
+        tunnels, drain / 1024, arrival, steps))
+    print('%-12s %12s %12s %12s' % ('bytes ahead', 'mean', 'p99', 'max'))
+    for name, choose in [('uuid % n', lambda pool, _, id_: pool.tunnels[id_.int % tunnels]),
+                         ('placement', lambda _, placement, id_: placement.get(id_))]:
+        waits = run(choose)
+        print('%-12s %12d %12d %12d' % (name, sum(waits) / len(waits), waits[len(waits) * 99 // 100], waits[-1]))
+
+    random.seed(1)
+    pool = FakePool(tunnels)
+    placement = Placement(pool)
+    ids = [uuid.uuid4() for _ in range(10000)]
+    for id_ in ids:
+        placement.get(id_)
+    victim = pool.tunnels[0]
+    orphans = [id_ for id_ in ids if placement.lookup(id_) is victim]
+    victim.closed = True
+    pool.tunnels[0] = FakeTunnel()
+    moved = 0
+    flows = dict((id(t), 0) for t in pool.tunnels)
+    for id_ in ids:
+        before = placement.lookup(id_)
+        after = placement.get(id_)
+        moved += before is not after
+        flows[id(after)] += 1
+    print('a closed tunnel had %d of %d flows, %d moved; flows per tunnel after: %d to %d, '
+          'uuid %% n moves them all to the replacement' % (len(orphans), len(ids), moved,
+                                                          min(flows.values()), max(flows.values())))
+
+
+def bench_autoscale(rate=512 * 1024, uploaders=8, transfer=256 * 1024, load=8, idle=10, base_port=19500):
+    """`uploaders` each sending `transfer` bytes a connection, one after the
+    other for `load` s, then `idle` s without any, over tunnels whose
+    connections each get `rate` bytes/s: throughput and tunnels every
+    second with a fixed pool of one tunnel vs one the autoscaler sizes
+    between 1 and `uploaders`, looking every 250 ms"""
+    import os
+    import signal
+    import socket
+    import threading
+
+    def run(pool_size, port):
+        import epoll
+        from event import Event
+        from acceptor import Acceptor
+        from tunnel import Tunnel
+        from autoscaler import Autoscaler
+        import autoscaler
+        import tcptun
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _throttled_link(port, rate)
+            finally:
+                os._exit(0)
+
+        autoscaler.MIN_TUNNELS, autoscaler.MAX_TUNNELS = 1, uploaders
+        autoscaler.AUTOSCALE_INTERVAL = 250
+        autoscaler.COOLDOWN_LOOKS = 2
+        autoscaler.SHRINK_LOOKS = 4
+        epoll.Epoll.init()
+        received = [0]
+        initialize = Tunnel.initialize
+
+        def initialize_with_small_buffers(self):
+            initialize(self)
+            # about a long haul window in flight, as bench_stripe
+            self._stream.set_buffer_size(32 * 1024)
+
+        Tunnel.initialize = initialize_with_small_buffers
+
+        def sink_accepted(stream, _):
+            left = [transfer]
+
+            def on_received(self_, data, _):
+                received[0] += len(data)
+                left[0] -= len(data)
+                if left[0] == 0:
+                    # the uploader waits for it, one transfer in flight each
+                    self_.send('k')
+                return True
+
+            stream.set_on_received(on_received)
+            # the connection ends, and its tunnel may drain
+            stream.set_on_fin_received(lambda self_: self_.shutdown())
+            stream.start_receiving()
+
+        sink = Acceptor('SINK')
+        sink.bind('127.0.0.1', port + 2)
+        sink.listen()
+        sink.set_on_accepted(sink_accepted)
+
+        Tunnel.set_tcp_fin_received_handler(tcptun.on_stream_fin_received)
+        Tunnel.set_tcp_closed_handler(tcptun.on_stream_closed)
+        Tunnel.set_tcp_initial_handler(tcptun.on_server_side_initialized)
+        server = Acceptor('TUNNEL')
+        server.bind('127.0.0.1', port + 1)
+        server.listen()
+        server.set_on_accepted(lambda stream, _: Tunnel(connection=stream).initialize())
+
+        client = Acceptor('TCP')
+        client.bind('127.0.0.1', port + 3)
+        client.listen()
+        client.set_on_accepted(tcptun.gen_on_client_side_accepted(
+            ['127.0.0.1', port], ['127.0.0.1', port + 2], pool_size))
+
+        # incompressible, the tunnels would shrink anything else
+        payload = os.urandom(1024 * 1024)
+        stop = [False]
+
+        def upload():
+            # a connection stays on its tunnel, new ones take the new tunnels
+            while not stop[0]:
+                sock = socket.create_connection(('127.0.0.1', port + 3))
+                offset = random.randrange(len(payload) - transfer)
+                sock.sendall(payload[offset:offset + transfer])
+                sock.recv(1)
+                sock.close()
+
+        for _ in range(uploaders):
+            thread = threading.Thread(target=upload)
+            thread.daemon = True
+            thread.start()
+
+        print('%s' % ('fixed pool of %d' % pool_size if pool_size > 0 else 'autoscaled'))
+        print('%6s %12s %8s %9s' % ('second', 'throughput', 'tunnels', 'draining'))
+        start = time.time()
+        for second in range(1, load + idle + 1):
+            if second == load + 1:
+                stop[0] = True
+            before = received[0]
+            while time.time() < start + second:
+                Event.process_events_and_timers()
+            autoscalers = Autoscaler.get_live_autoscalers()
+            tunnels = [t for t in Tunnel.get_live_tunnels() if t._connect_to is not None]
+            draining = autoscalers[0].get_stats()['draining'] if len(autoscalers) > 0 else 0
+            print('%6d %7.0f KiB/s %8d %9d' % (second, (received[0] - before) / 1024.0, len(tunnels), draining))
+        # decisions are timed by the event loop's clock
+        origin = start - time.time() + Event.now()
+        for autoscaler_ in Autoscaler.get_live_autoscalers():
+            for decision in autoscaler_.get_decisions():
+                print('%6.2fs %-6s %d -> %d, per tunnel %d bytes outstanding, %.0f KiB/s' % (
+                    decision['time'] - origin, decision['action'], decision['from'], decision['to'],
+                    decision['queue'], decision['rate'] / 1024.0))
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    print('%d uploaders of %d KiB for %ds, then idle for %ds, tunnels of %d KiB/s' % (
+        uploaders, transfer / 1024, load, idle, rate / 1024))
+    _run_forked(run, 1, base_port)
+    _run_forked(run, 0, base_port + 10)
+
+
+_benchmarks = {
+    'timer': bench_timer,
+    'epoll': bench_epoll,
+    'soon': bench_soon,
+    'backend': bench_backend,
+    'recvbuf': bench_receive_buffer,
+    'sendv': bench_sendv,
+    'decode': bench_decode,
+    'backpressure': bench_backpressure,
+    'relay': bench_relay,
+    'fastopen': bench_fastopen,
+    'mmsg': bench_mmsg,
+    'frames': bench_frames,
+    'coalesce': bench_coalesce,
+    'fairness': bench_fairness,
+    'stripe': bench_stripe,
+    'compress': bench_compress,
+    'ping': bench_ping,
+    'placement': bench_placement,
+    'autoscale': bench_autoscale,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(_benchmarks.keys())
+    for name in names:
+        if name not in _benchmarks:
+            print('unknown benchmark: %s, choose from: %s' % (name, ', '.join(sorted(_benchmarks.keys()))))
+            sys.exit(1)
+        print('== %s' % name)
+        _benchmarks[name]()
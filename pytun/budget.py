@@ -0,0 +1,182 @@
+from collections import deque
+from itertools import count
+
+import loglevel
+_logger = loglevel.get_logger('budget')
+_logger.setLevel(loglevel.DEFAULT_LEVEL)
+
+
+SOFT_LIMIT = 256 * 1024 * 1024
+HARD_LIMIT = 512 * 1024 * 1024
+# held producers are released once the total is back below soft * RESUME_RATIO
+RESUME_RATIO = 0.5
+
+# ids are reused once an object is gone, what is still charged to a closed
+# stream would be refunded to a new one, these are not
+_tokens = count(1)
+
+
+def _token(obj):
+    token = getattr(obj, '_budget_token', None)
+    if token is None:
+        token = obj._budget_token = next(_tokens)
+    return token
+
+
+class BufferBudget(object):
+    """Process wide accounting of the bytes queued for sending.
+
+    Installed with NonBlocking.set_budget(), every NonBlocking then reports
+    what it queues and sends. Bytes queued while some NonBlocking is running
+    its receive handlers are charged to it as their producer, until they are
+    sent. Above the soft limit the biggest producers are held, i.e. stop
+    receiving, above the hard limit every producer is. They are released
+    once the total falls back below soft * RESUME_RATIO.
+    """
+
+    def __init__(self, soft_limit=SOFT_LIMIT, hard_limit=HARD_LIMIT):
+        assert(soft_limit <= hard_limit)
+        self._soft_limit = soft_limit
+        self._hard_limit = hard_limit
+        self._resume_limit = int(soft_limit * RESUME_RATIO)
+
+        self._total = 0
+        self._peak = 0
+        # token of the queue owner -> deque of [producer's token, bytes],
+        # oldest first
+        self._runs = {}
+        # token of the producer -> [producer, charged bytes]
+        self._producers = {}
+        self._held = {}
+        self._producer = None
+        # producers charged at least this much get held while above soft
+        self._cutoff = 0
+        self._hard_hit = False
+        self._holds = 0
+        self._releases = 0
+
+    def set_producer(self, producer):
+        self._producer = producer
+
+    def queued(self, owner, size):
+        producer = self._producer
+        key = None
+        entry = None
+        if producer is not None:
+            key = _token(producer)
+            entry = self._producers.get(key)
+            if entry is None:
+                entry = self._producers[key] = [producer, 0]
+            entry[1] += size
+
+        owner_key = _token(owner)
+        runs = self._runs.get(owner_key)
+        if runs is None:
+            runs = self._runs[owner_key] = deque()
+        if len(runs) > 0 and runs[-1][0] == key:
+            runs[-1][1] += size
+        else:
+            runs.append([key, size])
+
+        self._total += size
+        if self._total > self._peak:
+            self._peak = self._total
+        if self._total > self._soft_limit:
+            self._limit(entry)
+
+    def sent(self, owner, size):
+        self._total -= size
+        owner_key = _token(owner)
+        runs = self._runs.get(owner_key)
+        while runs and size > 0:
+            run = runs[0]
+            taken = min(size, run[1])
+            run[1] -= taken
+            size -= taken
+            self._refund(run[0], taken)
+            if run[1] == 0:
+                runs.popleft()
+        if runs is not None and len(runs) == 0:
+            del self._runs[owner_key]
+        self._check_release()
+
+    def release(self, owner):
+        """owner dropped its queue or is closed"""
+        owner_key = _token(owner)
+        runs = self._runs.pop(owner_key, ())
+        for key, size in runs:
+            self._total -= size
+            self._refund(key, size)
+        self._producers.pop(owner_key, None)
+        self._held.pop(owner_key, None)
+        self._check_release()
+
+    def _refund(self, key, size):
+        entry = self._producers.get(key)
+        if entry is None:
+            return
+        entry[1] -= size
+        if entry[1] <= 0:
+            del self._producers[key]
+
+    def _hold(self, producer):
+        key = _token(producer)
+        if key in self._held:
+            return
+        self._held[key] = producer
+        self._holds += 1
+        producer.hold_receiving()
+
+    def _limit(self, entry):
+        if self._total > self._hard_limit:
+            if not self._hard_hit:
+                self._hard_hit = True
+                _logger.warning('%d bytes queued, above hard limit, holding %d producers',
+                                self._total, len(self._producers))
+                for producer, _ in self._producers.values():
+                    self._hold(producer)
+            elif entry is not None:
+                self._hold(entry[0])
+            return
+
+        if len(self._held) == 0:
+            # hold the biggest ones, until what they have queued would bring
+            # the total back to where everyone is released
+            excess = self._total - self._resume_limit
+            biggest = sorted(self._producers.values(), key=lambda e: e[1], reverse=True)
+            for producer, charged in biggest:
+                if excess <= 0:
+                    break
+                self._hold(producer)
+                self._cutoff = charged
+                excess -= charged
+            _logger.warning('%d bytes queued, above soft limit, holding %d producers',
+                            self._total, len(self._held))
+        elif entry is not None and entry[1] >= self._cutoff:
+            self._hold(entry[0])
+
+    def _check_release(self):
+        if len(self._held) == 0 or self._total > self._resume_limit:
+            return
+        _logger.info('%d bytes queued, releasing %d producers', self._total, len(self._held))
+        held = self._held.values()
+        self._held = {}
+        self._hard_hit = False
+        self._releases += len(held)
+        for producer in held:
+            producer.release_receiving()
+
+    def get_total(self):
+        return self._total
+
+    def get(self):
+        return {
+            'queued': self._total,
+            'peak': self._peak,
+            'producers': len(self._producers),
+            'held': len(self._held),
+            'holds': self._holds,
+            'releases': self._releases,
+            'soft_limit': self._soft_limit,
+            'hard_limit': self._hard_limit
+        }
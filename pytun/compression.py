@@ -0,0 +1,165 @@
+import zlib
+import math
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+import loglevel
+_logger = loglevel.get_logger('compression')
+_logger.setLevel(loglevel.DEFAULT_LEVEL)
+
+
+# what the first byte of a chunk says about the rest
+RAW = 0
+ZLIB = 1
+LZ4 = 2
+# the codecs tried in this order, if both sides have them
+PREFERENCE = (LZ4, ZLIB)
+
+ZLIB_LEVEL = 6
+# bits per byte above which a sample is taken for compressed or encrypted;
+# a sample of random bytes measures 7.4 to 7.7, of text below 5
+ENTROPY_LIMIT = 7.2
+SAMPLE_SIZE = 512
+# shorter chunks are compressed anyway, the shared state makes them small
+MIN_SAMPLED = 512
+# after incompressible chunks in a row, up to this many are sent raw
+# unsampled, doubling with every one more; sampling costs about what
+# compressing does
+MAX_SKIPPED = 16
+
+# lz4 output is taken in pieces of this, its guess of the size falls short
+LZ4_OUTPUT = 64 * 1024
+
+# a sync flush ends with these, sent implicitly
+_SYNC_TAIL = '\x00\x00\xff\xff'
+# count * log2(count) for the counts a sample may have
+_COUNT_LOG = [0.0] + [count * math.log(count, 2) for count in range(1, SAMPLE_SIZE + 1)]
+# samples with no more distinct bytes stay below ENTROPY_LIMIT
+_MAX_DISTINCT = int(2 ** ENTROPY_LIMIT)
+
+
+def get_supported():
+    """bitmask of the codecs this side can decompress"""
+    mask = 1 << ZLIB
+    if lz4frame is not None:
+        mask |= 1 << LZ4
+    return mask
+
+
+def choose(peer_mask):
+    """the codec to compress with for a peer reading peer_mask, or None"""
+    for codec in PREFERENCE:
+        if peer_mask & get_supported() & (1 << codec):
+            return codec
+    return None
+
+
+def sample_entropy(data):
+    """Shannon entropy in bits per byte of up to SAMPLE_SIZE bytes spread
+    over data"""
+    if len(data) > SAMPLE_SIZE:
+        data = data[::len(data) // SAMPLE_SIZE][:SAMPLE_SIZE]
+    if len(data) == 0:
+        return 0.0
+    # log2(n) - sum(c * log2(c)) / n, counted by str.count in C
+    return math.log(len(data), 2) - sum(map(_COUNT_LOG.__getitem__, map(data.count, set(data)))) / float(len(data))
+
+
+def is_incompressible(data):
+    """whether a sample of data looks compressed or encrypted"""
+    if len(data) > SAMPLE_SIZE:
+        data = data[::len(data) // SAMPLE_SIZE][:SAMPLE_SIZE]
+    # n distinct bytes have at most log2(n) bits, text is told without
+    # counting them
+    if len(set(data)) <= _MAX_DISTINCT:
+        return False
+    return sample_entropy(data) > ENTROPY_LIMIT
+
+
+def gen_compress(codec):
+    """compress(data) gives the chunk to send, its first byte telling how
+    it goes on; the compressor state lasts over all the chunks"""
+    if codec == ZLIB:
+        compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        def deflate(data):
+            return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)[:-len(_SYNC_TAIL)]
+        encode = deflate
+    elif codec == LZ4:
+        compressor = lz4frame.LZ4FrameCompressor(block_linked=True, auto_flush=True)
+        started = [False]
+
+        def lz4_compress(data):
+            if not started[0]:
+                started[0] = True
+                return compressor.begin() + compressor.compress(data)
+            return compressor.compress(data)
+        encode = lz4_compress
+    else:
+        raise Exception('unknown codec %d' % codec)
+    flag = chr(codec)
+    # incompressible chunks in a row, and chunks still to send raw
+    missed = [0, 0]
+
+    def miss():
+        missed[0] += 1
+        missed[1] = min(2 ** (missed[0] - 1) - 1, MAX_SKIPPED)
+
+    def compress(data):
+        if len(data) < MIN_SAMPLED:
+            return flag + encode(data)
+        if missed[1] > 0:
+            missed[1] -= 1
+            return chr(RAW) + data
+        if is_incompressible(data):
+            miss()
+            return chr(RAW) + data
+        encoded = encode(data)
+        # the sample misled, this one goes out anyway, the peer's state
+        # needs it
+        if len(encoded) >= len(data):
+            miss()
+        else:
+            missed[0] = 0
+        return flag + encoded
+
+    return compress
+
+
+def gen_decompress():
+    """decompress(chunk) undoes whatever the peer's compress did"""
+    decompressors = {}
+
+    def inflate(data):
+        decompressor = decompressors.get(ZLIB)
+        if decompressor is None:
+            decompressor = decompressors[ZLIB] = zlib.decompressobj(-zlib.MAX_WBITS)
+        return decompressor.decompress(data + _SYNC_TAIL)
+
+    def lz4_decompress(data):
+        if lz4frame is None:
+            raise Exception('lz4 compressed data, lz4 is not installed')
+        decompressor = decompressors.get(LZ4)
+        if decompressor is None:
+            decompressor = decompressors[LZ4] = lz4frame.LZ4FrameDecompressor()
+        output = [decompressor.decompress(data, LZ4_OUTPUT)]
+        while not decompressor.needs_input:
+            output.append(decompressor.decompress('', LZ4_OUTPUT))
+        return ''.join(output)
+
+    codecs = {
+        ZLIB: inflate,
+        LZ4: lz4_decompress
+    }
+
+    def decompress(data):
+        flag = ord(data[0])
+        if flag == RAW:
+            return data[1:]
+        if flag not in codecs:
+            raise Exception('unknown codec %d' % flag)
+        return codecs[flag](data[1:])
+
+    return decompress
@@ -1,18 +1,86 @@
 import socket
+import errno
+import traceback
+from itertools import islice
+from event import Event
 from nonblocking import NonBlocking
+from syscall import MessageBatch
 
 import loglevel
 _logger = loglevel.get_logger('dgram')
 
 
+BATCH_SIZE = 64
+DATAGRAM_SIZE = 2 ** 16
+# recvmmsg calls per wakeup at most, so one busy socket does not starve the rest
+MAX_BATCHES = 16
+
+
 class Dgram(NonBlocking):
 
+    # shared by all of them once enabled, like the receive buffer
+    _batch = None
+
     def __init__(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         _logger.debug('fd: %d created', sock.fileno())
         NonBlocking.__init__(self, sock)
         self._connected = True
+        self._on_batch_received = None
+        self._idle_timeout = None
+        self._idle_ev = None
+        # sent or received since the idle timer was armed
+        self._active = False
+
+    @staticmethod
+    def enable_batch(count=BATCH_SIZE, size=DATAGRAM_SIZE):
+        """Receive and send up to `count` datagrams per syscall with
+        recvmmsg/sendmmsg, returns False where they are not available.
+        Datagrams without a destination address or with decoders appended
+        still go one by one."""
+        if not MessageBatch.is_supported():
+            _logger.warning('recvmmsg/sendmmsg are not supported')
+            return False
+        Dgram._batch = MessageBatch(count, size)
+        return True
+
+    def set_on_batch_received(self, handler):
+        """handler(dgram, [(data, addr), ...]) gets all the datagrams of a
+        wakeup at once in batch mode, instead of on_received one by one"""
+        self._on_batch_received = handler
+
+    def set_timeout(self, milliseconds):
+        """closes the socket once nothing was sent or received for between
+        milliseconds and twice that"""
+        self._idle_timeout = milliseconds
+        if self._idle_ev is None:
+            self._arm_idle_timer()
+
+    def _arm_idle_timer(self):
+        self._active = False
+        self._idle_ev = Event.add_timer(self._idle_timeout)
+        self._idle_ev.set_handler(lambda ev: self._on_idle_timer())
+
+    def _on_idle_timer(self):
+        self._idle_ev = None
+        if self.is_closed():
+            return
+        if self._active:
+            self._arm_idle_timer()
+            return
+        _logger.debug('%s, idle for %d ms', str(self), self._idle_timeout)
+        self.close()
+
+    def _on_close(self):
+        if self._idle_ev is not None:
+            self._idle_ev.del_timer()
+            self._idle_ev = None
+        NonBlocking._on_close(self)
+
+    def send(self, data, addr=None):
+        self._active = True
+        NonBlocking.send(self, data, addr)
 
     def set_non_blocking(self):
         self._fd.setblocking(False)
@@ -30,11 +98,107 @@ class Dgram(NonBlocking):
                       self._fd.fileno(), sent, addr[0], addr[1])
         return sent
 
+    def _flush(self):
+        batch = Dgram._batch
+        if batch is None:
+            return NonBlocking._flush(self)
+
+        sent_bytes = 0
+        while len(self._to_send) > 0:
+            if self._to_send[0][0] is None:
+                self._pop_poison()
+                return False
+            packets = []
+            for data, addr in islice(self._to_send, batch.get_count()):
+                if data is None or addr is None:
+                    break
+                packets.append((data, addr))
+            if len(packets) == 0:
+                return NonBlocking._flush(self)
+            try:
+                count = batch.send(self._fd.fileno(), packets)
+            except socket.error as msg:
+                if msg.errno != errno.EAGAIN:
+                    _logger.warning('%s, sendmmsg(%d): %s',
+                                    str(self), msg.errno, msg.strerror)
+                    self._error = True
+                    self._do_close()
+                    return False
+                Event.eventDrained(self._wev)
+                break
+            sent = 0
+            for _ in range(count):
+                sent += len(self._to_send.popleft()[0])
+            sent_bytes += sent
+            self._to_send_bytes -= sent
+            if NonBlocking._budget is not None:
+                NonBlocking._budget.sent(self, sent)
+
+        _logger.debug("%s, sent %d bytes", str(self), sent_bytes)
+        return True
+
+    def _on_receive(self):
+        self._active = True
+        batch = Dgram._batch
+        if batch is None or len(self._decoders) > 0:
+            NonBlocking._on_receive(self)
+            return
+
+        packets = []
+        for _ in range(MAX_BATCHES):
+            try:
+                received = batch.recv(self._fd.fileno())
+            except socket.error as msg:
+                if msg.errno != errno.EAGAIN:
+                    _logger.warning('%s, recvmmsg(%d): %s',
+                                    str(self), msg.errno, msg.strerror)
+                    self._error = True
+                    self._do_close()
+                    return
+                Event.eventDrained(self._rev)
+                break
+            packets.extend(received)
+            if batch.get_received() < batch.get_count():
+                break
+        if len(packets) == 0:
+            return
+        _logger.debug('%s, received %d datagrams', str(self), len(packets))
+
+        budget = NonBlocking._budget
+        if budget is not None:
+            budget.set_producer(self)
+        try:
+            if self._on_batch_received is not None:
+                ret = self._on_batch_received(self, packets)
+            else:
+                ret = True
+                for data, addr in packets:
+                    if not self._on_received(self, data, addr):
+                        ret = False
+        except Exception as ex:
+            _logger.error('_on_received error: %s', str(ex))
+            _logger.error('%s', traceback.format_exc())
+            self._error = True
+            self._do_close()
+            return
+        finally:
+            if budget is not None:
+                budget.set_producer(None)
+
+        if not ret:
+            self.stop_receiving()
+
     def _recv(self, size):
         recv, addr = self._fd.recvfrom(size)
         _logger.debug('fd: %d recv %d bytes from %s:%d',
                       self._fd.fileno(), len(recv), addr[0], addr[1])
         return recv, addr
 
+    def _recv_into(self, buff):
+        size, addr = self._fd.recvfrom_into(buff)
+        _logger.debug('fd: %d recv %d bytes from %s:%d',
+                      self._fd.fileno(), size, addr[0], addr[1])
+        return size, addr
+
     def _close(self):
         self._fd.close()
@@ -1,8 +1,9 @@
 import select
-import time
 import os
+import errno
 import traceback
 from event import Event
+from event import monotonic
 
 import loglevel
 _logger = loglevel.get_logger('epoll')
@@ -14,13 +15,17 @@ class Epoll:
     _epoll = None
 
     @staticmethod
-    def init():
-        Epoll._epoll = Epoll()
+    def init(edge_triggered=False):
+        if edge_triggered:
+            Epoll._epoll = EdgeEpoll()
+        else:
+            Epoll._epoll = Epoll()
         # only one instance is allowed
         Event.addEvent = staticmethod(lambda ev: Epoll._epoll.register(ev))
         Event.delEvent = staticmethod(lambda ev: Epoll._epoll.deregister(ev))
         Event.isEventSet = staticmethod(lambda ev: Epoll._epoll.is_set(ev))
         Event.processEvents = staticmethod(lambda t: Epoll._epoll.process_events(t))
+        Event.eventDrained = staticmethod(lambda ev: Epoll._epoll.drained(ev))
 
     def __init__(self):
         self._fd = select.epoll()
@@ -29,7 +34,7 @@ class Epoll:
         self._registered_write = {}
         self._fd_mask = {}
 
-        self._last_time = time.time()
+        self._last_time = Event.now()
 
     def register(self, event):
         if event.is_write():
@@ -88,6 +93,9 @@ class Epoll:
                 return fd in self._registered_read
         return False
 
+    def drained(self, event):
+        pass
+
     def _close_fd(self, fd):
         if fd in self._registered_read:
             del self._registered_read[fd]
@@ -105,8 +113,15 @@ class Epoll:
             pass
 
     def process_events(self, timeout):
+        stats = Event.stats
+        if stats is not None:
+            start = monotonic()
+        polled = self._fd.poll(timeout)
+        if stats is not None:
+            stats.record_poll(monotonic() - start, len(polled))
+
         ready_events = []
-        for fd, ev_type in self._fd.poll(timeout):
+        for fd, ev_type in polled:
             handled = False
             if ev_type & select.EPOLLOUT:
                 if fd in self._registered_write:
@@ -122,13 +137,155 @@ class Epoll:
         for event in ready_events:
             try:
                 if self.is_set(event):
-                    event.get_handler()(event)
+                    self._dispatch(event, stats)
             except Exception as ex:
                 self._close_fd(event.get_fd())
                 _logger.warning('%s, event handler exception', str(ex))
                 traceback.print_exc()
 
-        current_time = time.time()
+        current_time = Event.now()
         if current_time - self._last_time > 60.0:
             _logger.info('current number of opened fd: %d', len(self._fd_mask))
             self._last_time = current_time
+            if stats is not None:
+                stats.dump()
+                stats.reset()
+
+    @staticmethod
+    def _dispatch(event, stats):
+        if stats is None:
+            event.get_handler()(event)
+        else:
+            start = monotonic()
+            event.get_handler()(event)
+            stats.record_handler(event.get_name(), monotonic() - start)
+
+
+class EdgeEpoll(Epoll):
+    """Edge-triggered variant of Epoll.
+
+    Every fd is registered once with EPOLLIN | EPOLLOUT | EPOLLET, read and
+    write interest is only tracked in the dicts, so start/stop receiving or
+    sending issue no epoll_ctl. An edge is reported only once, so a direction
+    stays ready until its handler reports EAGAIN through Event.eventDrained,
+    and is dispatched again as long as there is interest in it.
+    """
+
+    _MASK = select.EPOLLIN | select.EPOLLOUT | select.EPOLLET
+
+    def __init__(self):
+        Epoll.__init__(self)
+        self._ready_read = set()
+        self._ready_write = set()
+        self._pending = set()
+
+    def _arm(self, event):
+        fd = event.get_fd()
+        try:
+            self._fd.register(fd, self._MASK)
+        except IOError as ex:
+            # already registered through the other direction of the same file
+            if ex.errno != errno.EEXIST:
+                raise
+        else:
+            # a new file got this fd number, forget what we knew about the old one
+            self._ready_read.discard(fd)
+            self._ready_write.discard(fd)
+        event._edge_armed = True
+
+    def _ready_set(self, event):
+        if event.is_write():
+            return self._ready_write
+        else:
+            return self._ready_read
+
+    def _registered(self, event):
+        if event.is_write():
+            return self._registered_write
+        else:
+            return self._registered_read
+
+    def register(self, event):
+        if not getattr(event, '_edge_armed', False):
+            self._arm(event)
+
+        fd = event.get_fd()
+        registered = self._registered(event)
+        assert(fd not in registered)
+        registered[fd] = event
+        self._fd_mask[fd] = self._MASK
+        if fd in self._ready_set(event):
+            self._pending.add(event)
+
+    def deregister(self, event):
+        fd = event.get_fd()
+        registered = self._registered(event)
+        if fd not in registered:
+            _logger.warn("No event registered for fd: %d", fd)
+            return
+        del registered[fd]
+        self._pending.discard(event)
+        # the file stays armed, closing it takes it out of the epoll set
+        if fd not in self._registered_read and fd not in self._registered_write:
+            del self._fd_mask[fd]
+
+    def is_set(self, event):
+        return event.get_fd() in self._registered(event)
+
+    def drained(self, event):
+        self._ready_set(event).discard(event.get_fd())
+
+    def _close_fd(self, fd):
+        self._ready_read.discard(fd)
+        self._ready_write.discard(fd)
+        for registered in (self._registered_read, self._registered_write):
+            if fd in registered:
+                self._pending.discard(registered[fd])
+        Epoll._close_fd(self, fd)
+
+    def process_events(self, timeout):
+        if len(self._pending) > 0:
+            timeout = 0
+
+        stats = Event.stats
+        if stats is not None:
+            start = monotonic()
+        polled = self._fd.poll(timeout)
+        if stats is not None:
+            stats.record_poll(monotonic() - start, len(polled))
+
+        for fd, ev_type in polled:
+            if ev_type & (select.EPOLLERR | select.EPOLLHUP):
+                ev_type |= select.EPOLLIN | select.EPOLLOUT
+            if ev_type & select.EPOLLOUT:
+                self._ready_write.add(fd)
+                if fd in self._registered_write:
+                    self._pending.add(self._registered_write[fd])
+            if ev_type & select.EPOLLIN:
+                self._ready_read.add(fd)
+                if fd in self._registered_read:
+                    self._pending.add(self._registered_read[fd])
+
+        ready_events = list(self._pending)
+        self._pending.clear()
+        for event in ready_events:
+            fd = event.get_fd()
+            try:
+                if self.is_set(event):
+                    self._dispatch(event, stats)
+                    # not drained yet, e.g. stopped early or fin queued
+                    if self.is_set(event) and fd in self._ready_set(event):
+                        self._pending.add(event)
+            except Exception as ex:
+                self._close_fd(fd)
+                _logger.warning('%s, event handler exception', str(ex))
+                traceback.print_exc()
+
+        current_time = Event.now()
+        if current_time - self._last_time > 60.0:
+            _logger.info('current number of opened fd: %d',
+                         len(self._registered_write.viewkeys() | self._registered_read.viewkeys()))
+            self._last_time = current_time
+            if stats is not None:
+                stats.dump()
+                stats.reset()
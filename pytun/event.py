@@ -1,21 +1,61 @@
+import sys
 import time
-import heapq
 import traceback
+from collections import deque
+from timerwheel import TimingWheel
 
 import loglevel
 _logger = loglevel.get_logger('event')
 _logger.setLevel(loglevel.DEFAULT_LEVEL)
 
 
+def _gen_monotonic():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        import ctypes
+        import ctypes.util
+
+        class Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'))
+        clock_gettime = libc.clock_gettime
+        clock_id = 6 if sys.platform == 'darwin' else 1
+        ts = Timespec()
+
+        def monotonic():
+            if clock_gettime(clock_id, ctypes.byref(ts)) != 0:
+                raise OSError('clock_gettime failed')
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except Exception as ex:
+        _logger.warning('no monotonic clock, fall back to time.time: %s', str(ex))
+        return time.time
+
+
+monotonic = _gen_monotonic()
+
+
 class Event:
 
-    _timers = []
+    # cached once per loop iteration
+    _now = monotonic()
+    _timers = TimingWheel(now=_now)
+    _ready = deque()
+    # LoopStats, nothing is measured while it is None
+    stats = None
 
     def __init__(self):
         self._fd = 0
         self._write = False
         self._handler = None
+        self._name = None
         self._timer_set = False
+        self._timer_slot = None
+        self._deadline = None
 
     def set_fd(self, fd):
         self._fd = fd
@@ -35,61 +75,109 @@ class Event:
     def set_handler(self, handler):
         self._handler = handler
 
+    def get_name(self):
+        return self._name
+
+    def set_name(self, name):
+        self._name = name
+
+    @staticmethod
+    def set_stats(stats):
+        Event.stats = stats
+
+    @staticmethod
+    def now():
+        return Event._now
+
+    @staticmethod
+    def update_time():
+        Event._now = monotonic()
+        return Event._now
+
     @staticmethod
     def add_timer(milliseconds):
         event = Event()
         event._timer_set = True
-        timeout = time.time() + milliseconds / 1000.0
-        heapq.heappush(Event._timers, (timeout, event))
+        event._name = 'timer'
+        event._deadline = Event._now + milliseconds / 1000.0
+        event._timer_slot = Event._timers.add(event, event._deadline)
+        return event
+
+    @staticmethod
+    def call_soon(handler):
+        """Runs handler(event) at the start of the next loop iteration,
+        cancelled with del_timer like a timer."""
+        event = Event()
+        event._timer_set = True
+        event._name = 'soon'
+        event.set_handler(handler)
+        Event._ready.append(event)
         return event
 
     def del_timer(self):
+        if self._timer_set and self._timer_slot is not None:
+            Event._timers.remove(self, self._timer_slot)
         self._timer_set = False
+        self._timer_slot = None
 
     def is_timer(self):
         return self._timer_set
 
     @staticmethod
     def find_timer():
-        current = time.time()
-        while len(Event._timers) > 0:
-            timeout, event = Event._timers[0]
-            if not event.is_timer():
-                heapq.heappop(Event._timers)
-            elif timeout > current:
-                return timeout - current
-            else:
-                return 0
+        if len(Event._ready) > 0:
+            return 0
         # return -1
-        return 5
+        return Event._timers.next_timeout(Event._now, 5)
+
+    @staticmethod
+    def _fire(event):
+        # an earlier handler of this round may have cancelled it
+        if event.is_timer():
+            event._timer_set = False
+            event._timer_slot = None
+            try:
+                stats = Event.stats
+                if stats is None:
+                    event.get_handler()(event)
+                else:
+                    start = monotonic()
+                    if event._deadline is not None:
+                        stats.record_lag(start - event._deadline)
+                    event.get_handler()(event)
+                    stats.record_handler(event._name, monotonic() - start)
+            except Exception as ex:
+                _logger.warning("timer handler exception: %s", str(ex))
+                traceback.print_exc()
+
+    @staticmethod
+    def run_ready():
+        # the ones queued meanwhile wait for the next iteration
+        for _ in range(len(Event._ready)):
+            Event._fire(Event._ready.popleft())
 
     @staticmethod
     def expire_timers():
-        current = time.time()
-        while len(Event._timers) > 0:
-            timeout, event = Event._timers[0]
-            if timeout > current:
-                break
-            else:
-                heapq.heappop(Event._timers)
-                if event.is_timer():
-                    try:
-                        event.get_handler()(event)
-                    except Exception as ex:
-                        _logger.warning("timer handler exception: %s", str(ex))
-                        traceback.print_exc()
+        for event in Event._timers.expire(Event._now):
+            Event._fire(event)
 
     addEvent = None
     delEvent = None
     isEventSet = None
     processEvents = None
+    # edge-triggered backends need to know when a handler hit EAGAIN
+    eventDrained = staticmethod(lambda ev: None)
 
     @staticmethod
     def process_events_and_timers():
+        Event.update_time()
+        Event.run_ready()
+
         timeout = Event.find_timer()
         _logger.debug('loop: %f s', timeout)
         Event.processEvents(timeout)
 
+        Event.update_time()
         Event.expire_timers()
 
     @staticmethod
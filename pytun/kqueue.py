@@ -1,5 +1,4 @@
 import select
-import time
 import os
 import traceback
 from event import Event
@@ -28,7 +27,7 @@ class Kqueue:
         self._registered_read = {}
         self._registered_write = {}
 
-        self._last_time = time.time()
+        self._last_time = Event.now()
 
     def register(self, event):
         fd = event.get_fd()
@@ -106,7 +105,7 @@ class Kqueue:
                 _logger.warning('%s, event handler exception', str(ex))
                 traceback.print_exc()
 
-        current_time = time.time()
+        current_time = Event.now()
         if current_time - self._last_time > 60.0:
             _logger.info('current number of opened fd: %d',
                          len(self._registered_write.viewkeys() | self._registered_read.viewkeys()))
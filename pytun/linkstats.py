@@ -0,0 +1,122 @@
+# a ping not answered in this many seconds is lost
+PING_TIMEOUT = 5.0
+# weights of a new sample, as tcp takes them for srtt and rttvar
+RTT_GAIN = 1 / 8.0
+JITTER_GAIN = 1 / 4.0
+RATE_GAIN = 1 / 4.0
+LOSS_GAIN = 1 / 8.0
+# a link is degraded after this many pings in a row timed out
+DEGRADED_TIMEOUTS = 2
+# pings remembered at most, the oldest are taken for lost
+MAX_OUTSTANDING = 64
+
+
+class LinkStats(object):
+    """What the pings of a tunnel tell about the link, times in seconds.
+
+    The round trip time and its variation are smoothed the way tcp does it,
+    loss is a moving average of the pings timed out, the throughput a moving
+    average of the bytes counted between two ticks.
+    """
+
+    def __init__(self, now):
+        self._rtt = None
+        self._jitter = 0.0
+        self._min_rtt = None
+        self._loss = 0.0
+        self._pings = 0
+        self._pongs = 0
+        self._timeouts = 0
+        self._timeouts_in_row = 0
+        # seq -> when sent
+        self._outstanding = {}
+        self._sent = 0
+        self._received = 0
+        self._sent_rate = 0.0
+        self._received_rate = 0.0
+        self._last_tick = now
+        self._sent_at_tick = 0
+        self._received_at_tick = 0
+
+    def count_sent(self, size):
+        self._sent += size
+
+    def count_received(self, size):
+        self._received += size
+
+    def is_busy(self):
+        """whether anything was sent or received since the last tick"""
+        return self._sent != self._sent_at_tick or self._received != self._received_at_tick
+
+    def tick(self, now):
+        """updates the throughput, and takes the pings too old for lost,
+        returns how many"""
+        elapsed = now - self._last_tick
+        if elapsed > 0:
+            self._sent_rate += RATE_GAIN * ((self._sent - self._sent_at_tick) / elapsed - self._sent_rate)
+            self._received_rate += RATE_GAIN * (
+                (self._received - self._received_at_tick) / elapsed - self._received_rate)
+        self._last_tick = now
+        self._sent_at_tick = self._sent
+        self._received_at_tick = self._received
+
+        lost = 0
+        for seq, sent in list(self._outstanding.items()):
+            if now - sent >= PING_TIMEOUT:
+                del self._outstanding[seq]
+                self._lost()
+                lost += 1
+        return lost
+
+    def ping_sent(self, seq, now):
+        if len(self._outstanding) >= MAX_OUTSTANDING:
+            del self._outstanding[min(self._outstanding)]
+            self._lost()
+        self._outstanding[seq] = now
+        self._pings += 1
+
+    def pong_received(self, seq, sent, now):
+        """sent is the time the ping carried, None if seq timed out already"""
+        if self._outstanding.pop(seq, None) is None:
+            return None
+        rtt = max(now - sent, 0.0)
+        self._pongs += 1
+        self._timeouts_in_row = 0
+        self._loss -= LOSS_GAIN * self._loss
+        if self._rtt is None:
+            self._rtt = rtt
+            self._jitter = rtt / 2
+        else:
+            self._jitter += JITTER_GAIN * (abs(rtt - self._rtt) - self._jitter)
+            self._rtt += RTT_GAIN * (rtt - self._rtt)
+        if self._min_rtt is None or rtt < self._min_rtt:
+            self._min_rtt = rtt
+        return rtt
+
+    def _lost(self):
+        self._timeouts += 1
+        self._timeouts_in_row += 1
+        self._loss += LOSS_GAIN * (1.0 - self._loss)
+
+    def get_rtt(self):
+        """smoothed round trip time, None before the first pong"""
+        return self._rtt
+
+    def is_degraded(self):
+        return self._timeouts_in_row >= DEGRADED_TIMEOUTS
+
+    def get(self):
+        return {
+            'rtt': self._rtt,
+            'min_rtt': self._min_rtt,
+            'jitter': self._jitter,
+            'loss': self._loss,
+            'pings': self._pings,
+            'pongs': self._pongs,
+            'timeouts': self._timeouts,
+            'degraded': self.is_degraded(),
+            'sent': self._sent,
+            'received': self._received,
+            'sent_rate': self._sent_rate,
+            'received_rate': self._received_rate
+        }
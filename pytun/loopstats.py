@@ -0,0 +1,108 @@
+import loglevel
+_logger = loglevel.get_logger('loopstats')
+_logger.setLevel(loglevel.DEFAULT_LEVEL)
+
+
+class Histogram(object):
+    """Power of two buckets, bucket i counts values below 2 ** i."""
+
+    BUCKETS = 32
+
+    def __init__(self):
+        self._buckets = [0] * self.BUCKETS
+        self._count = 0
+        self._total = 0
+        self._max = 0
+
+    def add(self, value):
+        value = int(value)
+        index = min(value.bit_length(), self.BUCKETS - 1)
+        self._buckets[index] += 1
+        self._count += 1
+        self._total += value
+        if value > self._max:
+            self._max = value
+
+    def get_count(self):
+        return self._count
+
+    def get_total(self):
+        return self._total
+
+    def percentile(self, p):
+        """upper bound of the bucket holding the p-th percentile"""
+        if self._count == 0:
+            return 0
+        rank = self._count * p / 100.0
+        seen = 0
+        for index, count in enumerate(self._buckets):
+            seen += count
+            if seen >= rank:
+                return min(2 ** index, self._max)
+        return self._max
+
+    def summary(self):
+        return {
+            'count': self._count,
+            'mean': self._total / self._count if self._count > 0 else 0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self._max
+        }
+
+
+class LoopStats(object):
+    """Event loop instrumentation, durations are kept in microseconds.
+
+    Installed with Event.set_stats(); while Event.stats is None the loop
+    does not measure anything.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._iterations = 0
+        self._poll = Histogram()
+        self._ready = Histogram()
+        self._lag = Histogram()
+        self._handlers = {}
+
+    def record_poll(self, seconds, ready):
+        self._iterations += 1
+        self._poll.add(seconds * 1e6)
+        self._ready.add(ready)
+
+    def record_handler(self, name, seconds):
+        histogram = self._handlers.get(name)
+        if histogram is None:
+            histogram = self._handlers[name] = Histogram()
+        histogram.add(seconds * 1e6)
+
+    def record_lag(self, seconds):
+        self._lag.add(max(seconds, 0) * 1e6)
+
+    def get(self):
+        handler_total = sum(h.get_total() for h in self._handlers.values())
+        return {
+            'iterations': self._iterations,
+            'poll_us': self._poll.get_total(),
+            'handler_us': handler_total,
+            'poll': self._poll.summary(),
+            'ready': self._ready.summary(),
+            'lag': self._lag.summary(),
+            'handlers': dict((name, h.summary()) for name, h in self._handlers.items())
+        }
+
+    def dump(self):
+        stats = self.get()
+        _logger.info('iterations: %d, poll: %d us, handlers: %d us',
+                     stats['iterations'], stats['poll_us'], stats['handler_us'])
+        for name in ('poll', 'ready', 'lag'):
+            _logger.info('%-16s %s', name, self._format(stats[name]))
+        for name, summary in sorted(stats['handlers'].items()):
+            _logger.info('%-16s %s', name, self._format(summary))
+
+    @staticmethod
+    def _format(summary):
+        return 'count: %(count)d, mean: %(mean)d, p50: %(p50)d, p99: %(p99)d, max: %(max)d' % summary
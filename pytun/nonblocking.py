@@ -3,23 +3,92 @@ import errno
 import traceback
 from event import Event
 from collections import deque
+from itertools import islice
+from syscall import IOV_MAX
 
 import loglevel
 _logger = loglevel.get_logger('non-blocking')
 _logger.setLevel(loglevel.DEFAULT_LEVEL)
 
 
-SEND_BUFFER = 512 * 1024
+SEND_BUFFER_HIGH = 512 * 1024
+SEND_BUFFER_LOW = 128 * 1024
 FIN_WAIT_TIMEOUT = 120 * 1000
+RECEIVE_BUFFER_SIZE = 2 ** 16
+# consumed bytes a decoder buffer keeps before they are cut off
+DECODE_COMPACT_THRESHOLD = 64 * 1024
+
+
+def _to_bytes(data):
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
 
 
 class NonBlocking(object):
 
+    # shared by all of them once enabled, what is read into it is decoded
+    # and handled before the next read overwrites it
+    _receive_buffer = None
+    # process wide BufferBudget, None unless installed
+    _budget = None
+
     class _ReceiveHandlerContext(object):
+        """One depth of the decoder chain.
+
+        Input that the handler can not consume yet is appended to a growable
+        buffer and decoded in place from a read offset, so a large frame
+        arriving in many reads is copied once instead of being concatenated
+        again on every read. Handlers get memoryviews and return the decoded
+        unit (or None) and the number of bytes consumed, 0 meaning more data
+        is needed.
+        """
 
         def __init__(self, handler):
             self.handler = handler
-            self.remain = []
+            self.buffer = bytearray()
+            self.offset = 0
+
+        def _run(self, view, decoded):
+            pos = 0
+            while pos < len(view):
+                processed, consumed = self.handler(view[pos:])
+                if consumed == 0:
+                    break
+                pos += consumed
+                if processed is not None:
+                    decoded.append(processed)
+            return pos
+
+        def _append(self, data):
+            # only called before views of the buffer are handed out
+            if self.offset == len(self.buffer):
+                del self.buffer[:]
+                self.offset = 0
+            elif self.offset > DECODE_COMPACT_THRESHOLD and self.offset * 2 > len(self.buffer):
+                del self.buffer[:self.offset]
+                self.offset = 0
+            self.buffer.extend(data)
+
+        def decode(self, chunks):
+            decoded = []
+            i = 0
+            if self.offset == len(self.buffer):
+                # nothing buffered, decode straight from the chunks
+                while i < len(chunks):
+                    view = memoryview(chunks[i])
+                    i += 1
+                    consumed = self._run(view, decoded)
+                    if consumed < len(view):
+                        self._append(view[consumed:])
+                        break
+                if i == len(chunks):
+                    return decoded
+
+            for chunk in chunks[i:]:
+                self._append(chunk)
+            self.offset += self._run(memoryview(self.buffer)[self.offset:], decoded)
+            return decoded
 
     def __init__(self, fd, prefix=None):
         self._fd = fd
@@ -28,6 +97,16 @@ class NonBlocking(object):
 
         self._to_send = deque()
         self._to_send_bytes = 0
+        # bytes of the first queued chunk already sent, vectored flush only
+        self._send_offset = 0
+        self._vectored = False
+        self._high_watermark = SEND_BUFFER_HIGH
+        self._low_watermark = SEND_BUFFER_LOW
+        self._send_buffer_full = False
+        # held by the budget, start_receiving is ignored meanwhile, and
+        # whether to receive once released
+        self._held = False
+        self._resume_receiving = False
 
         self._encoders = []
         self._decoders = []
@@ -45,6 +124,8 @@ class NonBlocking(object):
         self._on_received = None
         self._on_fin_received = None
         self._on_closed = None
+        # for whoever counts the open ones, kept when on_closed is replaced
+        self._on_released = None
 
         self._fin_ev = None
         self._close_ev = None
@@ -53,11 +134,13 @@ class NonBlocking(object):
         self._wev.set_write(True)
         self._wev.set_fd(self._fd.fileno())
         self._wev.set_handler(lambda ev: self._on_send())
+        self._wev.set_name('%s send' % type(self).__name__.lower())
 
         self._rev = Event()
         self._rev.set_write(False)
         self._rev.set_fd(self._fd.fileno())
         self._rev.set_handler(lambda ev: self._on_receive())
+        self._rev.set_name('%s receive' % type(self).__name__.lower())
 
         self._errorType = socket.error
 
@@ -81,6 +164,17 @@ class NonBlocking(object):
     def set_non_blocking(self):
         raise NotImplemented
 
+    @staticmethod
+    def enable_receive_buffer(size=RECEIVE_BUFFER_SIZE):
+        """Read into one preallocated buffer instead of a new string per read.
+        Decoders get memoryviews into it, anything kept past the read, i.e.
+        decoder remains and the chunks passed to the handlers, is copied out."""
+        NonBlocking._receive_buffer = memoryview(bytearray(size))
+
+    @staticmethod
+    def set_budget(budget):
+        NonBlocking._budget = budget
+
     def set_on_ready_to_send(self, handler):
         self._on_ready_to_send = handler
 
@@ -96,6 +190,9 @@ class NonBlocking(object):
     def set_on_closed(self, on_closed):
         self._on_closed = on_closed
 
+    def set_on_released(self, on_released):
+        self._on_released = on_released
+
     def set_on_decode_error(self, on_decode_error):
         self._on_decode_error = on_decode_error
 
@@ -111,24 +208,46 @@ class NonBlocking(object):
             return
         if not self._connected or self._fin_received or self.is_closed():
             return
+        if self._held:
+            self._resume_receiving = True
+            return
         if not Event.isEventSet(self._rev):
             _logger.debug('%s, start_receiving::addEvent', str(self))
             Event.addEvent(self._rev)
 
     def stop_receiving(self):
         _logger.debug('%s, stop_receiving', str(self))
+        self._resume_receiving = False
         if Event.isEventSet(self._rev):
             _logger.debug('%s, stop_receiving::delEvent', str(self))
             Event.delEvent(self._rev)
 
+    def hold_receiving(self):
+        """stop receiving until release_receiving(), whatever start_receiving() says"""
+        _logger.debug('%s, hold_receiving', str(self))
+        if self._held:
+            return
+        receiving = Event.isEventSet(self._rev)
+        self.stop_receiving()
+        self._held = True
+        self._resume_receiving = receiving
+
+    def release_receiving(self):
+        """receive again if the stream did before the hold, or was started
+        meanwhile"""
+        _logger.debug('%s, release_receiving', str(self))
+        if self._held:
+            self._held = False
+            if self._resume_receiving:
+                self.start_receiving()
+
     def _do_close(self):
         _logger.debug('%s, _do_close', str(self))
         if self._error:
             self._stop_sending()
             self.stop_receiving()
         if self._close_ev is None:
-            self._close_ev = Event.add_timer(0)
-            self._close_ev.set_handler(lambda ev: self._on_close())
+            self._close_ev = Event.call_soon(lambda ev: self._on_close())
 
     def _receive_fin(self):
         _logger.debug('%s, _receive_fin', str(self))
@@ -153,6 +272,9 @@ class NonBlocking(object):
     def _send(self, data, addr):
         raise NotImplemented
 
+    def _sendv(self, chunks, offset):
+        raise NotImplemented
+
     def _start_sending(self):
         _logger.debug('%s, _start_sending', str(self))
         if self._close_ev is not None:
@@ -172,63 +294,64 @@ class NonBlocking(object):
         self.stop_receiving()
         self._do_close()
 
-    def _to_send_or_not_policy(self):
-        # if len(self._to_send) > 10:
-        #     return False
-        if self._to_send_bytes > SEND_BUFFER:
-            return False
-        return True
+    def set_watermarks(self, high, low):
+        """on_send_buffer_full fires once the queued bytes rise above high,
+        on_ready_to_send once they are back at or below low"""
+        assert(low <= high)
+        self._high_watermark = high
+        self._low_watermark = low
 
-    def _to_send_or_not(self, ready_to_send):
-        if ready_to_send and self._to_send_or_not_policy():
-            if self._on_ready_to_send is not None:
-                try:
-                    self._on_ready_to_send(self)
-                except Exception as ex:
-                    _logger.error('_on_ready_to_send: %s', str(ex))
-                    _logger.error('%s', traceback.format_exc())
-                    self._error = True
-                    self._do_close()
-        else:
-            if self._on_send_buffer_full is not None:
-                try:
-                    self._on_send_buffer_full(self)
-                except Exception as ex:
-                    _logger.error('_on_send_buffer_full: %s', str(ex))
-                    _logger.error('%s', traceback.format_exc())
-                    self._error = True
-                    self._do_close()
-
-    def _on_send(self):
-        _logger.debug('%s, _on_send', str(self))
-        if self._fin_sent:
-            self._stop_sending()
-            if self._fin_received:
+    def _notify_send_buffer(self, handler, name):
+        if handler is not None:
+            try:
+                handler(self)
+            except Exception as ex:
+                _logger.error('%s: %s', name, str(ex))
+                _logger.error('%s', traceback.format_exc())
+                self._error = True
                 self._do_close()
-            else:
-                self.start_receiving()
-                assert(self._fin_ev is None)
-                _logger.debug('%s, add fin wait timer', str(self))
-                self._fin_ev = Event.add_timer(FIN_WAIT_TIMEOUT)
-                self._fin_ev.set_handler(lambda ev: self._wait_fin_timeout())
-            return
 
+    def _check_watermarks(self):
+        if self._send_buffer_full:
+            if self._to_send_bytes <= self._low_watermark:
+                self._send_buffer_full = False
+                self._notify_send_buffer(self._on_ready_to_send, '_on_ready_to_send')
+        elif self._to_send_bytes > self._high_watermark:
+            self._send_buffer_full = True
+            self._notify_send_buffer(self._on_send_buffer_full, '_on_send_buffer_full')
+
+    def is_send_buffer_full(self):
+        return self._send_buffer_full
+
+    def get_send_queued(self):
+        """bytes encoded and waiting to be sent"""
+        return self._to_send_bytes
+
+    def _pop_poison(self):
+        self._to_send.popleft()
+        left = len(self._to_send)
+        if left != 0:
+            _logger.warning('%s, discard %d packages', str(self), left)
+            self._to_send.clear()
+            self._to_send_bytes = 0
+            if NonBlocking._budget is not None:
+                NonBlocking._budget.release(self)
+        self._send_offset = 0
+        self._shutdown()
+
+    def _flush(self):
         sent_bytes = 0
-        ready_to_send = True
         while len(self._to_send) > 0:
+            if self._to_send[0][0] is None:
+                self._pop_poison()
+                return False
             data, addr = self._to_send.popleft()
-            if data is None:
-                left = len(self._to_send)
-                if left != 0:
-                    _logger.warning('%s, discard %d packages', str(self), left)
-                    self._to_send.clear()
-                    self._to_send_bytes = 0
-                self._shutdown()
-                return
             try:
                 sent = self._send(data, addr)
                 sent_bytes += sent
                 self._to_send_bytes -= sent
+                if NonBlocking._budget is not None:
+                    NonBlocking._budget.sent(self, sent)
                 if sent < len(data):
                     self._to_send.appendleft((data[sent:], addr))
             except self._errorType as msg:
@@ -238,17 +361,77 @@ class NonBlocking(object):
                                     str(self), msg.errno, msg.strerror)
                     self._error = True
                     self._do_close()
-                    return
+                    return False
                 else:
-                    ready_to_send = False
+                    Event.eventDrained(self._wev)
                     break
 
         _logger.debug("%s, sent %d bytes", str(self), sent_bytes)
+        return True
+
+    def _flush_vectored(self):
+        sent_bytes = 0
+        while len(self._to_send) > 0:
+            if self._to_send[0][0] is None:
+                self._pop_poison()
+                return False
+            chunks = []
+            for data, _ in islice(self._to_send, IOV_MAX):
+                if data is None:
+                    break
+                chunks.append(data)
+            try:
+                sent = self._sendv(chunks, self._send_offset)
+            except self._errorType as msg:
+                if msg.errno != errno.EAGAIN and msg.errno != errno.EINPROGRESS:
+                    _logger.warning('%s, sendv(%d): %s',
+                                    str(self), msg.errno, msg.strerror)
+                    self._error = True
+                    self._do_close()
+                    return False
+                else:
+                    Event.eventDrained(self._wev)
+                    break
+            sent_bytes += sent
+            self._to_send_bytes -= sent
+            if NonBlocking._budget is not None:
+                NonBlocking._budget.sent(self, sent)
+            # drop what went out, remember how far the first chunk left got
+            sent += self._send_offset
+            for _ in range(len(chunks)):
+                if sent < len(self._to_send[0][0]):
+                    break
+                sent -= len(self._to_send.popleft()[0])
+            self._send_offset = sent
+
+        _logger.debug("%s, sent %d bytes", str(self), sent_bytes)
+        return True
+
+    def _on_send(self):
+        _logger.debug('%s, _on_send', str(self))
+        if self._fin_sent:
+            self._stop_sending()
+            if self._fin_received:
+                self._do_close()
+            else:
+                self.start_receiving()
+                assert(self._fin_ev is None)
+                _logger.debug('%s, add fin wait timer', str(self))
+                self._fin_ev = Event.add_timer(FIN_WAIT_TIMEOUT)
+                self._fin_ev.set_handler(lambda ev: self._wait_fin_timeout())
+            return
+
+        if self._vectored:
+            flushed = self._flush_vectored()
+        else:
+            flushed = self._flush()
+        if not flushed:
+            return
 
         if len(self._to_send) == 0:
             self._stop_sending()
 
-        self._to_send_or_not(ready_to_send)
+        self._check_watermarks()
 
     def send(self, data, addr=None):
         _logger.debug('%s, send', str(self))
@@ -262,6 +445,8 @@ class NonBlocking(object):
 
         self._to_send.append((to_send, addr))
         self._to_send_bytes += len(to_send)
+        if NonBlocking._budget is not None:
+            NonBlocking._budget.queued(self, len(to_send))
 
         if addr is not None:
             _logger.debug('%s, sending %d(%d) bytes to %s:%d', str(self), len(to_send), len(data), *addr)
@@ -271,71 +456,46 @@ class NonBlocking(object):
         if self._connected:
             self._start_sending()
 
-        self._to_send_or_not(True)
+        self._check_watermarks()
 
     def is_ready_to_send(self):
-        if not self._connected or self.is_closed():
+        # queued data below the high watermark is fine, even before connected,
+        # _on_ready_to_send only follows an _on_send_buffer_full
+        if self.is_closed():
             return False
 
-        return Event.isEventSet(self._wev)
+        return not self._send_buffer_full
 
     def _recv(self, size):
         raise NotImplemented
 
-    def _decode_single_depth(self, handler, data_list):
-        _logger.debug('%s, _decode_single_depth', str(self))
-        if len(data_list) == 0:
-            return [], 0, []
-        total_processed = []
-        total_consumed_bytes = 0
-        to_process = data_list[0]
-        total_consumed_count = 1
-        while True:
-            processed, consumed_bytes = handler(to_process)
-            if consumed_bytes == 0:
-                if total_consumed_count < len(data_list):
-                    to_process += data_list[total_consumed_count]
-                    total_consumed_count += 1
-                else:
-                    break
-            else:
-                to_process = to_process[consumed_bytes:]
-            if processed is not None:
-                total_processed.append(processed)
-            total_consumed_bytes += consumed_bytes
-        remain = []
-        if len(to_process) > 0:
-            remain.append(to_process)
-        remain.extend(data_list[total_consumed_count:])
-        return total_processed, total_consumed_bytes, remain
+    def _recv_into(self, buff):
+        raise NotImplemented
 
     def _decode(self, data):
         _logger.debug('%s, _decode', str(self))
         if len(self._decoders) == 0:
             return [data]
 
-        total_consumed = []
         to_consume = [data]
-        for depth in range(len(self._decoders)):
-            context = self._decoders[depth]
-            if len(context.remain) > 0:
-                context.remain.extend(to_consume)
-                to_consume = context.remain
-            consumed, processed, remain = self._decode_single_depth(context.handler, to_consume)
-            context.remain = remain
-            if processed == 0:
-                break
-            if depth == len(self._decoders) - 1:
-                total_consumed.extend(consumed)
-            to_consume = consumed
-        return total_consumed
+        for context in self._decoders:
+            to_consume = context.decode(to_consume)
+            if len(to_consume) == 0:
+                return []
+        # the views die with the buffers they point to
+        return [_to_bytes(decoded) for decoded in to_consume]
 
     def _on_receive(self):
         _logger.debug('%s, _on_receive', str(self))
         buff_size = 2 ** 16
+        buff = NonBlocking._receive_buffer
         while True:
             try:
-                recv, addr = self._recv(buff_size)
+                if buff is None:
+                    recv, addr = self._recv(buff_size)
+                else:
+                    size, addr = self._recv_into(buff)
+                    recv = buff[:size]
                 if len(recv) == 0:
                     self._receive_fin()
                     return
@@ -346,6 +506,8 @@ class NonBlocking(object):
                                     str(self), msg.errno, msg.strerror)
                     self._error = True
                     self._do_close()
+                else:
+                    Event.eventDrained(self._rev)
                 return
 
             if self._decode_error:
@@ -365,6 +527,13 @@ class NonBlocking(object):
                         return
                     consumed = [recv]
 
+            if buff is not None:
+                consumed = [_to_bytes(data) for data in consumed]
+
+            # what the handlers queue is charged to this one
+            budget = NonBlocking._budget
+            if budget is not None:
+                budget.set_producer(self)
             stop = False
             try:
                 for data in consumed:
@@ -383,6 +552,9 @@ class NonBlocking(object):
                 self._error = True
                 self._do_close()
                 return
+            finally:
+                if budget is not None:
+                    budget.set_producer(None)
 
             if stop:
                 self.stop_receiving()
@@ -408,12 +580,20 @@ class NonBlocking(object):
         self._close()
         self._connected = False
         self._closed = True
+        if NonBlocking._budget is not None:
+            NonBlocking._budget.release(self)
         if self._on_closed is not None:
             try:
                 self._on_closed(self)
             except Exception as ex:
                 _logger.error('_on_closed: %s', ex)
                 _logger.error('%s', traceback.format_exc())
+        if self._on_released is not None:
+            try:
+                self._on_released(self)
+            except Exception as ex:
+                _logger.error('_on_released: %s', ex)
+                _logger.error('%s', traceback.format_exc())
 
     def _shutdown(self):
         _logger.debug('%s, _shutdown', str(self))
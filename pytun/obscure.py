@@ -11,6 +11,13 @@ _logger.setLevel(loglevel.DEFAULT_LEVEL)
 random.seed()
 
 
+def _to_string(data):
+    # decoders may be handed memoryviews of the receive buffer
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
+
+
 def pack_data(data):
     date_length = len(data)
     _logger.debug('packed %d bytes', date_length)
@@ -101,6 +108,7 @@ def gen_aes_decrypt():
     cipher = [None]
 
     def aes_decrypt(raw):
+        raw = _to_string(raw)
         if cipher[0] is None:
             if len(raw) < AES.block_size + AES.block_size:
                 return None, 0
@@ -131,6 +139,7 @@ def gen_xor_decrypt():
     cipher = [None]
 
     def xor_decrypt(raw):
+        raw = _to_string(raw)
         if cipher[0] is None:
             if len(raw) < AES.block_size:
                 return None, 0
@@ -149,7 +158,7 @@ def base64_decode(data):
     def ceil(v, d):
         return v / d + (0 if v % d == 0 else 1)
 
-    decoded = base64.b64decode(data[0:len(data) / 4 * 4])
+    decoded = base64.b64decode(_to_string(data[0:len(data) / 4 * 4]))
     return decoded, ceil(len(decoded), 3) * 4
 
 
@@ -244,11 +253,13 @@ def gen_http_decode(request):
         if remain[0] > 0:
             return consume_data(data)
 
+        # headers are parsed from a copy no longer than they may be
+        head = _to_string(data[:8192 + BM_HEADER_SIZE])
         first_line = True
         http_length = 0
         content_length = 0
         while True:
-            line, data = get_line(data)
+            line, head = get_line(head)
             if line is None:
                 return None, 0
             http_length += len(line) + len('\r\n')
@@ -267,8 +278,8 @@ def gen_http_decode(request):
                     if content.strip() != 'cdn.binasc.com':
                         raise Exception('unknown host: ' + content.strip()[0:32])
             else:
-                if len(data) > BM_HEADER_SIZE:
-                    data = data[BM_HEADER_SIZE:]
+                if len(data) > http_length + BM_HEADER_SIZE:
+                    data = data[http_length + BM_HEADER_SIZE:]
                 else:
                     return None, 0
                 remain[0] = content_length - BM_HEADER_SIZE
@@ -0,0 +1,177 @@
+import random
+from collections import OrderedDict
+
+import loglevel
+_logger = loglevel.get_logger('placement')
+_logger.setLevel(loglevel.DEFAULT_LEVEL)
+
+
+# a new flow looks at this many tunnels and takes the least loaded
+CHOICES = 2
+# flows remembered at most, the least recently used are forgotten
+AFFINITY_SIZE = 64 * 1024
+
+_MASK = 0xffffffffffffffff
+
+
+def _weight(key, token):
+    """rendezvous weight of a tunnel for a key, murmur3's 64 bit finalizer
+    mixing them, python's hash of a tuple is not random enough"""
+    value = (hash(key) ^ token) & _MASK
+    value ^= value >> 33
+    value = value * 0xff51afd7ed558ccd & _MASK
+    value ^= value >> 33
+    value = value * 0xc4ceb9fe1a85ec53 & _MASK
+    return value ^ value >> 33
+
+
+class Affinity(object):
+    """flow key -> the tunnel it goes through, while that one is open; at
+    most AFFINITY_SIZE of them, the least recently used go first"""
+
+    def __init__(self, size=AFFINITY_SIZE):
+        self._size = size
+        self._tunnels = OrderedDict()
+        self._on_forget = None
+
+    def set_on_forget(self, handler):
+        """handler(key, tunnel) once a flow is no longer remembered"""
+        self._on_forget = handler
+
+    def get(self, key):
+        """the tunnel of key, None if unknown or closed"""
+        tunnel = self._tunnels.pop(key, None)
+        if tunnel is None:
+            return None
+        if tunnel.is_closed():
+            self._forgotten(key, tunnel)
+            return None
+        self._tunnels[key] = tunnel
+        return tunnel
+
+    def bind(self, key, tunnel):
+        previous = self._tunnels.pop(key, None)
+        if previous is not None and previous is not tunnel:
+            self._forgotten(key, previous)
+        self._tunnels[key] = tunnel
+        while len(self._tunnels) > self._size:
+            self._forgotten(*self._tunnels.popitem(last=False))
+
+    def release(self, key):
+        tunnel = self._tunnels.pop(key, None)
+        if tunnel is not None:
+            self._forgotten(key, tunnel)
+
+    def _forgotten(self, key, tunnel):
+        if self._on_forget is not None:
+            self._on_forget(key, tunnel)
+
+    def __contains__(self, key):
+        return key in self._tunnels
+
+    def __len__(self):
+        return len(self._tunnels)
+
+
+class Placement(object):
+    """Decides which tunnel of a TunnelPool a flow goes through.
+
+    A flow stays on its tunnel while that one is open, so what it sends is
+    not reordered. A new flow, or one whose tunnel closed, ranks the tunnels
+    by rendezvous hashing of its key and takes the least loaded of the first
+    CHOICES of them, load being the bytes outstanding in the tunnel and
+    then its flows. The ranking of a key only changes when one of those
+    tunnels comes or goes: the flows of a closed tunnel spread over the
+    others instead of moving together, and a new tunnel takes its share of
+    the new flows only. Degraded tunnels are passed over while there are
+    others.
+
+    The pool is started by the first flow, unless it was already.
+    """
+
+    def __init__(self, pool, choices=CHOICES):
+        self._pool = pool
+        self._choices = choices
+        self._started = False
+        self._affinity = Affinity()
+        self._affinity.set_on_forget(self._on_forget)
+        # id(tunnel) -> its rendezvous token, and flows on it
+        self._tokens = {}
+        self._flows = {}
+        self._placed = 0
+        self._moved = 0
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            self._pool.start()
+
+    def get(self, key):
+        """the tunnel of key, placing the flow if it has none"""
+        # closed tunnels are still known until asked for
+        known = key in self._affinity
+        tunnel = self._affinity.get(key)
+        if tunnel is not None:
+            return tunnel
+        return self.place(key, known)
+
+    def lookup(self, key):
+        """the tunnel of key, None if it has none"""
+        return self._affinity.get(key)
+
+    def place(self, key, moved=False):
+        self.start()
+        tunnel = self._choose(key)
+        self._affinity.bind(key, tunnel)
+        self._flows[id(tunnel)] = self._flows.get(id(tunnel), 0) + 1
+        self._placed += 1
+        if moved:
+            self._moved += 1
+        _logger.debug('%s placed on %s', str(key), str(tunnel))
+        return tunnel
+
+    def release(self, key):
+        """the flow is over"""
+        self._affinity.release(key)
+
+    def _on_forget(self, _key, tunnel):
+        flows = self._flows.get(id(tunnel), 0) - 1
+        if flows > 0:
+            self._flows[id(tunnel)] = flows
+        else:
+            self._flows.pop(id(tunnel), None)
+
+    def _candidates(self):
+        tunnels = [t for t in self._pool.get_tunnels() if not t.is_closed()]
+        established = [t for t in tunnels if t.is_established()]
+        if len(established) > 0:
+            tunnels = established
+        healthy = [t for t in tunnels if not t.is_degraded()]
+        if len(healthy) > 0:
+            tunnels = healthy
+        return tunnels
+
+    def _token(self, tunnel):
+        token = self._tokens.get(id(tunnel))
+        if token is None:
+            if len(self._tokens) > 4 * len(self._pool.get_tunnels()) + 16:
+                alive = set(id(t) for t in self._pool.get_tunnels())
+                self._tokens = dict((k, v) for k, v in self._tokens.items() if k in alive)
+            token = self._tokens[id(tunnel)] = random.getrandbits(64)
+        return token
+
+    def _choose(self, key):
+        tunnels = self._candidates()
+        if len(tunnels) == 0:
+            # opens one, what is sent meanwhile is queued
+            return self._pool.get()
+        if len(tunnels) > self._choices:
+            tunnels = sorted(tunnels, key=lambda t: _weight(key, self._token(t)), reverse=True)[:self._choices]
+        return min(tunnels, key=lambda t: (t.get_outstanding(), self._flows.get(id(t), 0)))
+
+    def get_stats(self):
+        return {
+            'flows': len(self._affinity),
+            'placed': self._placed,
+            'moved': self._moved
+        }
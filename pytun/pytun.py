@@ -4,12 +4,19 @@ import event
 import getopt
 from acceptor import Acceptor
 from dgram import Dgram
+from nonblocking import NonBlocking
 from tundevice import TunDevice
 
+import autoscaler
 import tcptun
+import tunnel
 import udptun
 import tuntun
 from tunnel import Tunnel
+from autoscaler import Autoscaler
+from worker import Supervisor
+from loopstats import LoopStats
+from budget import BufferBudget
 
 import loglevel
 _logger = loglevel.get_logger('main')
@@ -51,20 +58,59 @@ def acceptor_on_closed(_self):
     sys.exit(-1)
 
 
+accepted_tunnels = [0]
+# ms between the logs of every tunnel's round trip time, loss and throughput
+TUNNEL_STATS_INTERVAL = 60 * 1000
+acceptors = []
+# backlog, accepts per iteration, concurrent streams, accepts per second
+acceptor_limits = {}
+
+
+def new_acceptor(prefix):
+    acceptor = Acceptor(prefix)
+    if 'max_accepts' in acceptor_limits:
+        acceptor.set_max_accepts(acceptor_limits['max_accepts'])
+    if 'max_streams' in acceptor_limits:
+        acceptor.set_max_streams(acceptor_limits['max_streams'])
+    if 'rate' in acceptor_limits:
+        acceptor.set_accept_rate(acceptor_limits['rate'])
+    acceptors.append(acceptor)
+    return acceptor
+
+
+def listen(acceptor):
+    if 'backlog' in acceptor_limits:
+        acceptor.listen(acceptor_limits['backlog'])
+    else:
+        acceptor.listen()
+
+
 def server_side_on_accepted(sock, _):
-    tunnel = Tunnel(connection=sock)
-    tunnel.initialize()
+    accepted_tunnels[0] += 1
+    tunnel_ = Tunnel(connection=sock)
+    tunnel_.initialize()
 
 
-_helpText = '''Usage:
-Connect Side: -C from/via/to/{tcp,udp,tun},...
-Accept Side: -A addr0:port0,addr1:port1,...'''
+def schedule_tunnel_stats():
+    def dump(_):
+        Tunnel.dump_stats()
+        Autoscaler.dump_stats()
+        schedule_tunnel_stats()
 
+    event.Event.add_timer(TUNNEL_STATS_INTERVAL).set_handler(dump)
 
-if __name__ == '__main__':
+
+def init_event_backend(edge_triggered, use_asyncio=False, loop_stats=False):
+    if loop_stats:
+        event.Event.set_stats(LoopStats())
+    if use_asyncio:
+        import aioloop
+        aioloop.AsyncioLoop.init()
+        _logger.debug("asyncio")
+        return
     try:
         import epoll
-        epoll.Epoll.init()
+        epoll.Epoll.init(edge_triggered)
         _logger.debug("epoll")
     except:
         try:
@@ -74,11 +120,94 @@ if __name__ == '__main__':
         except:
             raise Exception("Failed to init")
 
+
+def start_accept_side(server_list, reuse_port=False):
+    for addr, port, _, _ in server_list:
+        acceptor = new_acceptor('TUNNEL')
+        if reuse_port:
+            acceptor.set_reuse_port()
+        if tunnel.FAST_OPEN:
+            acceptor.set_fast_open()
+        acceptor.bind(addr, port)
+        listen(acceptor)
+        acceptor.set_on_accepted(server_side_on_accepted)
+        acceptor.set_on_closed(acceptor_on_closed)
+
+
+def process_budget_argument(argument):
+    # soft:hard in MiB
+    soft, hard = argument.split(':')
+    return int(soft) * 1024 * 1024, int(hard) * 1024 * 1024
+
+
+def process_coalesce_argument(argument):
+    # bytes[:ms]
+    values = argument.split(':')
+    delay = int(values[1]) if len(values) > 1 else 0
+    return int(values[0]), delay
+
+
+def process_autoscale_argument(argument):
+    # min:max
+    values = argument.split(':')
+    return int(values[0]), int(values[1]) if len(values) > 1 else int(values[0])
+
+
+def get_worker_stats():
+    tunnels = Tunnel.get_live_tunnels()
+    stats = {
+        'accepted': accepted_tunnels[0],
+        'timers': len(event.Event._timers),
+        'tunnels': len(tunnels),
+        'degraded_tunnels': sum(1 for t in tunnels if t.is_degraded())
+    }
+    for acceptor in acceptors:
+        for key, value in acceptor.get_stats().items():
+            key = 'acceptor_' + key
+            stats[key] = stats.get(key, 0) + value
+    budget = NonBlocking._budget
+    if budget is not None:
+        stats['queued'] = budget.get_total()
+        stats['held'] = budget.get()['held']
+    return stats
+
+
+_helpText = '''Usage:
+Connect Side: -C from/via/to/{tcp,udp,tun},...
+Accept Side: -A addr0:port0,addr1:port1,...
+Options:
+    -e  use edge-triggered epoll
+    -a  use asyncio (uvloop if installed) as event backend
+    -s  log event loop and tunnel statistics every minute
+    -r  read into a shared receive buffer
+    -w  number of accept side worker processes
+    -m  soft:hard limits in MiB of the data queued for sending, process wide
+    -b  listen backlog
+    -k  maximum connections accepted per loop iteration
+    -c  maximum concurrent connections per listening address
+    -t  maximum connections accepted per second per listening address
+    -p  number of tcp tunnels kept connected in advance, connect side
+    -P  min:max tunnels per destination sized by load, without -p
+    -f  use TCP Fast Open for the tunnels
+    -u  receive and send udp datagrams in batches with recvmmsg/sendmmsg
+    -g  bytes[:ms] of tunnel frames encoded at once, 0 disables it
+    -S  spread a fast tcp connection over up to this many pooled tunnels
+    -z  do not compress what goes through the tunnels'''
+
+
+if __name__ == '__main__':
     server_list = []
     accept_mode = False
     connect_mode = False
+    edge_triggered = False
+    use_asyncio = False
+    loop_stats = False
+    workers = 0
+    budget_limits = None
+    pool_size = 0
+    stripes = 1
 
-    optlist, args = getopt.getopt(sys.argv[1:], 'A:C:h')
+    optlist, args = getopt.getopt(sys.argv[1:], 'A:C:easrw:m:b:k:c:t:p:P:fug:S:zh')
     for cmd, arg in optlist:
         if cmd == '-A':
             accept_mode = True
@@ -90,6 +219,40 @@ if __name__ == '__main__':
             if accept_mode is True:
                 raise Exception('Already in Accept Mode')
             server_list = process_connect_side_argument(arg)
+        if cmd == '-e':
+            edge_triggered = True
+        if cmd == '-a':
+            use_asyncio = True
+        if cmd == '-s':
+            loop_stats = True
+        if cmd == '-r':
+            NonBlocking.enable_receive_buffer()
+        if cmd == '-w':
+            workers = int(arg)
+        if cmd == '-m':
+            budget_limits = process_budget_argument(arg)
+        if cmd == '-b':
+            acceptor_limits['backlog'] = int(arg)
+        if cmd == '-k':
+            acceptor_limits['max_accepts'] = int(arg)
+        if cmd == '-c':
+            acceptor_limits['max_streams'] = int(arg)
+        if cmd == '-t':
+            acceptor_limits['rate'] = int(arg)
+        if cmd == '-p':
+            pool_size = int(arg)
+        if cmd == '-P':
+            autoscaler.MIN_TUNNELS, autoscaler.MAX_TUNNELS = process_autoscale_argument(arg)
+        if cmd == '-f':
+            tunnel.FAST_OPEN = True
+        if cmd == '-u':
+            Dgram.enable_batch()
+        if cmd == '-S':
+            stripes = int(arg)
+        if cmd == '-g':
+            tunnel.COALESCE_BYTES, tunnel.COALESCE_DELAY = process_coalesce_argument(arg)
+        if cmd == '-z':
+            tunnel.COMPRESSION = False
         if cmd == '-h':
             print(_helpText)
             sys.exit(0)
@@ -98,27 +261,51 @@ if __name__ == '__main__':
         print(_helpText)
         sys.exit(0)
 
+    if stripes > 1:
+        # the stripes are pooled tunnels
+        pool_size = max(pool_size, stripes)
+
+    if workers > 0 and not accept_mode:
+        raise Exception('Workers are only supported in Accept Mode')
+
     Tunnel.set_tcp_fin_received_handler(tcptun.on_stream_fin_received)
     Tunnel.set_tcp_closed_handler(tcptun.on_stream_closed)
     Tunnel.set_udp_closed_handler(udptun.on_dgram_closed)
     if accept_mode:
         Tunnel.set_tcp_initial_handler(tcptun.on_server_side_initialized)
         Tunnel.set_udp_initial_handler(udptun.on_server_side_initialized)
+        Tunnel.set_stripe_join_handler(tcptun.on_stream_joined)
+        Tunnel.set_stripe_leave_handler(tcptun.on_stream_left)
+
+    if budget_limits is not None:
+        # forked workers get a copy each, so the limits are per process
+        NonBlocking.set_budget(BufferBudget(*budget_limits))
+
+    if workers > 0:
 
-    for addr, port, type_, arg in server_list:
-        if accept_mode:
-            acceptor = Acceptor('TUNNEL')
-            acceptor.bind(addr, port)
-            acceptor.listen()
-            acceptor.set_on_accepted(server_side_on_accepted)
-            acceptor.set_on_closed(acceptor_on_closed)
-        else:
+        def on_worker_start():
+            init_event_backend(edge_triggered, use_asyncio, loop_stats)
+            if loop_stats:
+                schedule_tunnel_stats()
+            start_accept_side(server_list, reuse_port=True)
+            return get_worker_stats
+
+        Supervisor(workers, on_worker_start).run()
+
+    init_event_backend(edge_triggered, use_asyncio, loop_stats)
+    if loop_stats:
+        schedule_tunnel_stats()
+
+    if accept_mode:
+        start_accept_side(server_list)
+    else:
+        for addr, port, type_, arg in server_list:
             via, to = arg
             if type_ == 'tcp':
-                acceptor = Acceptor('TCP')
+                acceptor = new_acceptor('TCP')
                 acceptor.bind(addr, port)
-                acceptor.listen()
-                acceptor.set_on_accepted(tcptun.gen_on_client_side_accepted(via, to))
+                listen(acceptor)
+                acceptor.set_on_accepted(tcptun.gen_on_client_side_accepted(via, to, pool_size, stripes))
                 acceptor.set_on_closed(acceptor_on_closed)
             elif type_ == 'udp':
                 receiver = Dgram()
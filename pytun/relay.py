@@ -0,0 +1,190 @@
+import os
+import fcntl
+import errno
+import socket
+import traceback
+from event import Event
+import syscall
+
+import loglevel
+_logger = loglevel.get_logger('relay')
+_logger.setLevel(loglevel.DEFAULT_LEVEL)
+
+
+PIPE_SIZE = 256 * 1024
+_SPLICE_FLAGS = syscall.SPLICE_F_MOVE | syscall.SPLICE_F_NONBLOCK
+
+
+def _new_event(fd, write, handler, name):
+    ev = Event()
+    ev.set_write(write)
+    ev.set_fd(fd)
+    ev.set_handler(handler)
+    ev.set_name(name)
+    return ev
+
+
+def _set_event(ev, wanted):
+    if wanted:
+        if not Event.isEventSet(ev):
+            Event.addEvent(ev)
+    elif Event.isEventSet(ev):
+        Event.delEvent(ev)
+
+
+class _Direction(object):
+    """src socket -> pipe -> dst socket, `prefix` is written to dst first"""
+
+    def __init__(self, src, dst, prefix):
+        self.src = src
+        self.dst = dst
+        self.prefix = prefix
+        self.pipe_r, self.pipe_w = os.pipe()
+        for fd in (self.pipe_r, self.pipe_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        try:
+            fcntl.fcntl(self.pipe_w, syscall.F_SETPIPE_SZ, PIPE_SIZE)
+        except IOError:
+            pass
+        try:
+            self.capacity = fcntl.fcntl(self.pipe_w, syscall.F_GETPIPE_SZ)
+        except IOError:
+            self.capacity = 2 ** 16
+        self.in_pipe = 0
+        self.eof = False
+        self.done = False
+        self.moved = 0
+
+    def wants_read(self):
+        return not self.eof and self.in_pipe < self.capacity
+
+    def wants_write(self):
+        return self.in_pipe > 0 or len(self.prefix) > 0
+
+    def pump(self, src_ev, dst_ev):
+        """moves what it can, False once the relay has to be closed"""
+        while True:
+            progress = False
+            if self.wants_read():
+                try:
+                    moved = syscall.splice(self.src.fileno(), self.pipe_w,
+                                           self.capacity - self.in_pipe, _SPLICE_FLAGS)
+                except OSError as ex:
+                    if ex.errno != errno.EAGAIN:
+                        _logger.debug('splice from fd: %d, %s', self.src.fileno(), ex.strerror)
+                        return False
+                    Event.eventDrained(src_ev)
+                else:
+                    if moved == 0:
+                        self.eof = True
+                    self.in_pipe += moved
+                    progress = True
+
+            if len(self.prefix) > 0:
+                try:
+                    sent = self.dst.send(self.prefix)
+                except socket.error as ex:
+                    if ex.errno != errno.EAGAIN:
+                        _logger.debug('send to fd: %d, %s', self.dst.fileno(), ex.strerror)
+                        return False
+                    Event.eventDrained(dst_ev)
+                    return True
+                self.prefix = self.prefix[sent:]
+                if len(self.prefix) > 0:
+                    continue
+
+            if self.in_pipe > 0:
+                try:
+                    moved = syscall.splice(self.pipe_r, self.dst.fileno(), self.in_pipe, _SPLICE_FLAGS)
+                except OSError as ex:
+                    if ex.errno != errno.EAGAIN:
+                        _logger.debug('splice to fd: %d, %s', self.dst.fileno(), ex.strerror)
+                        return False
+                    Event.eventDrained(dst_ev)
+                    return True
+                self.in_pipe -= moved
+                self.moved += moved
+                progress = True
+
+            if self.eof and self.in_pipe == 0:
+                if not self.done:
+                    self.done = True
+                    try:
+                        self.dst.shutdown(socket.SHUT_WR)
+                    except socket.error:
+                        pass
+                return True
+            if not progress:
+                return True
+
+    def close(self):
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+
+class SpliceRelay(object):
+    """Relays two connected Streams in both directions with splice(), the
+    data goes through a pipe inside the kernel and is never copied into
+    python. The Streams have to be idle, neither receiving nor having
+    anything queued, the relay takes their sockets over and closes both
+    Streams once both directions are shut down or either one fails.
+    """
+
+    @staticmethod
+    def is_supported():
+        return syscall.splice is not None
+
+    def __init__(self, front, back, prefix=''):
+        self._front = front
+        self._back = back
+        a = front._fd
+        b = back._fd
+        self._forward = _Direction(a, b, prefix)
+        self._backward = _Direction(b, a, '')
+        self._a_rev = _new_event(a.fileno(), False, lambda ev: self._pump(self._forward), 'relay receive')
+        self._a_wev = _new_event(a.fileno(), True, lambda ev: self._pump(self._backward), 'relay send')
+        self._b_rev = _new_event(b.fileno(), False, lambda ev: self._pump(self._backward), 'relay receive')
+        self._b_wev = _new_event(b.fileno(), True, lambda ev: self._pump(self._forward), 'relay send')
+        self._closed = False
+
+    def __str__(self):
+        return 'RELAY: %s <-> %s' % (str(self._front), str(self._back))
+
+    def start(self):
+        _logger.debug('%s, start', str(self))
+        self._pump(self._forward)
+        self._pump(self._backward)
+
+    def _pump(self, direction):
+        if self._closed:
+            return
+        if direction is self._forward:
+            src_ev, dst_ev = self._a_rev, self._b_wev
+        else:
+            src_ev, dst_ev = self._b_rev, self._a_wev
+        try:
+            ok = direction.pump(src_ev, dst_ev)
+        except Exception as ex:
+            _logger.error('%s, pump: %s', str(self), str(ex))
+            _logger.error('%s', traceback.format_exc())
+            ok = False
+        if not ok or (self._forward.done and self._backward.done):
+            self.close()
+            return
+        _set_event(src_ev, direction.wants_read())
+        _set_event(dst_ev, direction.wants_write())
+
+    def get_moved(self):
+        return self._forward.moved, self._backward.moved
+
+    def close(self):
+        if self._closed:
+            return
+        _logger.debug('%s, close, %d/%d bytes relayed', str(self), *self.get_moved())
+        self._closed = True
+        for ev in (self._a_rev, self._a_wev, self._b_rev, self._b_wev):
+            _set_event(ev, False)
+        self._forward.close()
+        self._backward.close()
+        self._front.close()
+        self._back.close()
@@ -0,0 +1,179 @@
+import os
+import errno
+import fcntl
+import socket
+import threading
+import traceback
+from collections import deque
+from event import Event
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import loglevel
+_logger = loglevel.get_logger('resolver')
+_logger.setLevel(loglevel.DEFAULT_LEVEL)
+
+
+RESOLVER_THREADS = 4
+# getaddrinfo does not tell the record's ttl, so seconds of our own
+POSITIVE_TTL = 300
+NEGATIVE_TTL = 30
+CACHE_SIZE = 4096
+
+
+def is_address(host):
+    try:
+        socket.inet_pton(socket.AF_INET, host)
+        return True
+    except (socket.error, ValueError):
+        return False
+
+
+class Resolver(object):
+    """Resolves host names without blocking the event loop.
+
+    getaddrinfo runs on a few threads, results and failures are cached for
+    a while and concurrent lookups of the same name wait for one query.
+    The threads hand their results back through a pipe the event loop
+    watches, so the callbacks always run on the loop.
+    """
+
+    def __init__(self, threads=RESOLVER_THREADS):
+        self._threads = threads
+        self._started = False
+        self._queries = queue.Queue()
+        self._results = deque()
+        # host -> callbacks waiting for it
+        self._pending = {}
+        # host -> (expire time, address, error)
+        self._cache = {}
+
+        self._read_fd, self._write_fd = os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._rev = Event()
+        self._rev.set_write(False)
+        self._rev.set_fd(self._read_fd)
+        self._rev.set_handler(lambda ev: self._on_wakeup())
+        self._rev.set_name('resolver')
+
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._failures = 0
+
+    def resolve(self, host, callback):
+        """callback(address, error) gets an IPv4 address or an error message,
+        right away if host is an address or cached"""
+        if is_address(host):
+            callback(host, None)
+            return
+
+        cached = self._cache.get(host)
+        if cached is not None:
+            expire, address, error = cached
+            if expire > Event.now():
+                self._hits += 1
+                callback(address, error)
+                return
+            del self._cache[host]
+
+        if host in self._pending:
+            self._coalesced += 1
+            self._pending[host].append(callback)
+            return
+
+        self._misses += 1
+        self._pending[host] = [callback]
+        if not Event.isEventSet(self._rev):
+            Event.addEvent(self._rev)
+        self._start()
+        self._queries.put(host)
+
+    def _start(self):
+        if self._started:
+            return
+        self._started = True
+        for _ in range(self._threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            host = self._queries.get()
+            try:
+                infos = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)
+                result = (host, infos[0][4][0], None)
+            except (socket.error, UnicodeError) as ex:
+                result = (host, None, str(ex))
+            self._results.append(result)
+            try:
+                os.write(self._write_fd, 'x')
+            except OSError as ex:
+                # full, the loop has not been woken up yet anyway
+                if ex.errno != errno.EAGAIN:
+                    raise
+
+    def _on_wakeup(self):
+        while True:
+            try:
+                if len(os.read(self._read_fd, 4096)) == 0:
+                    break
+            except OSError as ex:
+                if ex.errno != errno.EAGAIN:
+                    raise
+                Event.eventDrained(self._rev)
+                break
+
+        now = Event.now()
+        while len(self._results) > 0:
+            host, address, error = self._results.popleft()
+            if error is None:
+                self._cache_result(host, now + POSITIVE_TTL, address, None)
+            else:
+                _logger.warning('failed to resolve %s: %s', host, error)
+                self._failures += 1
+                self._cache_result(host, now + NEGATIVE_TTL, None, error)
+            for callback in self._pending.pop(host, []):
+                try:
+                    callback(address, error)
+                except Exception as ex:
+                    _logger.error('resolve callback: %s', str(ex))
+                    _logger.error('%s', traceback.format_exc())
+
+        if len(self._pending) == 0 and Event.isEventSet(self._rev):
+            Event.delEvent(self._rev)
+
+    def _cache_result(self, host, expire, address, error):
+        if len(self._cache) >= CACHE_SIZE:
+            now = Event.now()
+            for name, cached in self._cache.items():
+                if cached[0] <= now:
+                    del self._cache[name]
+            if len(self._cache) >= CACHE_SIZE:
+                self._cache.clear()
+        self._cache[host] = (expire, address, error)
+
+    def get_stats(self):
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'coalesced': self._coalesced,
+            'failures': self._failures,
+            'cached': len(self._cache),
+            'pending': len(self._pending)
+        }
+
+
+_resolver = None
+
+
+def get_resolver():
+    """the process wide Resolver, created once the event loop is set up"""
+    global _resolver
+    if _resolver is None:
+        _resolver = Resolver()
+    return _resolver
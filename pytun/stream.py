@@ -2,16 +2,30 @@ import os
 import socket
 import errno
 import traceback
+import syscall
 from event import Event
 from nonblocking import NonBlocking
+from resolver import is_address, get_resolver
 
 import loglevel
 _logger = loglevel.get_logger('stream')
 _logger.setLevel(loglevel.DEFAULT_LEVEL)
 
 
+MSG_FASTOPEN = getattr(socket, 'MSG_FASTOPEN', 0x20000000)
+# queued bytes handed to the kernel with a fast open connect, what does not
+# fit into the SYN is sent after the handshake
+FAST_OPEN_DATA = 16 * 1024
+# errors of a kernel without client side fast open: refused by the sysctl,
+# or MSG_FASTOPEN not known and sendto() on an unconnected socket
+_FAST_OPEN_REFUSED = (errno.EOPNOTSUPP, errno.ENOTCONN, errno.EPIPE)
+
+
 class Stream(NonBlocking):
 
+    # set once the kernel refused a fast open, later connects go without
+    _fast_open_refused = False
+
     def __init__(self, conn=None, prefix=None):
         if conn is None:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -31,6 +45,8 @@ class Stream(NonBlocking):
             self._fd.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
 
         self._onConnected = None
+        self._vectored = syscall.sendv is not None
+        self._fast_open = False
 
     def set_cong_algorithm(self, algorithm):
         tcp_congestion = getattr(socket, 'TCP_CONGESTION', 13)
@@ -42,6 +58,12 @@ class Stream(NonBlocking):
     def set_on_connected(self, on_connected):
         self._onConnected = on_connected
 
+    def set_fast_open(self):
+        """connect() sends what is queued by the end of the next loop
+        iteration along with the SYN (TCP Fast Open), if the kernel refuses
+        the connect goes on as usual"""
+        self._fast_open = True
+
     def _check_connected(self):
         _logger.debug('_check_connected')
         err = self._fd.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
@@ -73,6 +95,75 @@ class Stream(NonBlocking):
             return
 
         self._wev.set_handler(lambda ev: self._check_connected())
+        if not is_address(addr):
+            get_resolver().resolve(addr, lambda address, error: self._on_resolved(addr, address, error, port))
+            return
+        self._connect_address(addr, port)
+
+    def _on_resolved(self, host, address, error, port):
+        if self.is_closed():
+            return
+        if error is not None:
+            _logger.error('fd: %d, connect to %s: %s', self._fd.fileno(), host, error)
+            self._error = True
+            self._do_close()
+            return
+        self._connect_address(address, port)
+
+    def _connect_address(self, addr, port):
+        if self._fast_open and not Stream._fast_open_refused:
+            # let the caller queue the first bytes before connecting, and the
+            # poll of the next iteration read what its peer sent already, a
+            # request reaching the SYN saves the round trip of the handshake
+            Event.call_soon(lambda ev: Event.add_timer(0).set_handler(
+                lambda ev_: self._connect_fast_open(addr, port)))
+            return
+        self._connect(addr, port)
+
+    def _connect_fast_open(self, addr, port):
+        _logger.debug('_connect_fast_open')
+        if self.is_closed():
+            return
+
+        chunks = []
+        size = 0
+        for data, _ in self._to_send:
+            if data is None or size >= FAST_OPEN_DATA:
+                break
+            chunks.append(data)
+            size += len(data)
+        if len(chunks) == 0 or Stream._fast_open_refused:
+            self._connect(addr, port)
+            return
+
+        data = ''.join(chunks)
+        try:
+            _logger.debug('fast open to %s:%d with %d bytes', addr, port, len(data))
+            sent = self._fd.sendto(data, MSG_FASTOPEN, (addr, port))
+        except socket.error as msg:
+            if msg.errno == errno.EAGAIN or msg.errno == errno.EINPROGRESS:
+                # connecting, the data goes after the handshake
+                Event.addEvent(self._wev)
+            else:
+                # nothing is sent yet, the queued data goes after the connect
+                _logger.info('fd: %d, fast open: %s, connect without',
+                             self._fd.fileno(), os.strerror(msg.errno))
+                if msg.errno in _FAST_OPEN_REFUSED:
+                    Stream._fast_open_refused = True
+                self._connect(addr, port)
+            return
+
+        for _ in chunks:
+            self._to_send.popleft()
+        if sent < len(data):
+            self._to_send.appendleft((data[sent:], None))
+        self._to_send_bytes -= sent
+        if NonBlocking._budget is not None:
+            NonBlocking._budget.sent(self, sent)
+        Event.addEvent(self._wev)
+        self._check_watermarks()
+
+    def _connect(self, addr, port):
         try:
             _logger.debug('connecting to %s:%d', addr, port)
             self._fd.connect((addr, port))
@@ -85,8 +176,7 @@ class Stream(NonBlocking):
             else:
                 Event.addEvent(self._wev)
         else:
-            timer = Event.add_timer(0)
-            timer.set_handler(lambda ev: self._wev.get_handler()(self._wev))
+            Event.call_soon(lambda ev: self._wev.get_handler()(self._wev))
 
     def set_non_blocking(self):
         self._fd.setblocking(False)
@@ -103,11 +193,21 @@ class Stream(NonBlocking):
         _logger.debug('fd: %d sent %d bytes', self._fd.fileno(), sent)
         return sent
 
+    def _sendv(self, chunks, offset):
+        sent = syscall.sendv(self._fd, chunks, offset)
+        _logger.debug('fd: %d sent %d bytes from %d chunks', self._fd.fileno(), sent, len(chunks))
+        return sent
+
     def _recv(self, size):
         recv = self._fd.recv(size)
         _logger.debug('fd: %d recv %d bytes', self._fd.fileno(), len(recv))
         return recv, None
 
+    def _recv_into(self, buff):
+        size = self._fd.recv_into(buff)
+        _logger.debug('fd: %d recv %d bytes', self._fd.fileno(), size)
+        return size, None
+
     def _send_fin(self):
         self._fd.shutdown(socket.SHUT_WR)
 
@@ -0,0 +1,221 @@
+import struct
+from event import Event
+
+import loglevel
+_logger = loglevel.get_logger('stripe')
+_logger.setLevel(loglevel.DEFAULT_LEVEL)
+
+
+# a stream is spread over up to this many tunnels
+MAX_STRIPES = 4
+# seconds between looks at how fast the stream goes on every tunnel
+STRIPE_INTERVAL = 0.5
+# streams slower than this, bytes/s, are not spread any further
+MIN_STRIPE_RATE = 512 * 1024
+# a tunnel added is kept if the stream got this much faster
+GROWTH_RATIO = 1.1
+# after an addition that did not pay off, no more for this many intervals
+PLATEAU_INTERVALS = 20
+# tunnels slower than this share of the fastest one are left
+SLOW_RATIO = 0.25
+# bytes received out of order kept per stream, the stream fails beyond
+MAX_REORDER_BYTES = 8 * 1024 * 1024
+
+
+def pack_end(seq):
+    """fin and closed frames of a striped stream tell where it ends"""
+    return struct.pack('!Q', seq)
+
+
+def unpack_end(data):
+    if len(data) != 8:
+        return None
+    return struct.unpack('!Q', data)[0]
+
+
+class Stripe(object):
+    """A stream's payload spread over several tunnels.
+
+    Every frame gets a sequence number and goes to the tunnel having the
+    least of this stream queued, so the faster tunnels take more of it. The
+    receiving side puts the frames back in order, keeping up to
+    MAX_REORDER_BYTES of them. The side which opened the stream adapts the
+    number of tunnels: while the stream is fast it adds one, keeps it if
+    that made the stream faster, and leaves tunnels falling far behind the
+    fastest one. The first tunnel is never left, the fin and closed frames
+    go there telling where the stream ends.
+    """
+
+    def __init__(self, id_, tunnel, on_data):
+        self._id = id_
+        self._primary = tunnel
+        # the tunnels frames are sent on, and all ever used
+        self._tunnels = [tunnel]
+        self._joined = [tunnel]
+        self._on_data = on_data
+        self._next_send = 0
+        self._next_receive = 0
+        # seq -> data received ahead
+        self._reorder = {}
+        self._reorder_bytes = 0
+        # [(seq, handler)] run once everything before seq is delivered
+        self._ends = []
+
+        self._candidates = None
+        self._on_join = None
+        self._on_leave = None
+        self._max_stripes = MAX_STRIPES
+        # id(tunnel) -> bytes sent and received on it, and at the last look
+        self._assigned = {id(tunnel): 0}
+        self._received = {id(tunnel): 0}
+        self._counted = {id(tunnel): 0}
+        self._last_look = Event.now()
+        self._rate_before = None
+        self._plateau = 0
+
+    def __str__(self):
+        return 'STRIPE: %s(%d)' % (str(self._id), len(self._tunnels))
+
+    def set_adaptive(self, candidates, on_join, on_leave, max_stripes=MAX_STRIPES):
+        """candidates() lists the tunnels which may be added, on_join(tunnel)
+        and on_leave(tunnel) tell the other side"""
+        self._candidates = candidates
+        self._on_join = on_join
+        self._on_leave = on_leave
+        self._max_stripes = max_stripes
+
+    def get_tunnels(self):
+        return list(self._joined)
+
+    def get_primary(self):
+        return self._primary
+
+    def add(self, tunnel):
+        if any(t is tunnel for t in self._tunnels):
+            return
+        self._tunnels.append(tunnel)
+        if not any(t is tunnel for t in self._joined):
+            self._joined.append(tunnel)
+        for counter in (self._assigned, self._received, self._counted):
+            counter.setdefault(id(tunnel), 0)
+
+    def remove(self, tunnel):
+        if tunnel is self._primary:
+            return
+        self._tunnels = [t for t in self._tunnels if t is not tunnel]
+
+    def _pick(self):
+        tunnels = [t for t in self._tunnels if not t.is_closed()]
+        if len(tunnels) == 0:
+            return self._primary
+        ready = [t for t in tunnels if t.is_ready_to_send(self._id)]
+        if len(ready) > 0:
+            tunnels = ready
+        return min(tunnels, key=lambda t: t.get_queued(self._id))
+
+    def send(self, data):
+        tunnel = self._pick()
+        tunnel.send_striped_payload(self._id, self._next_send, data)
+        self._next_send += 1
+        self._assigned[id(tunnel)] += len(data)
+        self._adapt()
+
+    def get_end(self):
+        return pack_end(self._next_send)
+
+    def is_ready_to_send(self):
+        return any(t.is_ready_to_send(self._id) for t in self._tunnels)
+
+    def received(self, tunnel, seq, data):
+        """False once too much is waiting for a missing frame"""
+        key = id(tunnel)
+        if key in self._received:
+            self._received[key] += len(data)
+        if seq == self._next_receive:
+            self._deliver(data)
+            while self._next_receive in self._reorder:
+                data = self._reorder.pop(self._next_receive)
+                self._reorder_bytes -= len(data)
+                self._deliver(data)
+            self._run_ends()
+        elif seq > self._next_receive:
+            self._reorder[seq] = data
+            self._reorder_bytes += len(data)
+            if self._reorder_bytes > MAX_REORDER_BYTES:
+                _logger.warning('%s, %d bytes waiting for frame %d',
+                                str(self), self._reorder_bytes, self._next_receive)
+                return False
+        self._adapt()
+        return True
+
+    def _deliver(self, data):
+        self._next_receive += 1
+        self._on_data(data)
+
+    def finish(self, seq, handler):
+        """handler() once the frames before seq are delivered"""
+        self._ends.append((seq, handler))
+        self._run_ends()
+
+    def _run_ends(self):
+        while len(self._ends) > 0 and self._ends[0][0] <= self._next_receive:
+            _, handler = self._ends.pop(0)
+            handler()
+
+    def _adapt(self):
+        if self._candidates is None:
+            return
+        # the bytes moved are counted up to now, not the loop's wake up
+        now = Event.update_time()
+        elapsed = now - self._last_look
+        if elapsed < STRIPE_INTERVAL:
+            return
+        self._last_look = now
+
+        rates = {}
+        for tunnel in self._tunnels:
+            key = id(tunnel)
+            moved = self._assigned[key] - tunnel.get_queued(self._id) + self._received[key]
+            rates[key] = (moved - self._counted[key]) / elapsed
+            self._counted[key] = moved
+        for tunnel in self._joined:
+            if id(tunnel) not in rates:
+                key = id(tunnel)
+                self._counted[key] = self._assigned[key] - tunnel.get_queued(self._id) + self._received[key]
+        rate = sum(rates.values())
+
+        if self._rate_before is not None:
+            if rate < self._rate_before * GROWTH_RATIO:
+                _logger.debug('%s, %d -> %d bytes/s, leave the last one', str(self), self._rate_before, rate)
+                self._leave(self._tunnels[-1])
+                self._plateau = PLATEAU_INTERVALS
+            self._rate_before = None
+            return
+
+        if len(self._tunnels) > 1:
+            fastest = max(rates.values())
+            slowest = min(self._tunnels[1:], key=lambda t: rates[id(t)])
+            if rates[id(slowest)] < fastest * SLOW_RATIO:
+                _logger.debug('%s, %s too slow', str(self), str(slowest))
+                self._leave(slowest)
+                return
+
+        if self._plateau > 0:
+            self._plateau -= 1
+            return
+        if rate < MIN_STRIPE_RATE or len(self._tunnels) >= self._max_stripes:
+            return
+        for tunnel in self._candidates():
+            if tunnel.supports_striping() and not tunnel.is_degraded() and \
+                    not any(t is tunnel for t in self._tunnels):
+                _logger.debug('%s, at %d bytes/s, add %s', str(self), rate, str(tunnel))
+                self._rate_before = rate
+                self.add(tunnel)
+                self._on_join(tunnel)
+                break
+
+    def _leave(self, tunnel):
+        if tunnel is self._primary:
+            return
+        self.remove(tunnel)
+        self._on_leave(tunnel)
@@ -0,0 +1,258 @@
+import os
+import socket
+import ctypes
+import ctypes.util
+
+import loglevel
+_logger = loglevel.get_logger('syscall')
+_logger.setLevel(loglevel.DEFAULT_LEVEL)
+
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (ValueError, OSError, AttributeError):
+    IOV_MAX = 1024
+
+
+class IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+def _load_libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError as ex:
+        _logger.warning('failed to load libc: %s', str(ex))
+        return None
+
+
+_libc = _load_libc()
+
+
+def _address_of(data):
+    """(address of the bytes of data, what has to be kept alive while it is
+    used); a str or a bytearray is not copied, a memoryview is"""
+    if isinstance(data, str):
+        return ctypes.cast(data, ctypes.c_void_p).value, data
+    if isinstance(data, bytearray):
+        buffer_ = (ctypes.c_char * len(data)).from_buffer(data)
+        return ctypes.addressof(buffer_), buffer_
+    if isinstance(data, memoryview):
+        # no address of a view through ctypes on python 2, nor of a read
+        # only one
+        copied = data.tobytes()
+        return ctypes.cast(copied, ctypes.c_void_p).value, copied
+    raise TypeError('no address of the bytes of a %s' % type(data).__name__)
+
+
+def fill_iovec(iov, chunks, offset):
+    """points iov at chunks, skipping `offset` bytes of the first one,
+    returns what has to be kept alive, with the chunks, while iov is in
+    use"""
+    kept = []
+    for i, data in enumerate(chunks):
+        skip = offset if i == 0 else 0
+        address, keep = _address_of(data)
+        kept.append(keep)
+        iov[i].iov_base = address + skip
+        iov[i].iov_len = len(data) - skip
+    return kept
+
+
+def _raise_errno(error_type):
+    err = ctypes.get_errno()
+    raise error_type(err, os.strerror(err))
+
+
+def _gen_sendv():
+    if hasattr(socket.socket, 'sendmsg'):
+        def sendv(sock, chunks, offset):
+            buffers = [memoryview(chunks[0])[offset:]] + chunks[1:]
+            return sock.sendmsg(buffers)
+        return sendv
+
+    if _libc is None or not hasattr(_libc, 'writev'):
+        return None
+    writev = _libc.writev
+    writev.argtypes = [ctypes.c_int, ctypes.POINTER(IOVec), ctypes.c_int]
+    writev.restype = ctypes.c_ssize_t
+
+    def sendv(sock, chunks, offset):
+        # one per call, nothing is shared between the callers
+        iov = (IOVec * len(chunks))()
+        # alive until writev returns
+        kept = fill_iovec(iov, chunks, offset)
+        sent = writev(sock.fileno(), iov, len(chunks))
+        if sent < 0:
+            _raise_errno(socket.error)
+        return sent
+    return sendv
+
+
+# sendv(sock, chunks, offset) writes chunks with one syscall, None if unsupported
+sendv = _gen_sendv()
+
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+
+
+def _gen_splice():
+    if hasattr(os, 'splice'):
+        def splice(fd_in, fd_out, size, flags):
+            return os.splice(fd_in, fd_out, size, flags=flags)
+        return splice
+
+    if _libc is None or not hasattr(_libc, 'splice'):
+        return None
+    splice_ = _libc.splice
+    splice_.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                        ctypes.c_size_t, ctypes.c_uint]
+    splice_.restype = ctypes.c_ssize_t
+
+    def splice(fd_in, fd_out, size, flags):
+        moved = splice_(fd_in, None, fd_out, None, size, flags)
+        if moved < 0:
+            _raise_errno(OSError)
+        return moved
+    return splice
+
+
+# splice(fd_in, fd_out, size, flags) moves data between a pipe and a file
+# inside the kernel, None if unsupported
+splice = _gen_splice()
+
+
+class SockaddrIn(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_ubyte * 2),
+                ('sin_addr', ctypes.c_ubyte * 4), ('sin_zero', ctypes.c_ubyte * 8)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(IOVec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+def _new_sockaddr(addr):
+    host, port = addr
+    sockaddr = SockaddrIn()
+    sockaddr.sin_family = socket.AF_INET
+    sockaddr.sin_port[0] = port >> 8
+    sockaddr.sin_port[1] = port & 0xff
+    ctypes.memmove(sockaddr.sin_addr, socket.inet_aton(host), 4)
+    return sockaddr, ctypes.addressof(sockaddr)
+
+
+def _load_mmsg():
+    if _libc is None or not hasattr(_libc, 'recvmmsg') or not hasattr(_libc, 'sendmmsg'):
+        return None, None
+    recvmmsg = _libc.recvmmsg
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg = _libc.sendmmsg
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+
+_recvmmsg, _sendmmsg = _load_mmsg()
+_MSG_TRUNC = getattr(socket, 'MSG_TRUNC', 0x20)
+
+
+class MessageBatch(object):
+    """Preallocated headers, addresses and buffers for recvmmsg/sendmmsg of
+    up to `count` IPv4 datagrams at once."""
+
+    @staticmethod
+    def is_supported():
+        return _recvmmsg is not None
+
+    def __init__(self, count, size):
+        self._count = count
+        self._size = size
+        self._msgs = (MMsgHdr * count)()
+        self._addrs = (SockaddrIn * count)()
+        self._iov = (IOVec * count)()
+        self._buffer = ctypes.create_string_buffer(count * size)
+        self._base = ctypes.addressof(self._buffer)
+        self._hdrs = [self._msgs[i].msg_hdr for i in range(count)]
+        for i in range(count):
+            hdr = self._hdrs[i]
+            hdr.msg_namelen = ctypes.sizeof(SockaddrIn)
+            hdr.msg_iov = ctypes.pointer(self._iov[i])
+            hdr.msg_iovlen = 1
+        # send() points the headers at what it sends
+        self._on_buffer = False
+        # (addr, port) -> (sockaddr_in, its address), peers are few and keep sending
+        self._peers = {}
+        self._received = 0
+
+    def get_count(self):
+        return self._count
+
+    def get_received(self):
+        """datagrams the last recv() took, the dropped ones too"""
+        return self._received
+
+    def recv(self, fd):
+        """[(data, (addr, port)), ...] without the truncated ones, raises
+        socket.error"""
+        if not self._on_buffer:
+            for i in range(self._count):
+                self._hdrs[i].msg_name = ctypes.addressof(self._addrs[i])
+                self._iov[i].iov_base = self._base + i * self._size
+                self._iov[i].iov_len = self._size
+            self._on_buffer = True
+        for hdr in self._hdrs:
+            hdr.msg_namelen = ctypes.sizeof(SockaddrIn)
+        received = _recvmmsg(fd, self._msgs, self._count, 0, None)
+        if received < 0:
+            _raise_errno(socket.error)
+        self._received = received
+        packets = []
+        for i in range(received):
+            addr = self._addrs[i]
+            port = addr.sin_port[0] << 8 | addr.sin_port[1]
+            from_ = (socket.inet_ntoa(ctypes.string_at(addr.sin_addr, 4)), port)
+            # the datagram did not fit, a cut one is no use to the peer
+            if self._hdrs[i].msg_flags & _MSG_TRUNC:
+                _logger.warning('fd: %d drop datagram from %s:%d longer than %d bytes',
+                                fd, from_[0], from_[1], self._size)
+                continue
+            data = ctypes.string_at(self._base + i * self._size, self._msgs[i].msg_len)
+            packets.append((data, from_))
+        return packets
+
+    def send(self, fd, packets):
+        """sends the first `count` of [(data, (addr, port)), ...], returns how
+        many went out, raises socket.error"""
+        count = min(len(packets), self._count)
+        self._on_buffer = False
+        peers = self._peers
+        # alive until sendmmsg returns
+        kept = []
+        for i in range(count):
+            data, addr = packets[i]
+            peer = peers.get(addr)
+            if peer is None:
+                if len(peers) >= 4096:
+                    peers.clear()
+                peer = peers[addr] = _new_sockaddr(addr)
+            self._hdrs[i].msg_name = peer[1]
+            iov = self._iov[i]
+            address, keep = _address_of(data)
+            kept.append(keep)
+            iov.iov_base = address
+            iov.iov_len = len(data)
+        sent = _sendmmsg(fd, self._msgs, count, 0)
+        if sent < 0:
+            _raise_errno(socket.error)
+        return sent
@@ -1,158 +1,271 @@
 import json
 import uuid
 from stream import Stream
-from tunnel import Tunnel
+from tunnelpool import TunnelPool
+from placement import Placement
+import autoscaler
+from stripe import Stripe, unpack_end
 
 import loglevel
 _logger = loglevel.get_logger('tcptun', loglevel.DEFAULT_LEVEL)
 
 
-key_to_tunnels = {}
+# accept side endpoints of striped streams, the tunnels joining find them here
+striped_endpoints = {}
 
 
-def gen_on_client_side_accepted(via, to):
+def _on_client_side_tunnel_received(tunnel, id_, data):
+    endpoint = tunnel.get_connection(id_)
+    if endpoint is None:
+        _logger.warning('connection: %s has gone, %d bytes data not sent', str(id_), len(data))
+    else:
+        endpoint.send(data)
+
+
+def _on_client_side_tunnel_ready_to_send(tunnel):
+    _logger.debug('%s tunnel ready to send', str(tunnel))
+    for endpoint in tunnel.connections.values():
+        endpoint.start_receiving()
+
+
+def on_tunnel_striped_received(tunnel, id_, seq, data):
+    endpoint = tunnel.get_connection(id_)
+    if endpoint is None or endpoint.stripe is None:
+        _logger.warning('striped connection: %s has gone, %d bytes data not sent', str(id_), len(data))
+    elif not endpoint.stripe.received(tunnel, seq, data):
+        endpoint.close()
+
+
+def _stripe_send(endpoint, tunnel, data):
+    if endpoint.stripe is not None:
+        endpoint.stripe.send(data)
+        return endpoint.stripe.is_ready_to_send()
+    tunnel.send_payload(endpoint.uuid, data)
+    return tunnel.is_ready_to_send(endpoint.uuid)
+
+
+def _stripe_end(endpoint):
+    return '' if endpoint.stripe is None else endpoint.stripe.get_end()
+
+
+def _stripe_deregister(endpoint, tunnel):
+    tunnels = [tunnel] if endpoint.stripe is None else endpoint.stripe.get_tunnels()
+    for tunnel_ in tunnels:
+        tunnel_.deregister(endpoint.uuid)
+
+
+def on_tunnel_stream_ready_to_send(tunnel, id_):
+    endpoint = tunnel.get_connection(id_)
+    if endpoint is not None:
+        endpoint.start_receiving()
+
+
+def _on_client_side_tunnel_send_buffer_full(tunnel):
+    _logger.debug('%s tunnel full', str(tunnel))
+    for endpoint in tunnel.connections.values():
+        endpoint.stop_receiving()
+
+
+def _on_client_side_tunnel_closed(tunnel):
+    _logger.debug('%s tunnel closed', str(tunnel))
+    for endpoint in tunnel.connections.values():
+        endpoint.close()
+    tunnel.clear_connections()
+
+
+def prepare_client_side_tunnel(tunnel):
+    tunnel.set_on_ready_to_send(_on_client_side_tunnel_ready_to_send)
+    tunnel.set_on_send_buffer_full(_on_client_side_tunnel_send_buffer_full)
+    tunnel.set_on_stream_ready_to_send(on_tunnel_stream_ready_to_send)
+    tunnel.set_on_payload(_on_client_side_tunnel_received)
+    tunnel.set_on_striped_payload(on_tunnel_striped_received)
+    tunnel.set_on_closed(_on_client_side_tunnel_closed)
+
+
+def gen_on_client_side_accepted(via, to, pool_size=0, stripes=1):
+    """connections are placed on the tunnels of a TunnelPool; with
+    pool_size > 0 it has that many tunnels connected right away, otherwise
+    the first client opens autoscaler.MIN_TUNNELS and the load may take
+    them up to autoscaler.MAX_TUNNELS; with stripes > 1 too, a fast
+    connection is spread over up to that many of them"""
 
     initial_data = json.dumps({
         'addr': to[0],
         'port': to[1]
     })
+    striped_initial_data = json.dumps({
+        'addr': to[0],
+        'port': to[1],
+        'stripe': True
+    })
+
+    if pool_size > 0:
+        pool = TunnelPool(via, pool_size)
+    else:
+        pool = TunnelPool(via, autoscaler.MIN_TUNNELS, autoscaler.MAX_TUNNELS)
+    pool.set_on_tunnel_created(prepare_client_side_tunnel)
+    pool.set_on_tunnel_closed(_on_client_side_tunnel_closed)
+    placement_ = Placement(pool)
+    if pool_size > 0:
+        placement_.start()
 
     def on_accepted(endpoint, from_):
 
         def on_received(self_, data, _):
-            tunnel.send_payload(self_.uuid, data)
-            return tunnel.is_ready_to_send()
+            return _stripe_send(self_, tunnel, data)
 
         def on_fin_received(self_):
             if not self_.is_closed():
-                tunnel.send_tcp_fin_data(self_.uuid)
+                tunnel.send_tcp_fin_data(self_.uuid, _stripe_end(self_))
 
         def on_closed(self_):
-            tunnel.send_tcp_closed_data(self_.uuid)
-            tunnel.deregister(self_.uuid)
-
-        def on_tunnel_received(_, id_, data):
-            endpoint_ = tunnel.get_connection(id_)
-            if endpoint_ is None:
-                _logger.warning('connection: %s has gone, %d bytes data not sent', str(id_), len(data))
-            else:
-                endpoint_.send(data)
-
-        def on_tunnel_ready_to_send(_):
-            _logger.debug('%s tunnel ready to send', str(tunnel))
-            for endpoint_ in tunnel.connections.values():
-                endpoint_.start_receiving()
-
-        def on_tunnel_send_buffer_full(_):
-            _logger.debug('%s tunnel full', str(tunnel))
-            for endpoint_ in tunnel.connections.values():
-                endpoint_.stop_receiving()
-
-        def on_tunnel_closed(_):
-            _logger.debug('%s tunnel closed', str(tunnel))
-            for endpoint_ in tunnel.connections.values():
-                endpoint_.close()
-            tunnel.clear_connections()
+            tunnel.send_tcp_closed_data(self_.uuid, _stripe_end(self_))
+            _stripe_deregister(self_, tunnel)
+            placement_.release(self_.uuid)
 
-        endpoint.uuid = uuid.uuid4()
+        def on_join(tunnel_):
+            # left ones stay registered, for what was on its way
+            if tunnel_.get_connection(endpoint.uuid) is None:
+                tunnel_.register(endpoint.uuid, endpoint)
+            tunnel_.send_stripe_join(endpoint.uuid)
 
-        key = endpoint.uuid.int % 67
+        def on_leave(tunnel_):
+            tunnel_.send_stripe_leave(endpoint.uuid)
 
-        tunnel = None
-        if key in key_to_tunnels:
-            tunnel = key_to_tunnels[key]
-        if tunnel is None or tunnel.is_closed():
-            tunnel = Tunnel(connect_to=via)
-            tunnel.set_on_ready_to_send(on_tunnel_ready_to_send)
-            tunnel.set_on_send_buffer_full(on_tunnel_send_buffer_full)
-            tunnel.set_on_payload(on_tunnel_received)
-            tunnel.set_on_closed(on_tunnel_closed)
-            tunnel.initialize()
-            key_to_tunnels[key] = tunnel
+        endpoint.uuid = uuid.uuid4()
+
+        tunnel = placement_.get(endpoint.uuid)
 
         tunnel.register(endpoint.uuid, endpoint)
+        endpoint.stripe = None
+        if pool_size > 0 and stripes > 1 and tunnel.supports_striping():
+            endpoint.stripe = Stripe(endpoint.uuid, tunnel, endpoint.send)
+            endpoint.stripe.set_adaptive(pool.get_tunnels, on_join, on_leave, stripes)
 
         endpoint.set_on_received(on_received)
         endpoint.set_on_fin_received(on_fin_received)
         endpoint.set_on_closed(on_closed)
         endpoint.start_receiving()
 
-        tunnel.send_tcp_initial_data(endpoint.uuid, initial_data)
+        tunnel.send_tcp_initial_data(endpoint.uuid,
+                                     initial_data if endpoint.stripe is None else striped_initial_data)
 
         _logger.debug("socket from %s:%d (%s) connected", from_[0], from_[1], str(endpoint))
 
     return on_accepted
 
 
+def _on_server_side_tunnel_received(tunnel, id_, data):
+    endpoint = None
+    if id_ in tunnel.connections:
+        endpoint = tunnel.connections[id_]
+    if endpoint is None:
+        _logger.warning('connection: %s has gone, %d bytes data not sent', str(id_), len(data))
+    else:
+        endpoint.send(data)
+
+
+def _on_server_side_tunnel_ready_to_send(tunnel):
+    _logger.debug('%s tunnel ready to send', str(tunnel))
+    for endpoint in tunnel.connections.values():
+        endpoint.start_receiving()
+
+
+def _on_server_side_tunnel_send_buffer_full(tunnel):
+    _logger.debug('%s tunnel full', str(tunnel))
+    for endpoint in tunnel.connections.values():
+        endpoint.stop_receiving()
+
+
+def _on_server_side_tunnel_closed(tunnel):
+    _logger.debug('%s tunnel closed', str(tunnel))
+    for endpoint in tunnel.connections.values():
+        endpoint.close()
+    tunnel.clear_connections()
+
+
+def prepare_server_side_tunnel(tunnel):
+    tunnel.set_on_ready_to_send(_on_server_side_tunnel_ready_to_send)
+    tunnel.set_on_send_buffer_full(_on_server_side_tunnel_send_buffer_full)
+    tunnel.set_on_stream_ready_to_send(on_tunnel_stream_ready_to_send)
+    tunnel.set_on_payload(_on_server_side_tunnel_received)
+    tunnel.set_on_striped_payload(on_tunnel_striped_received)
+    tunnel.set_on_closed(_on_server_side_tunnel_closed)
+
+
 def on_server_side_initialized(tunnel, id_, initial_data):
 
     def on_received(self_, data, _):
-        tunnel.send_payload(self_.uuid, data)
-        return tunnel.is_ready_to_send()
+        return _stripe_send(self_, tunnel, data)
 
     def on_fin_received(self_):
-        tunnel.send_tcp_fin_data(self_.uuid)
+        tunnel.send_tcp_fin_data(self_.uuid, _stripe_end(self_))
 
     def on_closed(self_):
-        tunnel.send_tcp_closed_data(self_.uuid)
-        tunnel.deregister(self_.uuid)
-
-    def on_tunnel_received(_, id__, data):
-        endpoint_ = None
-        if id__ in tunnel.connections:
-            endpoint_ = tunnel.connections[id__]
-        if endpoint_ is None:
-            _logger.warning('connection: %s has gone, %d bytes data not sent', str(id__), len(data))
-        else:
-            endpoint_.send(data)
-
-    def on_tunnel_ready_to_send(_):
-        _logger.debug('%s tunnel ready to send', str(tunnel))
-        for endpoint_ in tunnel.connections.values():
-            endpoint_.start_receiving()
-
-    def on_tunnel_send_buffer_full(_):
-        _logger.debug('%s tunnel full', str(tunnel))
-        for endpoint_ in tunnel.connections.values():
-            endpoint_.stop_receiving()
-
-    def on_tunnel_closed(_):
-        _logger.debug('%s tunnel closed', str(tunnel))
-        for endpoint_ in tunnel.connections.values():
-            endpoint_.close()
-        tunnel.clear_connections()
+        tunnel.send_tcp_closed_data(self_.uuid, _stripe_end(self_))
+        _stripe_deregister(self_, tunnel)
+        striped_endpoints.pop(self_.uuid, None)
+
+    json_data = json.loads(initial_data)
+    address, port = json_data['addr'], json_data['port']
 
     endpoint = Stream(prefix='TCP')
     endpoint.uuid = id_
+    endpoint.stripe = None
+    if json_data.get('stripe', False):
+        endpoint.stripe = Stripe(id_, tunnel, endpoint.send)
+        striped_endpoints[id_] = endpoint
 
     tunnel.register(endpoint.uuid, endpoint)
-
-    tunnel.set_on_ready_to_send(on_tunnel_ready_to_send)
-    tunnel.set_on_send_buffer_full(on_tunnel_send_buffer_full)
-    tunnel.set_on_payload(on_tunnel_received)
-    tunnel.set_on_closed(on_tunnel_closed)
+    prepare_server_side_tunnel(tunnel)
 
     endpoint.set_on_received(on_received)
     endpoint.set_on_fin_received(on_fin_received)
     endpoint.set_on_closed(on_closed)
 
-    json_data = json.loads(initial_data)
-    address, port = json_data['addr'], json_data['port']
     endpoint.connect(address, port)
     _logger.debug('connect to: %s:%d (%s)', address, port, str(endpoint))
 
 
-def on_stream_fin_received(tunnel_, id_, _):
+def on_stream_joined(tunnel_, id_, _):
+    endpoint = striped_endpoints.get(id_)
+    if endpoint is None:
+        _logger.warning('no such striped connection: %s', str(id_))
+        return
+    _logger.debug("(%s) %s joined by %s", str(endpoint), str(id_), str(tunnel_))
+    if tunnel_.get_connection(id_) is None:
+        tunnel_.register(id_, endpoint)
+    prepare_server_side_tunnel(tunnel_)
+    endpoint.stripe.add(tunnel_)
+
+
+def on_stream_left(tunnel_, id_, _):
+    endpoint = tunnel_.get_connection(id_)
+    if endpoint is not None and endpoint.stripe is not None:
+        _logger.debug("(%s) %s left by %s", str(endpoint), str(id_), str(tunnel_))
+        endpoint.stripe.remove(tunnel_)
+
+
+def _when_delivered(endpoint, data, handler):
+    # striped frames still on their way over the other tunnels go first
+    end = unpack_end(data)
+    if end is not None and getattr(endpoint, 'stripe', None) is not None:
+        endpoint.stripe.finish(end, handler)
+    else:
+        handler()
+
+
+def on_stream_fin_received(tunnel_, id_, data):
     endpoint = tunnel_.get_connection(id_)
     if endpoint is not None:
         _logger.debug("(%s) %s fin received", str(endpoint), str(id_))
-        endpoint.shutdown()
+        _when_delivered(endpoint, data, endpoint.shutdown)
     else:
         _logger.warning('no such tcp connection: %s', str(id_))
 
 
-def on_stream_closed(tunnel_, id_, _):
+def on_stream_closed(tunnel_, id_, data):
     endpoint = tunnel_.get_connection(id_)
     if endpoint is not None:
         _logger.debug("(%s) %s closed by other side", str(endpoint), str(id_))
-        endpoint.close()
+        _when_delivered(endpoint, data, endpoint.close)
@@ -0,0 +1,124 @@
+import time
+
+import loglevel
+_logger = loglevel.get_logger('timerwheel')
+_logger.setLevel(loglevel.DEFAULT_LEVEL)
+
+
+TICK = 0.01
+SLOTS = 4096
+# give up scanning for the next timer after this many empty slots
+MAX_SCAN = 500
+
+
+class TimingWheel(object):
+    """Hashed timing wheel.
+
+    Every timer lives in the slot of its deadline tick, keyed by the timer
+    itself, so cancelling is a dict deletion. Timers further away than one
+    revolution share slots with nearer ones and are skipped until their
+    deadline tick is reached. No timer expires before its deadline, the
+    slot of the current tick is looked at again until it has none left.
+
+    Against a heap, adding and cancelling cost more, a dict per slot, and
+    expiring less; cancelled timers do not stay queued.
+    """
+
+    def __init__(self, tick=TICK, slots=SLOTS, now=None):
+        self._tick = tick
+        self._slots = [{} for _ in range(slots)]
+        self._peaks = [0] * slots
+        self._size = 0
+        if now is None:
+            now = time.time()
+        # last tick whose slot has been processed, the slot after it may
+        # hold timers of its tick still waiting for their deadline
+        self._current = int(now / tick)
+        self._compactions = 0
+
+    def __len__(self):
+        return self._size
+
+    def _to_tick(self, timestamp):
+        return int(timestamp / self._tick)
+
+    def add(self, timer, deadline):
+        tick = self._to_tick(deadline)
+        if tick <= self._current:
+            # due in a tick already processed, its slot is looked at again
+            tick = self._current
+            self._current = tick - 1
+        index = tick % len(self._slots)
+        slot = self._slots[index]
+        slot[timer] = deadline
+        if len(slot) > self._peaks[index]:
+            self._peaks[index] = len(slot)
+        self._size += 1
+        return index
+
+    def remove(self, timer, index):
+        slot = self._slots[index]
+        if timer in slot:
+            del slot[timer]
+            self._size -= 1
+
+    def next_timeout(self, now, default):
+        if self._size == 0:
+            return default
+        slots = self._slots
+        count = len(slots)
+        scan = min(count, MAX_SCAN)
+        for i in range(1, scan + 1):
+            slot = slots[(self._current + i) % count]
+            if len(slot) == 0:
+                continue
+            tick = self._current + i
+            # the ones of later revolutions are not due yet
+            deadlines = [deadline for deadline in slot.itervalues() if self._to_tick(deadline) <= tick]
+            if len(deadlines) > 0:
+                return max(min(deadlines) - now, 0)
+        return default
+
+    def expire(self, now):
+        """Detach and return every timer whose deadline has passed,
+        ordered by deadline."""
+        target = self._to_tick(now)
+        if target <= self._current:
+            return []
+
+        slots = self._slots
+        count = len(slots)
+        expired = []
+        steps = min(target - self._current, count)
+        for i in range(1, steps + 1):
+            index = (self._current + i) % count
+            slot = slots[index]
+            if len(slot) == 0:
+                continue
+            due = [(deadline, timer) for timer, deadline in slot.iteritems() if deadline <= now]
+            for _, timer in due:
+                del slot[timer]
+            expired.extend(due)
+            self._compact(index)
+        self._current = target
+        # later in the current tick, the slot is looked at again
+        for deadline in slots[target % count].itervalues():
+            if self._to_tick(deadline) == target:
+                self._current = target - 1
+                break
+        self._size -= len(expired)
+
+        expired.sort(key=lambda item: item[0])
+        return [timer for _, timer in expired]
+
+    def _compact(self, index):
+        # dicts never shrink on deletion, rebuild the ones left mostly empty
+        slot = self._slots[index]
+        peak = self._peaks[index]
+        if peak > 64 and len(slot) * 4 < peak:
+            self._slots[index] = dict(slot)
+            self._peaks[index] = len(slot)
+            self._compactions += 1
+
+    def get_compactions(self):
+        return self._compactions
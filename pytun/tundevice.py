@@ -1,4 +1,6 @@
 import os
+import io
+import errno
 import fcntl
 import subprocess
 import struct
@@ -70,6 +72,7 @@ class TunDevice(NonBlocking):
         #subprocess.check_call(cmd, shell=True)
 
         NonBlocking.__init__(self, FileWrapper(fd), 'TUN')
+        self._file = io.FileIO(fd, 'r', closefd=False)
         self._connected = True
         self._decoders = [self._ReceiveHandlerContext(self._ipv4_decoder)]
 
@@ -96,5 +99,12 @@ class TunDevice(NonBlocking):
         _logger.debug('%s, read %d bytes', str(self), len(recv))
         return recv, None
 
+    def _recv_into(self, buff):
+        size = self._file.readinto(buff)
+        if size is None:
+            raise OSError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        _logger.debug('%s, read %d bytes', str(self), size)
+        return size, None
+
     def _close(self):
         os.close(self._fd.fileno())
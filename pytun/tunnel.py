@@ -1,6 +1,10 @@
+from collections import deque
 from stream import Stream
 from event import Event
+from relay import SpliceRelay
 import obscure
+import compression
+import linkstats
 import struct
 import uuid
 
@@ -12,6 +16,94 @@ BUFF_SIZE = 1024 ** 2
 UNKNOWN_CONN_ADDR = "127.0.0.1"
 UNKNOWN_CONN_PORT = 8000
 HEARTBEAT_INTERVAL = 60 * 1000
+# v5 tunnels carrying streams are pinged this often, ms, idle ones every
+# HEARTBEAT_INTERVAL
+PING_INTERVAL = 1000
+# relay non tunnel clients to the unknown connection with splice() if possible
+SPLICE_RELAY = True
+# connect side tunnels send their first frames with the SYN
+FAST_OPEN = False
+# highest frame format offered and accepted, 1 talks like the old peers do,
+# 3 is 2 with striped streams, 4 is 3 with compressed chunks, 5 is 4 with
+# heartbeats answered, 6 is 5 with idle stream ids unbound
+FRAME_VERSION = 6
+# v6 stream ids not used for this long, ms, are unbound and bound again, the
+# flows of datagrams and packets are never closed
+STREAM_ID_IDLE = 5 * 60 * 1000
+# stream ids unbound by a heartbeat at most
+UNBIND_BATCH = 1024
+# v4 chunks of frames are compressed, unless they look compressed already
+COMPRESSION = True
+# v2 frames sent during a loop iteration go through the encoders at once,
+# earlier when this many bytes are collected, 0 disables it
+COALESCE_BYTES = 16 * 1024
+# ms to keep collecting, 0 sends them once the loop is idle
+COALESCE_DELAY = 0
+# frames of the streams are queued per stream and handed to the tunnel's
+# Stream by deficit round robin, so a bulk stream does not hold up the others
+FAIR_QUEUEING = True
+# bytes a stream may send per round
+QUANTUM = 16 * 1024
+# a stream with more queued is no longer ready to send, until half of it left
+STREAM_WINDOW = 256 * 1024
+# the Stream gets frames until this many bytes are queued in it
+SCHEDULE_HIGH = 64 * 1024
+SCHEDULE_LOW = 16 * 1024
+# the tunnel is no longer ready to send above this in all stream queues
+QUEUE_HIGH = 4 * 1024 * 1024
+QUEUE_LOW = 1024 * 1024
+
+# the versions are negotiated with heartbeats carrying this, old peers ignore
+# what a heartbeat carries
+_VERSION_MAGIC = 'PTv'
+# highest frame version this side decodes, and the version of the frames
+# following the switch
+_VERSION_OFFER = 0
+_VERSION_SWITCH = 1
+# v4, the codecs this side decompresses, a bitmask in place of the version
+_VERSION_CODECS = 2
+# v5 heartbeats, a ping carries its sequence number and the time it was sent,
+# the pong echoes both
+_PING_MAGIC = 'PTi'
+_PONG_MAGIC = 'PTo'
+_PING_FORMAT = '!Id'
+_PING_SIZE = struct.calcsize(_PING_FORMAT)
+# v6 heartbeats, stream ids no longer sent with by the side which bound them,
+# the peer forgets them and echoes them back, after which they are free
+_UNBIND_MAGIC = 'PTu'
+_NIL_UUID = uuid.UUID(int=0)
+
+
+def _pack_varint(value):
+    packed = ''
+    while value >= 0x80:
+        packed += chr(value & 0x7f | 0x80)
+        value >>= 7
+    return packed + chr(value)
+
+
+def _unpack_varint(data, offset):
+    value = 0
+    shift = 0
+    while shift < 64:
+        if offset >= len(data):
+            break
+        byte = ord(data[offset])
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+    raise Exception('corrupted data')
+
+
+class _StreamQueue(object):
+
+    def __init__(self):
+        self.frames = deque()
+        self.bytes = 0
+        self.deficit = 0
+        self.paused = False
 
 
 class Tunnel(object):
@@ -21,8 +113,17 @@ class Tunnel(object):
     _UDP_INITIAL_DATA = 3
     _UDP_CLOSED_DATA = 4
     _TUN_INITIAL_DATA = 5
+    _STRIPE_JOIN = 6
+    _STRIPE_LEAVE = 7
     _PAYLOAD = 10
+    _STRIPED_PAYLOAD = 11
     _HEARTBEAT = 100
+    # v2 frames binding a stream id to a uuid have it after the header
+    _BIND = 0x80
+    _CLOSED_TYPES = (_TCP_CLOSED_DATA, _UDP_CLOSED_DATA)
+
+    # id(tunnel) -> tunnel, the initialized ones not closed yet
+    _live = {}
 
     _static_handlers = {
         _HEARTBEAT: (lambda _, __, ___: None)
@@ -52,20 +153,70 @@ class Tunnel(object):
     def set_tun_initial_handler(handler):
         Tunnel._static_handlers[Tunnel._TUN_INITIAL_DATA] = handler
 
+    @staticmethod
+    def set_stripe_join_handler(handler):
+        Tunnel._static_handlers[Tunnel._STRIPE_JOIN] = handler
+
+    @staticmethod
+    def set_stripe_leave_handler(handler):
+        Tunnel._static_handlers[Tunnel._STRIPE_LEAVE] = handler
+
     def __init__(self, connection=None, connect_to=None):
         self._stream = connection
         self._connect_to = connect_to
         self._on_initial_data = None
         self._on_payload = None
+        self._on_striped_payload = None
         self._on_stream_closed = None
         self._handlers = self._static_handlers.copy()
         self._handlers.update({
-            Tunnel._PAYLOAD: lambda _, id_, data: self._on_payload(self, id_, data)
+            Tunnel._PAYLOAD: lambda _, id_, data: self._on_payload(self, id_, data),
+            Tunnel._STRIPED_PAYLOAD: lambda _, id_, data: self._on_striped(id_, data),
+            Tunnel._HEARTBEAT: lambda _, __, data: self._on_heartbeat(data)
         })
         self._on_ready_to_send = None
         self._on_send_buffer_full = None
+        self._on_connected = None
+        self._established = connection is not None
         self._hb_event = None
         self.connections = {}
+        self._send_version = 1
+        self._receive_version = 1
+        # v2 stream ids, the connect side binds odd ones, the accept side even
+        self._next_id = 1 if connect_to is not None else 2
+        self._ids = {}
+        self._uuids = {}
+        # v6, the stream ids sent or received with since the last sweep, the
+        # own ones the peer is asked to forget, and the ones it did
+        self._sids_used = set()
+        self._unbinding = set()
+        self._free_ids = []
+        self._last_sweep = Event.now()
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_ev = None
+        self._coalesce_bytes = COALESCE_BYTES
+        self._coalesce_delay = COALESCE_DELAY
+        self._fair = FAIR_QUEUEING
+        # id -> _StreamQueue, and the ids having frames in round robin order
+        self._queues = {}
+        self._active = deque()
+        # the first active stream got its quantum for this round already
+        self._in_turn = False
+        self._scheduling = False
+        self._queued_bytes = 0
+        self._queue_full = False
+        self._on_stream_ready_to_send = None
+        self._compression = COMPRESSION
+        self._compress = None
+        self._decompress = compression.gen_decompress()
+        # chunk bytes before and after compression, and chunks left raw
+        self._raw_bytes = 0
+        self._compressed_bytes = 0
+        self._incompressible = 0
+        self._link = linkstats.LinkStats(Event.now())
+        self._ping_seq = 0
+        self._last_heartbeat = Event.now()
 
     def __hash__(self):
         return hash(self._stream)
@@ -79,11 +230,32 @@ class Tunnel(object):
         return str(self._stream)
 
     def _send_heartbeat(self):
-        self._send_content(Tunnel._HEARTBEAT, None, None)
+        # the ping carries when it left, not when the loop woke up
+        now = Event.update_time()
+        busy = self._link.is_busy() or len(self.connections) > 0
+        if self._link.tick(now) > 0 and self._link.is_degraded():
+            _logger.warning('%s, %d pings in a row lost', str(self), linkstats.DEGRADED_TIMEOUTS)
+        if self._send_version >= 5 and (busy or now - self._last_heartbeat >= HEARTBEAT_INTERVAL / 1000.0):
+            self._ping_seq = (self._ping_seq + 1) & 0xffffffff
+            self._link.ping_sent(self._ping_seq, now)
+            self._send_content(Tunnel._HEARTBEAT, None, _PING_MAGIC + struct.pack(_PING_FORMAT, self._ping_seq, now))
+            self._last_heartbeat = now
+        elif self._send_version < 5:
+            self._send_content(Tunnel._HEARTBEAT, None, None)
+            self._last_heartbeat = now
+        if now - self._last_sweep >= STREAM_ID_IDLE / 1000.0:
+            self._last_sweep = now
+            self._unbind_idle()
         self._enable_heartbeat()
 
     def _enable_heartbeat(self):
-        self._hb_event = Event.add_timer(HEARTBEAT_INTERVAL)
+        # peers below v5 do not answer pings, they get a heartbeat per
+        # HEARTBEAT_INTERVAL and no timer more often
+        if self._send_version >= 5:
+            interval = min(PING_INTERVAL, HEARTBEAT_INTERVAL)
+        else:
+            interval = HEARTBEAT_INTERVAL
+        self._hb_event = Event.add_timer(interval)
         self._hb_event.set_handler(lambda ev: self._send_heartbeat())
 
     def _disable_heartbeat(self):
@@ -101,6 +273,9 @@ class Tunnel(object):
 
         # self._stream.set_buffer_size(BUFF_SIZE)
         self._stream.set_tcp_no_delay()
+        if self._fair:
+            # little is queued in the Stream, the rest waits in fair order
+            self._stream.set_watermarks(SCHEDULE_HIGH, SCHEDULE_LOW)
 
         self._stream.append_send_handler(obscure.pack_data)
         self._stream.append_send_handler(obscure.random_padding)
@@ -122,12 +297,35 @@ class Tunnel(object):
         self._stream.set_on_closed(lambda _: self._on_closed())
 
         if self._connect_to is not None:
+            if FAST_OPEN:
+                self._stream.set_fast_open()
+            self._stream.set_on_connected(lambda _: self._on_stream_connected())
             self._stream.connect(*self._connect_to)
+            if FRAME_VERSION > 1:
+                self._send_version_frame(_VERSION_OFFER, FRAME_VERSION)
         else:
             self._stream.set_on_decode_error(lambda _, received: self._on_decode_error(received))
             self._stream.start_receiving()
+        Tunnel._live[id(self)] = self
         self._enable_heartbeat()
 
+    def _on_stream_connected(self):
+        self._established = True
+        self._stream.start_receiving()
+        if self._on_connected is not None:
+            self._on_connected(self)
+
+    def set_on_connected(self, handler):
+        self._on_connected = handler
+
+    def is_established(self):
+        return self._established and not self.is_closed()
+
+    def warm_up(self):
+        """sends a heartbeat, so the first frame with the cipher key and the
+        http preamble go out before there is any payload to wait for them"""
+        self._send_content(Tunnel._HEARTBEAT, None, None)
+
     def register(self, key, conn):
         _logger.debug('%s, register: %s(%s)', str(self), str(key), str(conn))
         assert(key not in self.connections)
@@ -149,39 +347,414 @@ class Tunnel(object):
         _logger.debug('%s, clear_connections (%d)', str(self), len(self.connections))
         self.connections.clear()
 
-    def is_ready_to_send(self):
-        return self._stream.is_ready_to_send()
+    def is_ready_to_send(self, id_=None):
+        """whether more can be sent, for the stream `id_` if given; a stream
+        over its window gets on_stream_ready_to_send when it is ready again"""
+        if not self._fair:
+            return self._stream.is_ready_to_send()
+        if self.is_closed() or self._queue_full:
+            return False
+        if id_ is None:
+            return True
+        queue = self._queues.get(id_)
+        return queue is None or not queue.paused
+
+    def get_queued(self, id_):
+        """bytes of the stream `id_` waiting in its queue"""
+        queue = self._queues.get(id_)
+        return 0 if queue is None else queue.bytes
+
+    def get_outstanding(self):
+        """bytes queued in the tunnel and its Stream, not sent yet"""
+        return self._queued_bytes + self._batch_bytes + self._stream.get_send_queued()
+
+    def set_on_stream_ready_to_send(self, handler):
+        """handler(tunnel, id_) once a stream over its window is back below
+        half of it"""
+        self._on_stream_ready_to_send = handler
+
+    def set_fair_queueing(self, fair):
+        """before initialize()"""
+        self._fair = fair
+
+    def _enqueue(self, type_, id_, content):
+        if self.is_closed():
+            # the queues were cleared, nothing would drain them again
+            _logger.debug('%s closed, drop %d bytes of %s', str(self), len(content), str(id_))
+            return
+        queue = self._queues.get(id_)
+        if queue is None:
+            queue = self._queues[id_] = _StreamQueue()
+            self._active.append(id_)
+        queue.frames.append((type_, content))
+        queue.bytes += len(content)
+        self._queued_bytes += len(content)
+        if not queue.paused and queue.bytes > STREAM_WINDOW:
+            _logger.debug('%s, stream %s over its window', str(self), str(id_))
+            queue.paused = True
+        if not self._queue_full and self._queued_bytes > QUEUE_HIGH:
+            self._queue_full = True
+            if self._on_send_buffer_full is not None:
+                self._on_send_buffer_full(self)
+        self._schedule()
+
+    def _schedule(self):
+        """deficit round robin from the stream queues into the Stream, until
+        it is full; on_ready_to_send of the Stream carries on"""
+        if self._scheduling:
+            return
+        self._scheduling = True
+        ready = []
+        try:
+            while len(self._active) > 0 and not self._stream.is_send_buffer_full() and not self.is_closed():
+                id_ = self._active[0]
+                queue = self._queues[id_]
+                if not self._in_turn:
+                    queue.deficit += QUANTUM
+                    self._in_turn = True
+                type_, content = queue.frames[0]
+                if len(content) > queue.deficit:
+                    self._active.rotate(-1)
+                    self._in_turn = False
+                    continue
+
+                queue.frames.popleft()
+                queue.deficit -= len(content)
+                queue.bytes -= len(content)
+                self._queued_bytes -= len(content)
+                self._transmit(type_, id_, content)
+                if queue.paused and queue.bytes <= STREAM_WINDOW / 2:
+                    queue.paused = False
+                    ready.append(id_)
+                if len(queue.frames) == 0:
+                    self._active.popleft()
+                    self._in_turn = False
+                    del self._queues[id_]
+        finally:
+            self._scheduling = False
+
+        if self._queue_full and self._queued_bytes <= QUEUE_LOW and not self.is_closed():
+            self._queue_full = False
+            if self._on_ready_to_send is not None:
+                self._on_ready_to_send(self)
+        if self._on_stream_ready_to_send is not None:
+            for id_ in ready:
+                self._on_stream_ready_to_send(self, id_)
+
+    def _clear_queues(self):
+        self._queues.clear()
+        self._active.clear()
+        self._in_turn = False
+        self._queued_bytes = 0
+
+    def set_coalescing(self, max_bytes, delay=0):
+        """frames are collected until the loop is idle or `delay` ms passed,
+        or max_bytes are, then encoded and queued as one chunk; peers reading
+        v1 only get them one by one, max_bytes 0 always does"""
+        self._coalesce_bytes = max_bytes
+        self._coalesce_delay = delay
+
+    def get_rtt(self):
+        """smoothed round trip time in seconds of the pings, None before the
+        first pong or with peers not answering them"""
+        return self._link.get_rtt()
+
+    def is_degraded(self):
+        """whether the last pings went unanswered"""
+        return self._link.is_degraded()
+
+    def get_stats(self):
+        """round trip time, jitter and throughput in seconds and bytes per
+        second, pings lost, what compression saved and what is queued"""
+        stats = self._link.get()
+        stats.update(self.get_compression_stats())
+        stats['queued'] = self._queued_bytes
+        stats['version'] = self._send_version
+        stats['stream_ids'] = len(self._uuids)
+        return stats
+
+    @staticmethod
+    def get_live_tunnels():
+        return list(Tunnel._live.values())
+
+    @staticmethod
+    def dump_stats():
+        for tunnel in Tunnel._live.values():
+            stats = tunnel.get_stats()
+            rtt = stats['rtt']
+            _logger.info('%s v%d, rtt: %s, jitter: %.1f ms, loss: %.1f%%, timeouts: %d, '
+                         'sent: %d B/s, received: %d B/s, queued: %d%s',
+                         str(tunnel), stats['version'], 'n/a' if rtt is None else '%.1f ms' % (rtt * 1000),
+                         stats['jitter'] * 1000, stats['loss'] * 100, stats['timeouts'],
+                         stats['sent_rate'], stats['received_rate'], stats['queued'],
+                         ', degraded' if stats['degraded'] else '')
+
+    def set_compression(self, enabled):
+        """before the versions are negotiated, whether chunks get compressed
+        and whether the peer may compress"""
+        self._compression = enabled
+
+    def get_compression_stats(self):
+        return {
+            'raw_bytes': self._raw_bytes,
+            'compressed_bytes': self._compressed_bytes,
+            'incompressible': self._incompressible
+        }
+
+    def _send_chunk(self, chunk):
+        # from v4 on, every chunk handed to the Stream starts with its codec
+        if self._send_version >= 4:
+            self._raw_bytes += len(chunk)
+            if self._compress is None:
+                chunk = chr(compression.RAW) + chunk
+            else:
+                chunk = self._compress(chunk)
+                if chunk[0] == chr(compression.RAW):
+                    self._incompressible += 1
+            self._compressed_bytes += len(chunk)
+        self._stream.send(chunk)
+
+    def _send_frame(self, frame):
+        if self._coalesce_bytes <= 0 or self._send_version < 2:
+            self._send_chunk(frame)
+            return
+        self._batch.append(frame)
+        self._batch_bytes += len(frame)
+        if self._batch_bytes >= self._coalesce_bytes:
+            self._flush_batch()
+        elif self._batch_ev is None:
+            if self._coalesce_delay > 0:
+                self._batch_ev = Event.add_timer(self._coalesce_delay)
+                self._batch_ev.set_handler(lambda ev: self._flush_batch())
+            else:
+                self._batch_ev = Event.call_soon(lambda ev: self._flush_batch())
+
+    def _flush_batch(self):
+        if self._batch_ev is not None:
+            self._batch_ev.del_timer()
+            self._batch_ev = None
+        if len(self._batch) == 0:
+            return
+        if len(self._batch) == 1:
+            batch = self._batch[0]
+        else:
+            batch = ''.join(self._batch)
+        self._batch = []
+        self._batch_bytes = 0
+        if not self._stream.is_closed():
+            self._send_chunk(batch)
+
+    def get_frame_version(self):
+        """(sent, received) frame format versions"""
+        return self._send_version, self._receive_version
+
+    def _send_version_frame(self, kind, version):
+        self._send_content(Tunnel._HEARTBEAT, None, _VERSION_MAGIC + chr(kind) + chr(version))
+
+    def _on_heartbeat(self, data):
+        if len(data) == len(_PING_MAGIC) + _PING_SIZE and data.startswith(_PING_MAGIC):
+            self._send_content(Tunnel._HEARTBEAT, None, _PONG_MAGIC + data[len(_PING_MAGIC):])
+            return
+        if len(data) == len(_PONG_MAGIC) + _PING_SIZE and data.startswith(_PONG_MAGIC):
+            seq, sent = struct.unpack(_PING_FORMAT, data[len(_PONG_MAGIC):])
+            # Event.now() is from before the poll which brought the pong
+            rtt = self._link.pong_received(seq, sent, Event.update_time())
+            if rtt is not None:
+                _logger.debug('%s, rtt %.1f ms', str(self), rtt * 1000)
+            return
+        if data.startswith(_UNBIND_MAGIC):
+            self._on_unbind(data)
+            return
+        if len(data) != len(_VERSION_MAGIC) + 2 or not data.startswith(_VERSION_MAGIC):
+            return
+        kind, version = ord(data[-2]), ord(data[-1])
+        _logger.debug('%s, version frame %d: %d', str(self), kind, version)
+        if kind == _VERSION_CODECS:
+            codec = compression.choose(version) if self._compression else None
+            # once, the peer's decompressor keeps the state
+            if codec is not None and self._compress is None:
+                _logger.debug('%s, compress with %d', str(self), codec)
+                self._compress = compression.gen_compress(codec)
+            return
+        if kind == _VERSION_SWITCH:
+            self._receive_version = version
+        # the peer reads what it offers, and what it switched to
+        version = min(version, FRAME_VERSION)
+        if version > self._send_version:
+            self._send_version_frame(_VERSION_SWITCH, version)
+            # the frames after the switch go in a chunk of their own, from
+            # v4 on chunks are not just frames
+            self._flush_batch()
+            self._send_version = version
+            if version >= 5 and self._hb_event is not None:
+                self._disable_heartbeat()
+                self._enable_heartbeat()
+            if version >= 4:
+                self._send_version_frame(_VERSION_CODECS, compression.get_supported() if self._compression else 0)
+
+    def _bind(self, sid, id_):
+        self._uuids[sid] = id_
+        self._ids[id_] = sid
+
+    def _unbind_idle(self):
+        """the own stream ids not used since the last sweep are sent with no
+        more, frames of the peer still on the way are taken until it echoes
+        them"""
+        used = self._sids_used
+        self._sids_used = set()
+        if self._send_version < 6:
+            return
+        parity = self._next_id % 2
+        idle = [sid for sid in self._ids.itervalues() if sid % 2 == parity and sid not in used]
+        for sid in idle:
+            del self._ids[self._uuids[sid]]
+            self._unbinding.add(sid)
+        _logger.debug('%s, unbind %d idle stream ids', str(self), len(idle))
+        self._send_unbind(idle)
+
+    def _send_unbind(self, sids):
+        for i in range(0, len(sids), UNBIND_BATCH):
+            self._send_content(Tunnel._HEARTBEAT, None,
+                               _UNBIND_MAGIC + ''.join(map(_pack_varint, sids[i:i + UNBIND_BATCH])))
+
+    def _on_unbind(self, data):
+        parity = self._next_id % 2
+        offset = len(_UNBIND_MAGIC)
+        echo = []
+        while offset < len(data):
+            sid, offset = _unpack_varint(data, offset)
+            if sid % 2 == parity:
+                # the echo, nothing the peer sent with it is on the way
+                if sid in self._unbinding:
+                    self._unbinding.remove(sid)
+                    self._uuids.pop(sid, None)
+                    self._free_ids.append(sid)
+                continue
+            id_ = self._uuids.pop(sid, None)
+            if id_ is not None and self._ids.get(id_) == sid:
+                del self._ids[id_]
+            echo.append(sid)
+        self._send_unbind(echo)
+
+    def _forget(self, id_):
+        sid = self._ids.pop(id_, None)
+        if sid is not None:
+            self._uuids.pop(sid, None)
 
     def _send_content(self, type_, id_, content):
-        if id_ is None:
-            to_send = struct.pack('!HI', type_, 0) + '\x00' * 16
+        if content is None:
+            content = ''
+        if type_ != Tunnel._HEARTBEAT:
+            self._link.count_sent(len(content))
+        if self._fair and id_ is not None:
+            self._enqueue(type_, id_, content)
+        else:
+            self._transmit(type_, id_, content)
+
+    def _transmit(self, type_, id_, content):
+        # the format is the one at the time the frame leaves its queue
+        if self._send_version == 1:
+            id_bytes = '\x00' * 16 if id_ is None else id_.get_bytes()
+            to_send = struct.pack('!HI', type_, len(content)) + id_bytes + content
+        elif id_ is None:
+            to_send = chr(type_) + '\x00' + _pack_varint(len(content)) + content
         else:
-            to_send = struct.pack('!HI', type_, len(content)) + id_.get_bytes() + content
-        self._stream.send(to_send)
+            # a stream id is bound once, usually by the initial data, the
+            # other side reuses it
+            sid = self._ids.get(id_)
+            if sid is None:
+                if len(self._free_ids) > 0:
+                    sid = self._free_ids.pop()
+                else:
+                    sid = self._next_id
+                    self._next_id += 2
+                self._bind(sid, id_)
+                to_send = chr(type_ | Tunnel._BIND) + _pack_varint(sid) + _pack_varint(len(content)) + \
+                    id_.get_bytes() + content
+            else:
+                to_send = chr(type_) + _pack_varint(sid) + _pack_varint(len(content)) + content
+            self._sids_used.add(sid)
+        self._send_frame(to_send)
+        if type_ in Tunnel._CLOSED_TYPES:
+            self._forget(id_)
 
     def _on_tunnel_ready_to_send(self):
+        if self._fair:
+            self._schedule()
+            return
         if self._on_ready_to_send is not None:
             self._on_ready_to_send(self)
 
     def _on_tunnel_send_buffer_full(self):
+        if self._fair:
+            return
         if self._on_send_buffer_full is not None:
             self._on_send_buffer_full(self)
 
-    def _on_received(self, data, _addr):
-        _logger.debug("tunnel %s received %d bytes" % (str(self), len(data)))
-        if len(data) < 6 + 16:
+    def _unpack_v1(self, data, offset):
+        if len(data) < offset + 6 + 16:
+            raise Exception('corrupted data')
+
+        type_, content_length = struct.unpack_from('!HI', data, offset)
+        id_ = uuid.UUID(bytes=data[offset + 6: offset + 6 + 16])
+
+        end = offset + 6 + 16 + content_length
+        if len(data) < end:
             raise Exception('corrupted data')
 
-        type_, content_length = struct.unpack('!HI', data[: 6])
-        id_ = uuid.UUID(bytes=data[6: 6 + 16])
+        return type_, id_, data[offset + 6 + 16: end], end
+
+    def _unpack_v2(self, data, offset):
+        if len(data) < offset + 3:
+            raise Exception('corrupted data')
 
-        if type_ not in self._handlers or self._handlers[type_] is None:
-            _logger.warning("tunnel message type %d can not be handled", type_)
+        type_ = ord(data[offset])
+        sid, offset = _unpack_varint(data, offset + 1)
+        content_length, offset = _unpack_varint(data, offset)
+        if type_ & Tunnel._BIND:
+            type_ &= ~Tunnel._BIND
+            if len(data) < offset + 16:
+                raise Exception('corrupted data')
+            id_ = uuid.UUID(bytes=data[offset: offset + 16])
+            offset += 16
+            self._bind(sid, id_)
+            self._sids_used.add(sid)
+        elif sid == 0:
+            id_ = _NIL_UUID
+        else:
+            id_ = self._uuids.get(sid)
+            self._sids_used.add(sid)
 
-        if len(data) - 6 - 16 != content_length:
+        end = offset + content_length
+        if len(data) < end:
             raise Exception('corrupted data')
 
-        self._handlers[type_](self, id_, data[6 + 16:])
+        return type_, id_, data[offset: end], end
+
+    def _on_received(self, data, _addr):
+        _logger.debug("tunnel %s received %d bytes" % (str(self), len(data)))
+        if self._receive_version >= 4:
+            data = self._decompress(data)
+        # coalesced v2 frames arrive together
+        offset = 0
+        while offset < len(data) and not self.is_closed():
+            if self._receive_version == 1:
+                type_, id_, content, offset = self._unpack_v1(data, offset)
+            else:
+                type_, id_, content, offset = self._unpack_v2(data, offset)
+                if id_ is None:
+                    # the stream was closed here already
+                    _logger.debug('%s, unknown stream id, drop %d bytes', str(self), len(content))
+                    continue
+
+            if type_ != Tunnel._HEARTBEAT:
+                self._link.count_received(len(content))
+            if type_ not in self._handlers or self._handlers[type_] is None:
+                _logger.warning("tunnel message type %d can not be handled", type_)
+
+            self._handlers[type_](self, id_, content)
+            if type_ in Tunnel._CLOSED_TYPES:
+                self._forget(id_)
 
         return True
 
@@ -206,6 +779,26 @@ class Tunnel(object):
     def send_payload(self, id_, payload):
         self._send_content(Tunnel._PAYLOAD, id_, payload)
 
+    def supports_striping(self):
+        return self._send_version >= 3 and not self.is_closed()
+
+    def send_striped_payload(self, id_, seq, payload):
+        self._send_content(Tunnel._STRIPED_PAYLOAD, id_, _pack_varint(seq) + payload)
+
+    def send_stripe_join(self, id_):
+        self._send_content(Tunnel._STRIPE_JOIN, id_, '')
+
+    def send_stripe_leave(self, id_):
+        self._send_content(Tunnel._STRIPE_LEAVE, id_, '')
+
+    def _on_striped(self, id_, data):
+        seq, offset = _unpack_varint(data, 0)
+        self._on_striped_payload(self, id_, seq, data[offset:])
+
+    def set_on_striped_payload(self, handler):
+        """handler(tunnel, id_, seq, data)"""
+        self._on_striped_payload = handler
+
     def set_on_payload(self, handler):
         self._on_payload = handler
 
@@ -217,6 +810,13 @@ class Tunnel(object):
 
     def _on_closed(self):
         self._disable_heartbeat()
+        Tunnel._live.pop(id(self), None)
+        if self._batch_ev is not None:
+            self._batch_ev.del_timer()
+            self._batch_ev = None
+        self._batch = []
+        self._batch_bytes = 0
+        self._clear_queues()
         if self._on_stream_closed is not None:
             self._on_stream_closed(self)
 
@@ -232,6 +832,28 @@ class Tunnel(object):
     def _on_decode_error(self, received):
         self._disable_heartbeat()
         self._stream._encoders = []
+        if SPLICE_RELAY and SpliceRelay.is_supported() and len(self._stream._to_send) == 0:
+            self._relay_unknown_connection(received)
+            return False
+        return self._copy_unknown_connection(received)
+
+    def _relay_unknown_connection(self, received):
+        # nothing more is read in python, the relay takes the socket over
+        # once the backend is connected
+        self._stream.stop_receiving()
+        backend = Stream(prefix="SIMPLE")
+
+        def backend_connected(_):
+            SpliceRelay(self._stream, backend, received).start()
+
+        def backend_closed(_):
+            self._stream.close()
+
+        backend.set_on_connected(backend_connected)
+        backend.set_on_closed(backend_closed)
+        backend.connect(UNKNOWN_CONN_ADDR, UNKNOWN_CONN_PORT)
+
+    def _copy_unknown_connection(self, received):
         backend = Stream(prefix="SIMPLE")
 
         def tunnel_ready_to_send(_):
@@ -247,6 +869,12 @@ class Tunnel(object):
         def tunnel_closed(_):
             backend.close()
 
+        def backend_ready_to_send(_):
+            self._stream.start_receiving()
+
+        def backend_send_buffer_full(_):
+            self._stream.stop_receiving()
+
         def backend_received(_, data, _addr):
             self._stream.send(data)
             return self._stream.is_ready_to_send()
@@ -257,9 +885,14 @@ class Tunnel(object):
         self._stream.set_on_ready_to_send(tunnel_ready_to_send)
         self._stream.set_on_send_buffer_full(tunnel_send_buffer_full)
         self._stream.set_on_received(tunnel_received)
+        # what is read after the decode error goes to the same backend
+        self._stream.set_on_decode_error(lambda self_, data: tunnel_received(self_, data, None))
         self._stream.set_on_closed(tunnel_closed)
+        backend.set_on_ready_to_send(backend_ready_to_send)
+        backend.set_on_send_buffer_full(backend_send_buffer_full)
         backend.set_on_received(backend_received)
         backend.set_on_closed(backend_closed)
         if received is not None and len(received) > 0:
             backend.send(received)
         backend.connect(UNKNOWN_CONN_ADDR, UNKNOWN_CONN_PORT)
+        return backend.is_ready_to_send()
@@ -0,0 +1,192 @@
+from event import Event
+from tunnel import Tunnel
+from autoscaler import Autoscaler
+
+import loglevel
+_logger = loglevel.get_logger('tunnelpool')
+_logger.setLevel(loglevel.DEFAULT_LEVEL)
+
+
+# a tunnel failing before it got connected is retried after this, doubled
+# on every failure in a row up to MAX_RECONNECT_DELAY
+RECONNECT_DELAY = 500
+MAX_RECONNECT_DELAY = 30 * 1000
+# a tunnel closed sooner than this after it got connected failed too, the
+# peer may accept and close right away when overloaded or rejecting it
+MIN_LIFETIME = 5 * 1000
+
+
+class TunnelPool(object):
+    """Keeps `size` connect side tunnels to `via` established.
+
+    The tunnels are connected on start() and warmed up, so the first
+    payload does not wait for the handshake or the cipher keys. A closed
+    tunnel is replaced in the background right away, one that failed to
+    connect or closed within MIN_LIFETIME after a delay growing with every
+    failure in a row.
+
+    With max_size above size an Autoscaler sizes the pool between the two
+    by its load, starting with size tunnels. A tunnel the pool shrinks by
+    is drained: it is no longer handed out, but what is on it goes on until
+    close_drained() finds it without connections and with nothing to send.
+    """
+
+    def __init__(self, via, size, max_size=None):
+        self._via = via
+        self._size = size
+        self._tunnels = []
+        self._draining = []
+        # a draining tunnel is closed with connections on it, once it has
+        # nothing to send, when their flows can move
+        self._movable = False
+        self._autoscaler = None
+        if max_size is not None and max_size > size:
+            self._autoscaler = Autoscaler(self, size, max_size)
+        # ids of the tunnels which got connected -> when
+        self._connected = {}
+        self._next = 0
+        self._failures = 0
+        self._reconnect_ev = None
+        self._closed = False
+        self._on_tunnel_created = None
+        self._on_tunnel_closed = None
+
+    def set_on_tunnel_created(self, handler):
+        """handler(tunnel) sets the tunnel up, before it is initialized"""
+        self._on_tunnel_created = handler
+
+    def set_on_tunnel_closed(self, handler):
+        self._on_tunnel_closed = handler
+
+    def set_flows_movable(self, movable):
+        """whether a flow may go on through another tunnel, as datagrams and
+        packets may, but not the bytes of a tcp connection"""
+        self._movable = movable
+
+    def start(self):
+        for _ in range(self._size):
+            self._open()
+        if self._autoscaler is not None:
+            self._autoscaler.start()
+
+    def _open(self):
+        tunnel = Tunnel(connect_to=self._via)
+        if self._on_tunnel_created is not None:
+            self._on_tunnel_created(tunnel)
+        tunnel.set_on_connected(self._on_connected)
+        tunnel.set_on_closed(self._on_closed)
+        tunnel.initialize()
+        self._tunnels.append(tunnel)
+        return tunnel
+
+    def _on_connected(self, tunnel):
+        _logger.debug('%s connected', str(tunnel))
+        self._connected[id(tunnel)] = Event.now()
+        tunnel.warm_up()
+
+    def _on_closed(self, tunnel):
+        # closed tunnels compare equal, their sockets are gone
+        draining = any(t is tunnel for t in self._draining)
+        self._tunnels = [t for t in self._tunnels if t is not tunnel]
+        self._draining = [t for t in self._draining if t is not tunnel]
+        if self._on_tunnel_closed is not None:
+            self._on_tunnel_closed(tunnel)
+
+        connected = self._connected.pop(id(tunnel), None)
+        if draining or self._closed:
+            return
+        if connected is not None and Event.now() - connected >= MIN_LIFETIME / 1000.0:
+            self._failures = 0
+        else:
+            self._failures += 1
+        if self._failures == 0:
+            self._replenish()
+        elif self._reconnect_ev is None:
+            delay = min(RECONNECT_DELAY * 2 ** (self._failures - 1), MAX_RECONNECT_DELAY)
+            _logger.warning('tunnel to %s:%d failed %d times, retry in %d ms',
+                            self._via[0], self._via[1], self._failures, delay)
+            self._reconnect_ev = Event.add_timer(delay)
+            self._reconnect_ev.set_handler(lambda ev: self._on_reconnect_timer())
+
+    def _on_reconnect_timer(self):
+        self._reconnect_ev = None
+        self._replenish()
+
+    def _replenish(self):
+        while len(self._tunnels) < self._size:
+            # taking a draining one back is cheaper than connecting one
+            if len(self._draining) > 0:
+                tunnel = self._draining.pop()
+                self._tunnels.append(tunnel)
+                _logger.debug('%s no longer draining', str(tunnel))
+            else:
+                self._open()
+
+    def set_size(self, size):
+        """opens tunnels up to size, or drains the least busy ones down to
+        it"""
+        assert(size > 0)
+        self._size = size
+        if len(self._tunnels) < size:
+            if self._reconnect_ev is None:
+                self._replenish()
+            return
+        while len(self._tunnels) > size:
+            # the ones still connecting first, then the least busy
+            tunnel = min(self._tunnels, key=lambda t: (t.is_established(), len(t.connections), t.get_outstanding()))
+            self._tunnels = [t for t in self._tunnels if t is not tunnel]
+            self._draining.append(tunnel)
+            _logger.debug('%s draining, %d connections', str(tunnel), len(tunnel.connections))
+        self.close_drained()
+
+    def close_drained(self):
+        """closes the draining tunnels nothing goes through any more"""
+        for tunnel in list(self._draining):
+            if tunnel.get_outstanding() > 0:
+                continue
+            if len(tunnel.connections) == 0 or self._movable:
+                _logger.debug('%s drained, closing', str(tunnel))
+                tunnel.close()
+
+    def close(self):
+        """closes the tunnels, none are opened any more"""
+        self._closed = True
+        if self._autoscaler is not None:
+            self._autoscaler.stop()
+        if self._reconnect_ev is not None:
+            self._reconnect_ev.del_timer()
+            self._reconnect_ev = None
+        for tunnel in self._tunnels + self._draining:
+            tunnel.close()
+
+    def get(self):
+        """an established tunnel if there is one, round robin over the ones
+        answering their pings"""
+        tunnels = [t for t in self._tunnels if t.is_established()]
+        healthy = [t for t in tunnels if not t.is_degraded()]
+        if len(healthy) > 0:
+            tunnels = healthy
+        if len(tunnels) == 0:
+            # still connecting, what is sent meanwhile is queued
+            tunnels = [t for t in self._tunnels if not t.is_closed()]
+        if len(tunnels) == 0:
+            return self._open()
+        self._next = (self._next + 1) % len(tunnels)
+        return tunnels[self._next]
+
+    def get_tunnels(self):
+        """the tunnels handed out, the draining ones are not"""
+        return list(self._tunnels)
+
+    def get_draining(self):
+        return list(self._draining)
+
+    def get_size(self):
+        return self._size
+
+    def get_via(self):
+        return self._via
+
+    def get_autoscaler(self):
+        """the Autoscaler sizing the pool, None if its size is fixed"""
+        return self._autoscaler
@@ -9,6 +9,9 @@ from watchdog.observers import Observer
 from watchdog.events import PatternMatchingEventHandler
 from tundevice import TunDevice
 from tunnel import Tunnel
+from tunnelpool import TunnelPool
+from placement import Placement, Affinity
+import autoscaler
 from dns import DNSRecord
 from dns import QTYPE
 from packet import Packet
@@ -22,7 +25,6 @@ def ip_string_to_long(ip):
     return struct.unpack('!I', socket.inet_pton(socket.AF_INET, ip))[0]
 
 
-TUNNEL_SIZE = 67
 FAST_DNS_SERVER = ip_string_to_long('119.29.29.29')
 CLEAN_DNS_SERVER = ip_string_to_long('8.8.8.8')
 TEST_DNS_SERVER = ip_string_to_long('35.201.154.22')
@@ -267,7 +269,9 @@ def test_domain_poisoned(tun, packet):
     tun.send(copied.get_packet())
 
 
-key_to_tunnels = {}
+# accept side, id -> the tunnel the flow came through last, where the
+# replies go
+server_affinity = Affinity()
 
 
 def is_through_tunnel(packet, to_addr):
@@ -332,6 +336,11 @@ def gen_on_client_side_received(tundev, from_, via, to):
             try_restore_dns(packet, id_)
         tundev.send(packet.get_packet())
 
+    pool = TunnelPool(via, autoscaler.MIN_TUNNELS, autoscaler.MAX_TUNNELS)
+    pool.set_on_tunnel_created(lambda tunnel_: tunnel_.set_on_payload(on_tunnel_received))
+    pool.set_flows_movable(True)
+    placement_ = Placement(pool)
+
     def connect_side_multiplex(tun_device, _, packet):
         if need_restore(from_addr, packet):
             restore_dst(packet)
@@ -359,15 +368,7 @@ def gen_on_client_side_received(tundev, from_, via, to):
             return True
 
         id_ = address2uuid(packet.get_raw_source_ip(), packet.get_source_port())
-        key = id_.int % TUNNEL_SIZE
-        tunnel = None
-        if key in key_to_tunnels:
-            tunnel = key_to_tunnels[key]
-        if tunnel is None or tunnel.is_closed():
-            tunnel = Tunnel(connect_to=via)
-            tunnel.set_on_payload(on_tunnel_received)
-            tunnel.initialize()
-            key_to_tunnels[key] = tunnel
+        tunnel = placement_.get(id_)
         # if proto == 'tcp':
         #     data = data * 2
         tunnel.send_tun_initial_data(id_, packet.get_packet())
@@ -383,10 +384,7 @@ def on_server_side_initialized(tunnel, id_, data):
 
     def on_received(_, data_, packet):
         id__ = address2uuid(packet.get_raw_destination_ip(), packet.get_destination_port())
-        key_ = id__.int % TUNNEL_SIZE
-        tunnel_ = None
-        if key_ in key_to_tunnels:
-            tunnel_ = key_to_tunnels[key_]
+        tunnel_ = server_affinity.get(id__)
         if tunnel_ is not None:
             tunnel_.send_payload(id__, data_)
         else:
@@ -399,8 +397,7 @@ def on_server_side_initialized(tunnel, id_, data):
         tun_device.set_on_received(on_received)
         tun_device.start_receiving()
 
-    key = id_.int % TUNNEL_SIZE
-    key_to_tunnels[key] = tunnel
+    server_affinity.bind(id_, tunnel)
     tun_device.send(data)
 
 
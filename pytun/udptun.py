@@ -3,13 +3,28 @@ import socket
 import struct
 import uuid
 from dgram import Dgram
-from tunnel import Tunnel
+from tunnelpool import TunnelPool
+from placement import Placement, Affinity
+import autoscaler
+from resolver import get_resolver
 
 import logging
 import loglevel
 _logger = loglevel.get_logger('udptun', logging.INFO)
 
 
+# datagrams of a flow kept while its destination is resolved, the first
+# one is often a query or handshake not retried soon
+MAX_UNRESOLVED = 16
+
+# connect side placements, a flow the other side closed is released there
+_placements = []
+# accept side, id -> the Dgram sending to the destination, and the tunnel
+# the flow came through last, where the replies go
+server_endpoints = {}
+server_affinity = Affinity()
+
+
 def address2uuid(addr, port):
     addr_str = socket.inet_pton(socket.AF_INET, addr)
     packed = struct.pack('!QH4sH', uuid.getnode(), 0, addr_str, port)
@@ -23,6 +38,12 @@ def uuid2address(id_):
 
 def on_tunnel_received(self_, id_, data):
     if hasattr(self_, 'to'):
+        if self_.to is None:
+            if len(self_.unresolved) < MAX_UNRESOLVED:
+                self_.unresolved.append(data)
+            else:
+                _logger.debug('%s not resolved yet, drop %d bytes', str(self_), len(data))
+            return
         addr, port = self_.to
     else:
         addr, port = uuid2address(id_)
@@ -33,6 +54,24 @@ def on_tunnel_closed(_):
     pass
 
 
+def _on_client_side_tunnel_received(tunnel, id_, data):
+    endpoint = tunnel.get_connection(id_)
+    if endpoint is None:
+        _logger.debug('flow %s has gone, drop %d bytes', str(id_), len(data))
+    else:
+        endpoint.on_tunnel_received(endpoint, id_, data)
+
+
+def _on_client_side_tunnel_closed(tunnel):
+    # the flows are placed on another tunnel by their next datagram
+    tunnel.clear_connections()
+
+
+def _prepare_client_side_tunnel(tunnel):
+    tunnel.set_on_payload(_on_client_side_tunnel_received)
+    tunnel.set_on_closed(_on_client_side_tunnel_closed)
+
+
 def gen_on_client_side_received(via, to):
 
     initial_data = json.dumps({
@@ -40,42 +79,78 @@ def gen_on_client_side_received(via, to):
         'port': to[1]
     })
 
+    pool = TunnelPool(via, autoscaler.MIN_TUNNELS, autoscaler.MAX_TUNNELS)
+    pool.set_on_tunnel_created(_prepare_client_side_tunnel)
+    pool.set_flows_movable(True)
+    placement_ = Placement(pool)
+    _placements.append(placement_)
+
     def on_received(endpoint, data, from_):
         id_ = address2uuid(*from_)
-        tunnel = Delegation.get_tunnel(id_)
+        tunnel = placement_.lookup(id_)
         if tunnel is None:
-            tunnel = Tunnel(connect_to=via)
-            tunnel.set_on_payload(Delegation.on_payload)
-            tunnel.set_on_closed(Delegation.on_closed)
-            tunnel.set_on_ready_to_send(Delegation.set_on_ready_to_send)
-            tunnel.set_on_send_buffer_full(Delegation.set_on_send_buffer_full)
-            tunnel.initialize()
-        if Delegation.query_endpoint(id_) is None:
+            # a new flow, or its tunnel closed and the other side learns
+            # where it went
+            tunnel = placement_.get(id_)
+            if tunnel.get_connection(id_) is None:
+                tunnel.register(id_, endpoint)
             tunnel.send_udp_initial_data(id_, initial_data)
-            Delegation.register(id_, tunnel, endpoint)
         tunnel.send_payload(id_, data)
+        return True
 
     return on_received
 
 
+def _on_server_side_tunnel_received(tunnel, id_, data):
+    endpoint = server_endpoints.get(id_)
+    if endpoint is None:
+        _logger.debug('flow %s has gone, drop %d bytes', str(id_), len(data))
+        return
+    if server_affinity.get(id_) is not tunnel:
+        server_affinity.bind(id_, tunnel)
+    endpoint.on_tunnel_received(endpoint, id_, data)
+
+
 def on_server_side_initialized(tunnel, id_, initial_data):
     json_data = json.loads(initial_data)
     address, port = json_data['addr'], json_data['port']
 
-    endpoint = Delegation.query_endpoint(id_)
-    if endpoint is None:
-        endpoint = Dgram()
-        endpoint.uuid = id_
-        endpoint.to = (address, port)
-    Delegation.register(endpoint.uuid, tunnel, endpoint)
+    tunnel.set_on_payload(_on_server_side_tunnel_received)
+    server_affinity.bind(id_, tunnel)
+    if id_ in server_endpoints:
+        _logger.debug('datagram flow %s moved to %s', str(id_), str(tunnel))
+        return
+
+    endpoint = Dgram()
+    endpoint.uuid = id_
+    # sendto would resolve a host name for every datagram, blocking
+    endpoint.to = None
+    endpoint.unresolved = []
+    server_endpoints[id_] = endpoint
+
+    def on_resolved(resolved, error):
+        unresolved, endpoint.unresolved = endpoint.unresolved, []
+        if endpoint.is_closed():
+            return
+        if error is None:
+            endpoint.to = (resolved, port)
+            for data in unresolved:
+                endpoint.send(data, endpoint.to)
+        else:
+            endpoint.close()
+
+    get_resolver().resolve(address, on_resolved)
 
     def on_received(self_, data, _):
-        tunnel_ = Delegation.get_tunnel(self_.uuid)
+        tunnel_ = server_affinity.get(self_.uuid)
         if tunnel_ is not None:
             tunnel_.send_payload(self_.uuid, data)
+        return True
 
     def on_closed(self_):
-        tunnel_ = Delegation.get_tunnel(self_.uuid)
+        server_endpoints.pop(self_.uuid, None)
+        tunnel_ = server_affinity.get(self_.uuid)
+        server_affinity.release(self_.uuid)
         if tunnel_ is not None:
             tunnel_.send_udp_closed_data(self_.uuid)
 
@@ -90,5 +165,13 @@ def on_server_side_initialized(tunnel, id_, initial_data):
     _logger.info('new datagram to: %s:%d (%s)', address, port, str(endpoint))
 
 
-def on_dgram_closed(_tunnel, id_, _):
-    Delegation.de_register(id_)
+def on_dgram_closed(tunnel, id_, _):
+    endpoint = server_endpoints.pop(id_, None)
+    if endpoint is not None:
+        server_affinity.release(id_)
+        endpoint.close()
+        return
+    tunnel.deregister(id_)
+    for placement_ in _placements:
+        if placement_.lookup(id_) is tunnel:
+            placement_.release(id_)
@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import traceback
+from event import Event
+
+import loglevel
+_logger = loglevel.get_logger('worker')
+_logger.setLevel(loglevel.DEFAULT_LEVEL)
+
+
+STATS_INTERVAL = 10 * 1000
+RESTART_DELAY = 1.0
+
+
+class Supervisor(object):
+    """Forks `count` workers and keeps them running.
+
+    `on_start` runs in every freshly forked worker. It has to set up the
+    event backend and the listeners (bound with SO_REUSEPORT, so the kernel
+    spreads connections over the workers) and returns a callable giving the
+    worker's stats as a dict of numbers. Workers report their stats through
+    a pipe, the supervisor logs the sum of them.
+    """
+
+    def __init__(self, count, on_start):
+        self._count = count
+        self._on_start = on_start
+        # slot -> (pid, read end of the stats pipe)
+        self._workers = {}
+        self._stats = {}
+        self._buffers = {}
+        self._restarts = 0
+        self._stopping = False
+
+    def _spawn(self, slot):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            for _, (_, fd) in self._workers.items():
+                os.close(fd)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                self._run_worker(slot, write_fd)
+            except Exception as ex:
+                _logger.error('worker %d: %s', slot, str(ex))
+                _logger.error('%s', traceback.format_exc())
+            os._exit(1)
+        os.close(write_fd)
+        self._workers[slot] = (pid, read_fd)
+        self._buffers[slot] = ''
+        _logger.info('worker %d started, pid: %d', slot, pid)
+
+    def _run_worker(self, slot, write_fd):
+        get_stats = self._on_start()
+
+        def report():
+            stats = get_stats()
+            stats['pid'] = os.getpid()
+            os.write(write_fd, json.dumps(stats) + '\n')
+            timer = Event.add_timer(STATS_INTERVAL)
+            timer.set_handler(lambda ev: report())
+
+        _logger.info('worker %d running', slot)
+        report()
+        Event.process_loop()
+
+    def _read_stats(self, slot, fd):
+        try:
+            data = os.read(fd, 4096)
+        except OSError as ex:
+            if ex.errno == errno.EINTR:
+                return
+            raise
+        if len(data) == 0:
+            return
+        lines = (self._buffers[slot] + data).split('\n')
+        self._buffers[slot] = lines[-1]
+        for line in lines[:-1]:
+            try:
+                self._stats[slot] = json.loads(line)
+            except ValueError:
+                _logger.warning('worker %d: bad stats: %s', slot, line[:64])
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as ex:
+                if ex.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            for slot, (pid_, fd) in self._workers.items():
+                if pid_ == pid:
+                    _logger.warning('worker %d (pid: %d) exited with status %d', slot, pid, status)
+                    os.close(fd)
+                    del self._workers[slot]
+                    if slot in self._stats:
+                        del self._stats[slot]
+                    break
+
+    def get_stats(self):
+        total = {'workers': len(self._workers), 'restarts': self._restarts}
+        for stats in self._stats.values():
+            for key, value in stats.items():
+                if key == 'pid' or not isinstance(value, (int, long, float)):
+                    continue
+                total[key] = total.get(key, 0) + value
+        return total
+
+    def _stop(self, _signum, _frame):
+        self._stopping = True
+
+    def _kill_workers(self):
+        for slot, (pid, _) in self._workers.items():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for _ in self._workers:
+            try:
+                os.wait()
+            except OSError:
+                break
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for slot in range(self._count):
+            self._spawn(slot)
+
+        last_report = time.time()
+        last_restart = 0
+        while not self._stopping:
+            fds = dict((fd, slot) for slot, (_, fd) in self._workers.items())
+            try:
+                readable, _, _ = select.select(fds.keys(), [], [], 1.0)
+            except select.error as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                self._read_stats(fds[fd], fd)
+
+            self._reap()
+            now = time.time()
+            for slot in range(self._count):
+                # do not fork in a tight loop if workers die at once
+                if slot not in self._workers and now - last_restart > RESTART_DELAY:
+                    self._restarts += 1
+                    last_restart = now
+                    self._spawn(slot)
+
+            if now - last_report > STATS_INTERVAL / 1000.0:
+                _logger.info('workers stats: %s', json.dumps(self.get_stats(), sort_keys=True))
+                last_report = now
+
+        _logger.info('stopping %d workers', len(self._workers))
+        self._kill_workers()
+        sys.exit(0)